@@ -0,0 +1,116 @@
+"""
+Replays a skewed stream of repeated and reworded questions against the query function
+with the answer cache on and off, and reports hit rates, latency and the Vertex AI,
+BigQuery and Gemini calls made. The index is re-indexed halfway through each run.
+
+    python benchmarks/answer_cache.py --queries 500 --questions 40 --llm-latency 0.5
+"""
+import argparse
+import hashlib
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from langchain_core.documents import Document  # noqa: E402
+
+from fakes import FakeEmbeddings, FakeFirestore  # noqa: E402
+from langchain_fakes import FakeChatModel, FakeDocumentStore, FakeRequest, load_query_function  # noqa: E402
+
+
+class BagOfWordsEmbeddings(FakeEmbeddings):
+    """
+    Embeds a text as its hashed bag of words, so rewordings of a question (different order,
+    case or punctuation) get nearby vectors like they would with a real model.
+    """
+
+    def _vector(self, text: str) -> list:
+        vector = [0.0] * self.dimensions
+        for word in text.lower().replace("?", " ").replace(",", " ").split():
+            vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % self.dimensions] += 1.0
+        return vector
+
+
+def question_stream(queries: int, questions: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    stream = []
+    for _ in range(queries):
+        # Zipf-like popularity: a few questions make up most of the traffic
+        q = min(int(rng.paretovariate(1.2)) - 1, questions - 1)
+        wording = rng.randrange(3)
+        if wording == 0:
+            stream.append(f"What is the payment term of clause {q}?")
+        elif wording == 1:
+            stream.append(f"what is the payment term of clause {q}")
+        else:
+            stream.append(f"Clause {q}, what is the payment term?")
+    return stream
+
+
+def run(query_main, stream: list, db: FakeFirestore, counters: dict) -> dict:
+    latencies = []
+    for i, question in enumerate(stream):
+        if i == len(stream) // 2:
+            # Re-indexing bumps the index generation, as the indexer does
+            db.collection("index_state").document(query_main.BIGQUERY_TABLE).set({"generation": i}, merge=True)
+        started = time.perf_counter()
+        query_main.query(FakeRequest({"query": question}))
+        latencies.append(time.perf_counter() - started)
+    return {"latencies": latencies, **{name: counter() for name, counter in counters.items()}}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--questions", type=int, default=40, help="Distinct questions in the stream")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Simulated seconds per chat model call")
+    parser.add_argument("--search-latency", type=float, default=0.3, help="Simulated seconds per vector search")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="Simulated seconds per embedding request")
+    parser.add_argument("--similarity", type=float, default=0.95, help="Semantic tier similarity threshold")
+    args = parser.parse_args()
+
+    stream = question_stream(args.queries, args.questions)
+    documents = [
+        Document(page_content=f"Clause {i}: payment is due within {i + 10} days.", metadata={"source": "contract.pdf", "page": i})
+        for i in range(args.questions)
+    ]
+
+    for label, size in (("no cache", "0"), ("answer cache", "1000")):
+        os.environ["ANSWER_CACHE_SIZE"] = size
+        os.environ["ANSWER_CACHE_SIMILARITY"] = str(args.similarity)
+        embeddings = BagOfWordsEmbeddings(latency=args.embedding_latency, dimensions=256)
+        chat_llm = FakeChatModel(responses=["Payment is due within 30 days.\nSOURCES: contract.pdf"], latency=args.llm_latency)
+        store = FakeDocumentStore(documents, latency=args.search_latency)
+        db = FakeFirestore()
+        query_main = load_query_function(chat_llm, store, embeddings=embeddings, db=db, module_name=f"query_main_{size}")
+        if query_main.answer_cache():
+            # Notice the re-indexing right away instead of within GENERATION_CHECK_SECONDS
+            query_main.answer_cache().generation = query_main.IndexGeneration(db, query_main.BIGQUERY_TABLE, check_seconds=0).current
+
+        sys.stdout, stdout = open(os.devnull, "w"), sys.stdout
+        try:
+            result = run(
+                query_main,
+                stream,
+                db,
+                {
+                    "embedding requests": lambda: embeddings.calls["requests"],
+                    "vector searches": lambda: store.searches,
+                    "LLM calls": lambda: chat_llm.calls,
+                },
+            )
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+        latencies = sorted(result.pop("latencies"))
+        print(
+            f"{label:>12}: total {sum(latencies):7.2f}s  p50 {statistics.median(latencies) * 1000:8.2f}ms  "
+            f"p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:8.2f}ms  "
+            + "  ".join(f"{count} {name}" for name, count in result.items())
+        )
+        if query_main.answer_cache():
+            print(f"{'':>12}  {query_main.answer_cache().stats()}")
@@ -0,0 +1,53 @@
+"""
+Answers the same questions with every answer strategy of the query function and
+reports the LLM calls and latency per query, with a fake chat model and vector store.
+
+    python benchmarks/answer_strategy.py --k 4 --llm-latency 0.5
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from langchain_core.documents import Document  # noqa: E402
+
+from langchain_fakes import FakeChatModel, FakeDocumentStore, load_query_function  # noqa: E402
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=10)
+    parser.add_argument("--k", type=int, default=4, help="Documents retrieved per query")
+    parser.add_argument("--chunk-words", type=int, default=300, help="Words per retrieved document")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Simulated seconds per chat model call")
+    parser.add_argument("--token-budget", type=int, default=28000, help="Prompt token budget of the auto strategy")
+    args = parser.parse_args()
+
+    filler = " ".join(["the supplier shall deliver the products on the agreed date"] * (args.chunk_words // 10))
+    documents = [
+        Document(page_content=f"Clause {i}: payment is due within {i + 10} days. {filler}", metadata={"source": "contract.pdf", "page": i})
+        for i in range(50)
+    ]
+    chat_llm = FakeChatModel(responses=["Payment is due within 30 days.\nSOURCES: contract.pdf"], latency=args.llm_latency)
+    store = FakeDocumentStore(documents)
+    query_main = load_query_function(chat_llm, store)
+    # Importable once the query function has been loaded, with its folder on the path
+    from scoped_search import ScopedRetrievalQAWithSourcesChain
+
+    retriever = store.as_retriever(search_kwargs={"k": args.k})
+
+    for strategy in ("auto", "stuff", "map_reduce", "refine"):
+        chain = ScopedRetrievalQAWithSourcesChain(
+            combine_documents_chain=query_main.build_combine_chain(chat_llm, strategy, args.token_budget),
+            retriever=retriever,
+        )
+        calls, latencies = [], []
+        for i in range(args.queries):
+            counter = query_main.LLMCallCounter()
+            started = time.perf_counter()
+            chain({"question": f"What is the payment term of clause {i}?"}, callbacks=[counter])
+            latencies.append(time.perf_counter() - started)
+            calls.append(counter.calls)
+        print(f"{strategy:>10}: {statistics.mean(calls):5.1f} LLM calls/query  {statistics.mean(latencies) * 1000:8.1f}ms/query")
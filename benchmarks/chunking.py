@@ -0,0 +1,38 @@
+"""
+Compares the number and size of the chunks produced by each chunking strategy of the
+chunker on a synthetic Document AI output, i.e. the number of texts the indexer
+embeds and stores per document.
+
+    python benchmarks/chunking.py --pages 300 --max-tokens 512 --overlap-tokens 50
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "chunker"))
+
+from chunking import STRATEGIES, chunk_documents, count_tokens  # noqa: E402
+from fakes import synthetic_document  # noqa: E402
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--paragraphs-per-page", type=int, default=20)
+    parser.add_argument("--words-per-paragraph", type=int, default=30)
+    parser.add_argument("--max-tokens", type=int, default=512)
+    parser.add_argument("--overlap-tokens", type=int, default=50)
+    args = parser.parse_args()
+
+    document = synthetic_document(args.pages, args.paragraphs_per_page, args.words_per_paragraph)
+
+    runs = [("paragraph (unmerged)", "paragraph", 0)] + [(name, name, args.max_tokens) for name in STRATEGIES]
+    for label, strategy, max_tokens in runs:
+        started = time.monotonic()
+        chunks = list(chunk_documents([document], strategy, max_tokens=max_tokens, overlap_tokens=args.overlap_tokens))
+        elapsed = time.monotonic() - started
+        tokens = [count_tokens(chunk.text) for chunk in chunks]
+        print(
+            f"{label:>20}: {len(chunks):6d} chunks  {sum(tokens) / len(chunks):6.1f} avg tokens  "
+            f"{max(tokens):5d} max tokens  {sum(tokens):8d} total tokens  {elapsed:5.2f}s"
+        )
@@ -0,0 +1,234 @@
+"""
+Measures the cold start of the query, indexer and chunker functions: the time to
+import main.py and the latency of the first request, with the GCP clients replaced by
+stubs that take --client-latency seconds to create and --api-latency seconds per API
+call. Every run is a fresh Python process, so library imports are included (except the
+Firestore and Document AI modules the fakes themselves import).
+
+Modes:
+    eager        every client created at import, one after the other (how the functions used to start)
+    lazy         clients created on first use, the ones a request needs concurrently
+    provisioned  lazy, with the BigQuery dataset and table assumed to exist (BIGQUERY_PROVISIONED=true)
+
+    python benchmarks/cold_start.py --runs 3 --client-latency 0.1 --api-latency 0.2
+"""
+import argparse
+import importlib.abc
+import importlib.machinery
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+FUNCTIONS = ("query", "indexer", "chunker")
+MODES = ("eager", "lazy", "provisioned")
+# Resources only used in a mode the benchmark does not enable (the chunker's Pub/Sub publisher needs PIPELINE_TOPIC)
+OPTIONAL_CLIENTS = {"publisher"}
+
+
+class StubbingFinder(importlib.abc.MetaPathFinder):
+    """
+    Imports modules normally, then replaces some of their attributes with stubs; the
+    import itself is still paid for, like in a real cold start.
+    """
+
+    def __init__(self, stubs: dict):
+        self.stubs = stubs
+
+    def find_spec(self, name, path, target=None):
+        if name not in self.stubs:
+            return None
+        spec = importlib.machinery.PathFinder.find_spec(name, path)
+        exec_module = spec.loader.exec_module
+
+        def exec_and_stub(module):
+            exec_module(module)
+            for attribute, value in self.stubs[name].items():
+                setattr(module, attribute, value)
+
+        spec.loader.exec_module = exec_and_stub
+        return spec
+
+
+def install_stubs(client_latency: float, api_latency: float) -> Counter:
+    """
+    Replaces the Firestore, BigQuery, Cloud Storage, Document AI and Vertex AI clients with
+    stubs. Returns the counter of the API calls they receive.
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from fakes import FakeEmbeddings, FakeFirestore
+
+    calls = Counter()
+
+    def api(name: str) -> None:
+        calls[name] += 1
+        time.sleep(api_latency)
+
+    def full_table(reference):
+        from google.cloud import bigquery
+
+        table = bigquery.Table(getattr(reference, "reference", reference), schema=[
+            bigquery.SchemaField("doc_id", "STRING"),
+            bigquery.SchemaField("content", "STRING"),
+            bigquery.SchemaField("metadata", "JSON"),
+            bigquery.SchemaField("text_embedding", "FLOAT64", mode="REPEATED"),
+            bigquery.SchemaField("collection", "STRING"),
+        ])
+        table.clustering_fields = ["collection"]
+        return table
+
+    class StubJob(list):
+        job_id = "job"
+
+        def result(self):
+            api("bigquery.job_result")
+            return self
+
+    class StubBigQueryClient:
+        def __init__(self, *args, **kwargs):
+            time.sleep(client_latency)
+
+        def create_dataset(self, dataset, exists_ok=False):
+            api("bigquery.create_dataset")
+
+        def create_table(self, table, exists_ok=False):
+            from google.cloud import bigquery
+
+            api("bigquery.create_table")
+            return bigquery.Table(table)
+
+        def get_table(self, table):
+            api("bigquery.get_table")
+            return full_table(table)
+
+        def update_table(self, table, fields):
+            api("bigquery.update_table")
+            return table
+
+        def query(self, query, **kwargs):
+            api("bigquery.query")
+            row = {"doc_id": "1", "content": "Payment is due within 30 days.", "text_embedding": [0.0] * 64,
+                   "metadata": {"source": "contract.pdf", "page": 1}, "_vector_search_distance": 0.1}
+            return StubJob([row])
+
+        def load_table_from_json(self, rows, table, job_config=None):
+            api("bigquery.load_table_from_json")
+            return StubJob()
+
+    class StubClient:
+        def __init__(self, *args, **kwargs):
+            time.sleep(client_latency)
+
+    def firestore_client(*args, **kwargs):
+        time.sleep(client_latency)
+        db = FakeFirestore(latency=api_latency)
+        db.calls = calls
+        # One uploaded file whose paragraphs still need to be indexed
+        file_ref = db.collection("contracts").document("contract.pdf")
+        file_ref._apply_set({"status": "Processing..."})
+        for i in range(3):
+            file_ref.collection("paragraphs").document(f"1.{i}")._apply_set({"text": f"Clause {i}: payment is due within 30 days.", "page": 1, "indexed": False})
+        return db
+
+    def vertex_embeddings(*args, **kwargs):
+        time.sleep(client_latency)
+        api("vertexai.get_model")
+        return FakeEmbeddings()
+
+    def chat_model(*args, **kwargs):
+        from langchain_fakes import FakeChatModel
+
+        time.sleep(client_latency)
+        return FakeChatModel(responses=["Payment is due within 30 days.\nSOURCES: contract.pdf"])
+
+    stubs = {
+        "google.cloud.firestore": {"Client": firestore_client},
+        "google.cloud.bigquery": {"Client": StubBigQueryClient},
+        "google.cloud.storage": {"Client": StubClient},
+        "google.cloud.documentai": {"DocumentProcessorServiceClient": StubClient},
+        "langchain_google_vertexai": {"VertexAIEmbeddings": vertex_embeddings, "ChatVertexAI": chat_model},
+    }
+    for name, attributes in list(stubs.items()):
+        if name in sys.modules:
+            for attribute, value in attributes.items():
+                setattr(sys.modules[name], attribute, value)
+            del stubs[name]
+    sys.meta_path.insert(0, StubbingFinder(stubs))
+    return calls
+
+
+def first_request(function: str, module):
+    if function == "query":
+        return module.query(SimpleNamespace(get_json=lambda silent=False: {"query": "What is the payment term?"}, headers={}))
+    if function == "indexer":
+        return module.indexer(SimpleNamespace(get_json=lambda silent=False: {"object": "contracts/contract.pdf"}))
+    # Document AI output of an operation this instance does not know about: only Firestore is needed
+    return module.on_output_written(SimpleNamespace(data={"name": "unknown/0/contract-0.json"}))
+
+
+def worker(function: str, mode: str, client_latency: float, api_latency: float) -> dict:
+    calls = install_stubs(client_latency, api_latency)
+    os.environ["BIGQUERY_PROVISIONED"] = str(mode == "provisioned").lower()
+    function_dir = os.path.join(ROOT, function)
+    sys.path.insert(0, function_dir)
+
+    started = time.perf_counter()
+    spec = importlib.util.spec_from_file_location(f"{function}_main", os.path.join(function_dir, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if mode == "eager":
+        for name in module.clients._factories:
+            if name not in OPTIONAL_CLIENTS:
+                module.clients.get(name)
+    imported = time.perf_counter() - started
+
+    started = time.perf_counter()
+    first_request(function, module)
+    requested = time.perf_counter() - started
+    return {
+        "import": imported,
+        "first_request": requested,
+        "created": sorted(module.clients.timings),
+        "api_calls": sum(calls.values()),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--client-latency", type=float, default=0.1, help="Seconds to create a client (credentials, channel)")
+    parser.add_argument("--api-latency", type=float, default=0.2, help="Seconds per API call")
+    parser.add_argument("--functions", nargs="+", default=FUNCTIONS, choices=FUNCTIONS)
+    parser.add_argument("--worker", nargs=2, metavar=("FUNCTION", "MODE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        result = worker(*args.worker, args.client_latency, args.api_latency)
+        print("RESULT " + json.dumps(result))
+        sys.exit(0)
+
+    for function in args.functions:
+        for mode in MODES:
+            if mode == "provisioned" and function == "chunker":
+                continue
+            results = []
+            for _ in range(args.runs):
+                output = subprocess.run(
+                    [sys.executable, __file__, "--worker", function, mode,
+                     "--client-latency", str(args.client_latency), "--api-latency", str(args.api_latency)],
+                    capture_output=True, text=True, check=True,
+                ).stdout
+                results.append(json.loads(output.rsplit("RESULT ", 1)[1]))
+            imported = statistics.median(r["import"] for r in results)
+            requested = statistics.median(r["first_request"] for r in results)
+            print(
+                f"{function:>8} {mode:>11}: import {imported:6.2f}s  first request {requested:6.2f}s  "
+                f"total {imported + requested:6.2f}s  {results[0]['api_calls']:3d} API calls  "
+                f"clients: {', '.join(results[0]['created'])}"
+            )
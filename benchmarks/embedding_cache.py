@@ -0,0 +1,64 @@
+"""
+Indexes a synthetic corpus twice through the indexer's EmbeddingPipeline with the
+content-hash embedding cache, and reports the number of embedding calls per run.
+Part of every paragraph set is shared boilerplate (headers, disclaimers, footers).
+
+    python benchmarks/embedding_cache.py --documents 20 --paragraphs 100
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "indexer"))
+
+from embedding_cache import CachedEmbeddings, FirestoreEmbeddingStore  # noqa: E402
+from fakes import FakeEmbeddings, FakeFirestore, FakeVectorStore  # noqa: E402
+from pipeline import EmbeddingPipeline  # noqa: E402
+
+BOILERPLATE = [
+    "CONFIDENTIAL - Do not distribute without written consent.",
+    "This document is provided for information purposes only and does not constitute legal advice.",
+    "Page footer: ACME Corporation, 1 Example Street, Springfield.",
+]
+
+
+def synthetic_corpus(documents: int, paragraphs: int) -> list:
+    corpus = []
+    for d in range(documents):
+        texts = [f"Document {d}, clause {p}: the parties agree to term {p * 7 % 13}." for p in range(paragraphs)]
+        corpus.append(texts + BOILERPLATE)
+    return corpus
+
+
+def ingest(corpus: list, cached: CachedEmbeddings, store: FakeVectorStore) -> float:
+    started = time.monotonic()
+    for d, texts in enumerate(corpus):
+        EmbeddingPipeline(cached, store).run([(text, {"source": f"doc-{d}.pdf"}, None) for text in texts])
+    return time.monotonic() - started
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=20)
+    parser.add_argument("--paragraphs", type=int, default=100, help="Unique paragraphs per document")
+    parser.add_argument("--latency", type=float, default=0.1, help="Simulated seconds per embedding request")
+    parser.add_argument("--firestore-latency", type=float, default=0.01, help="Simulated seconds per Firestore RPC")
+    args = parser.parse_args()
+
+    corpus = synthetic_corpus(args.documents, args.paragraphs)
+    embeddings = FakeEmbeddings(latency=args.latency)
+    db = FakeFirestore(latency=args.firestore_latency)
+    store = FakeVectorStore(embeddings)
+    cached = CachedEmbeddings(embeddings, "textembedding-gecko@003", shared_store=FirestoreEmbeddingStore(db))
+
+    for name in ("first ingestion", "re-ingestion"):
+        before = embeddings.calls["texts"]
+        elapsed = ingest(corpus, cached, store)
+        print(f"{name:>16}: {elapsed:6.2f}s  {embeddings.calls['texts'] - before:6d} texts embedded  cache {cached.stats()}")
+
+    # A fresh instance only has the shared tier
+    cold = CachedEmbeddings(embeddings, "textembedding-gecko@003", shared_store=FirestoreEmbeddingStore(db))
+    before = embeddings.calls["texts"]
+    elapsed = ingest(corpus, cold, store)
+    print(f"{'new instance':>16}: {elapsed:6.2f}s  {embeddings.calls['texts'] - before:6d} texts embedded  cache {cold.stats()}")
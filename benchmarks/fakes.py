@@ -0,0 +1,712 @@
+"""
+In-process stand-ins for the GCP clients used by the Cloud Functions, so the
+benchmarks in this directory can run without a project or credentials.
+"""
+import base64
+import hashlib
+import queue
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+from datetime import datetime, timezone
+
+from google.api_core.exceptions import FailedPrecondition, InvalidArgument, ResourceExhausted
+from google.auth.credentials import Signing
+from google.cloud import documentai  # type: ignore
+from google.cloud.firestore_v1.transforms import DELETE_FIELD, Increment, Sentinel
+from google.longrunning import operations_pb2
+
+
+class FakeFirestore:
+    """
+    Minimal in-memory Firestore client. Every RPC (`set`, `update`, `commit`, ...)
+    sleeps for `latency` seconds and is counted in `calls`.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.data = {}
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def _rpc(self, name: str) -> None:
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def collection(self, name: str) -> "FakeCollectionReference":
+        return FakeCollectionReference(self, (name,))
+
+    def collection_group(self, name: str) -> "FakeCollectionGroup":
+        return FakeCollectionGroup(self, name)
+
+    def batch(self) -> "FakeWriteBatch":
+        return FakeWriteBatch(self)
+
+    def get_all(self, references: list) -> list:
+        self._rpc("get_all")
+        with self._lock:
+            return [FakeDocumentSnapshot(reference, self.data.get(reference.path)) for reference in references]
+
+
+class FakeCollectionReference:
+    def __init__(self, client: FakeFirestore, path: tuple):
+        self._client = client
+        self._path = path
+
+    @property
+    def id(self) -> str:
+        return self._path[-1]
+
+    @property
+    def parent(self) -> "FakeDocumentReference":
+        return FakeDocumentReference(self._client, self._path[:-1]) if len(self._path) > 1 else None
+
+    def document(self, document_id: str) -> "FakeDocumentReference":
+        return FakeDocumentReference(self._client, self._path + (document_id,))
+
+    def where(self, filter) -> "FakeQuery":
+        return FakeQuery(self._client, self._path, [filter])
+
+    def select(self, field_paths: list) -> "FakeQuery":
+        return FakeQuery(self._client, self._path, [], field_paths)
+
+    def stream(self):
+        return FakeQuery(self._client, self._path, []).stream()
+
+
+class FakeQuery:
+    """
+    The documents of a collection matching equality filters (FieldFilter(field, "==", value)),
+    with only the `field_paths` fields if given.
+    """
+
+    def __init__(self, client: FakeFirestore, path: tuple, filters: list, field_paths: list = None):
+        self._client = client
+        self._path = path
+        self._filters = filters
+        self._field_paths = field_paths
+
+    def where(self, filter) -> "FakeQuery":
+        return FakeQuery(self._client, self._path, self._filters + [filter], self._field_paths)
+
+    def select(self, field_paths: list) -> "FakeQuery":
+        return FakeQuery(self._client, self._path, self._filters, field_paths)
+
+    def stream(self):
+        self._client._rpc("stream")
+        with self._client._lock:
+            items = [
+                (path, dict(data)) for path, data in self._client.data.items()
+                if path[:-1] == self._path
+                and all(f.op_string == "==" and data.get(f.field_path) == f.value for f in self._filters)
+            ]
+        for path, data in items:
+            if self._field_paths is not None:
+                data = {field: data[field] for field in self._field_paths if field in data}
+            yield FakeDocumentSnapshot(FakeDocumentReference(self._client, path), data)
+
+
+class FakeCollectionGroup:
+    """
+    All the collections named `name`, whatever their parent document.
+    """
+
+    def __init__(self, client: FakeFirestore, name: str):
+        self._client = client
+        self._name = name
+
+    def stream(self):
+        self._client._rpc("stream")
+        with self._client._lock:
+            items = [(path, dict(data)) for path, data in self._client.data.items() if len(path) > 1 and path[-2] == self._name]
+        for path, data in items:
+            yield FakeDocumentSnapshot(FakeDocumentReference(self._client, path), data)
+
+
+class FakeDocumentReference:
+    def __init__(self, client: FakeFirestore, path: tuple):
+        self._client = client
+        self.path = path
+
+    @property
+    def id(self) -> str:
+        return self.path[-1]
+
+    @property
+    def parent(self) -> FakeCollectionReference:
+        return FakeCollectionReference(self._client, self.path[:-1])
+
+    def collection(self, name: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self._client, self.path + (name,))
+
+    def get(self) -> "FakeDocumentSnapshot":
+        self._client._rpc("get")
+        with self._client._lock:
+            return FakeDocumentSnapshot(self, self._client.data.get(self.path))
+
+    def set(self, data: dict, merge: bool = False) -> None:
+        self._client._rpc("set")
+        if merge:
+            self._apply_merge(data)
+        else:
+            self._apply_set(data)
+
+    def update(self, data: dict) -> None:
+        self._client._rpc("update")
+        self._apply_update(data)
+
+    @staticmethod
+    def _resolve(existing: dict, data: dict) -> dict:
+        # Apply the field transforms (Increment, SERVER_TIMESTAMP, DELETE_FIELD) the way the server would
+        resolved = {}
+        for field, value in data.items():
+            if value is DELETE_FIELD:
+                existing.pop(field, None)
+                continue
+            if isinstance(value, Increment):
+                value = existing.get(field, 0) + value.value
+            elif isinstance(value, Sentinel):
+                value = datetime.now(timezone.utc)
+            resolved[field] = value
+        return resolved
+
+    def _apply_set(self, data: dict) -> None:
+        with self._client._lock:
+            self._client.data[self.path] = self._resolve({}, data)
+
+    def _apply_update(self, data: dict) -> None:
+        with self._client._lock:
+            existing = self._client.data.setdefault(self.path, {})
+            existing.update(self._resolve(existing, data))
+
+    def _apply_delete(self, data: None = None) -> None:
+        with self._client._lock:
+            self._client.data.pop(self.path, None)
+
+    def _apply_merge(self, data: dict) -> None:
+        # Unlike update, set(merge=True) merges nested maps instead of replacing them
+        def merge(existing: dict, data: dict) -> None:
+            for field, value in self._resolve(existing, data).items():
+                if isinstance(value, dict):
+                    # Field transforms inside the map are resolved against the existing map, if any
+                    if not isinstance(existing.get(field), dict):
+                        existing[field] = {}
+                    merge(existing[field], value)
+                else:
+                    existing[field] = value
+
+        with self._client._lock:
+            merge(self._client.data.setdefault(self.path, {}), data)
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, reference: FakeDocumentReference, data: dict):
+        self.reference = reference
+        self._data = data
+
+    @property
+    def id(self) -> str:
+        return self.reference.id
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> dict:
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeWriteBatch:
+    def __init__(self, client: FakeFirestore):
+        self._client = client
+        self._writes = []
+
+    def set(self, doc_ref: FakeDocumentReference, data: dict) -> None:
+        self._writes.append((doc_ref._apply_set, data))
+
+    def update(self, doc_ref: FakeDocumentReference, data: dict) -> None:
+        self._writes.append((doc_ref._apply_update, data))
+
+    def delete(self, doc_ref: FakeDocumentReference) -> None:
+        self._writes.append((doc_ref._apply_delete, None))
+
+    def commit(self) -> None:
+        self._client._rpc("commit")
+        for apply, data in self._writes:
+            apply(data)
+
+
+class FakeEmbeddings:
+    """
+    Deterministic stand-in for `VertexAIEmbeddings`. Each request sleeps for
+    `latency + per_text_latency * len(texts)` seconds, and fails with
+    `ResourceExhausted` with probability `quota_error_rate`, or with `InvalidArgument`
+    when it asks for more than `max_instances` texts (the limit of the region).
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        per_text_latency: float = 0.0,
+        dimensions: int = 64,
+        quota_error_rate: float = 0.0,
+        max_instances: int = 250,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.per_text_latency = per_text_latency
+        self.dimensions = dimensions
+        self.quota_error_rate = quota_error_rate
+        self.max_instances = max_instances
+        self.calls = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _vector(self, text: str) -> list:
+        seed = int.from_bytes(hashlib.md5(text.encode()).digest()[:8], "big")
+        rng = random.Random(seed)
+        return [rng.uniform(-1, 1) for _ in range(self.dimensions)]
+
+    def _request(self, texts: list) -> list:
+        with self._lock:
+            self.calls["requests"] += 1
+            self.calls["texts"] += len(texts)
+            quota_error = self._random.random() < self.quota_error_rate
+        time.sleep(self.latency + self.per_text_latency * len(texts))
+        if len(texts) > self.max_instances:
+            with self._lock:
+                self.calls["instance_limit_errors"] += 1
+            raise InvalidArgument(f"400 Unable to submit request because it has more than {self.max_instances} instances")
+        if quota_error:
+            with self._lock:
+                self.calls["quota_errors"] += 1
+            raise ResourceExhausted("Quota exceeded for aiplatform.googleapis.com/online_prediction_requests_per_base_model")
+        return [self._vector(text) for text in texts]
+
+    def embed_documents(self, texts: list, batch_size: int = 0) -> list:
+        batch_size = batch_size or 5
+        embs = []
+        for i in range(0, len(texts), batch_size):
+            embs.extend(self._request(texts[i : i + batch_size]))
+        return embs
+
+    def embed_query(self, text: str) -> list:
+        return self._request([text])[0]
+
+
+class FakeVectorStore:
+    """
+    In-memory stand-in for `BigQueryVectorSearch` (with the tombstones of
+    `CollectionVectorSearch`). Every insert sleeps for `latency` seconds, like a BigQuery
+    load job would.
+    """
+
+    def __init__(self, embedding: FakeEmbeddings, latency: float = 0.0):
+        self.embedding_model = embedding
+        self.latency = latency
+        self.rows = []
+        self.tombstones = set()
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def add_texts(self, texts: list, metadatas: list = None, **kwargs) -> list:
+        embs = self.embedding_model.embed_documents(texts)
+        return self.add_texts_with_embeddings(texts, embs, metadatas, **kwargs)
+
+    def add_texts_with_embeddings(self, texts: list, embs: list, metadatas: list = None, **kwargs) -> list:
+        with self._lock:
+            self.calls["inserts"] += 1
+        time.sleep(self.latency)
+        ids = [uuid.uuid4().hex for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        with self._lock:
+            self.rows.extend(zip(ids, texts, metadatas, embs))
+        return ids
+
+    def live_rows(self) -> list:
+        with self._lock:
+            return [row for row in self.rows if row[0] not in self.tombstones]
+
+    def tombstone_stale_rows(self, collection: str, source: str, live_ids: list) -> int:
+        live_ids = set(live_ids)
+        with self._lock:
+            self.calls["tombstones"] += 1
+            stale = {
+                row[0] for row in self.rows
+                if row[2].get("collection") == collection and row[2].get("source") == source
+                and row[0] not in live_ids and row[0] not in self.tombstones
+            }
+            self.tombstones |= stale
+        time.sleep(self.latency)
+        return len(stale)
+
+    def compact(self) -> int:
+        with self._lock:
+            self.calls["compactions"] += 1
+            removed = len(self.rows)
+            self.rows = [row for row in self.rows if row[0] not in self.tombstones]
+            removed -= len(self.rows)
+            self.tombstones = set()
+        time.sleep(self.latency)
+        return removed
+
+
+class InMemoryPubSub:
+    """
+    Stand-in for a Pub/Sub topic with a push subscription to a CloudEvent function.
+    `publish` has the signature of `PublisherClient.publish` and returns a future;
+    `workers` threads deliver every message to `handler` like Eventarc would (the
+    payload base64-encoded in `data["message"]["data"]`). A message whose handler
+    raises is delivered again after `retry_delay` seconds, at most `max_attempts` times.
+    """
+
+    def __init__(self, handler, workers: int = 4, max_attempts: int = 5, retry_delay: float = 0.0, latency: float = 0.0):
+        self.handler = handler
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.latency = latency
+        self.calls = Counter()
+        self.errors = []
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def publish(self, topic: str, data: bytes, **attributes) -> Future:
+        future = Future()
+        message_id = uuid.uuid4().hex
+        with self._lock:
+            self.calls["published"] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        event = SimpleNamespace(
+            data={"message": {"data": base64.b64encode(data).decode(), "messageId": message_id, "attributes": attributes}},
+            topic=topic,
+        )
+        self._queue.put((event, 1))
+        future.set_result(message_id)
+        return future
+
+    def _work(self) -> None:
+        while True:
+            event, attempt = self._queue.get()
+            try:
+                self.handler(event)
+                with self._lock:
+                    self.calls["acked"] += 1
+            except Exception as e:
+                with self._lock:
+                    self.calls["nacked"] += 1
+                    if attempt >= self.max_attempts:
+                        self.errors.append(e)
+                if attempt < self.max_attempts:
+                    time.sleep(self.retry_delay)
+                    self._queue.put((event, attempt + 1))
+            finally:
+                self._queue.task_done()
+
+    def join(self) -> None:
+        """
+        Waits until every published message has been acknowledged or has run out of attempts.
+        """
+        self._queue.join()
+
+
+class FakeStorage:
+    """
+    In-memory stand-in for the Cloud Storage client. Listing a bucket and downloading a
+    blob each sleep for `latency` seconds and are counted in `calls`.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.objects = {}
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def _rpc(self, name: str) -> None:
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def upload(self, bucket: str, name: str, data: bytes, content_type: str = "application/json") -> None:
+        with self._lock:
+            self.objects[(bucket, name)] = (data, content_type)
+
+    def list_blobs(self, bucket: str, prefix: str = "") -> list:
+        self._rpc("list_blobs")
+        with self._lock:
+            names = sorted(name for object_bucket, name in self.objects if object_bucket == bucket and name.startswith(prefix))
+            return [FakeBlob(self, bucket, name, self.objects[(bucket, name)][1]) for name in names]
+
+
+class FakeBlob:
+    def __init__(self, client: FakeStorage, bucket: str, name: str, content_type: str):
+        self._client = client
+        self.bucket = bucket
+        self.name = name
+        self.content_type = content_type
+
+    def download_as_bytes(self) -> bytes:
+        self._client._rpc("download")
+        with self._client._lock:
+            return self._client.objects[(self.bucket, self.name)][0]
+
+
+class FakeOperation:
+    """
+    Long-running operation that completes at `ready_at` (a `time.monotonic` value), with
+    the interface of `google.api_core.operation.Operation` the chunker uses.
+    """
+
+    def __init__(self, name: str, ready_at: float, metadata=None):
+        self.operation = SimpleNamespace(name=name)
+        self.metadata = metadata
+        self.ready_at = ready_at
+
+    def done(self) -> bool:
+        return time.monotonic() >= self.ready_at
+
+    def result(self, timeout: float = None):
+        remaining = self.ready_at - time.monotonic()
+        if timeout is not None and remaining > timeout:
+            time.sleep(timeout)
+            raise TimeoutError(f"Operation {self.operation.name} did not complete within {timeout}s")
+        if remaining > 0:
+            time.sleep(remaining)
+        return self.metadata
+
+
+class FakeDocumentAI:
+    """
+    Stand-in for `DocumentProcessorServiceClient`. A batch process operation writes the
+    Document AI output of every input document into `storage` (a synthetic document of
+    `pages` pages, in shards of `pages_per_shard` pages) and completes `latency +
+    per_page_latency * pages` seconds after it was submitted. Every request is counted in
+    `calls` and fails with `ResourceExhausted` with probability `quota_error_rate`.
+    """
+
+    def __init__(
+        self,
+        storage: FakeStorage,
+        pages: int = 10,
+        pages_per_shard: int = 10,
+        latency: float = 0.0,
+        per_page_latency: float = 0.0,
+        quota_error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self.storage = storage
+        self.pages = pages
+        self.latency = latency
+        self.per_page_latency = per_page_latency
+        self.quota_error_rate = quota_error_rate
+        self.calls = Counter()
+        self.processors = []
+        self.state = documentai.Processor.State.DISABLED
+        self.operations = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+        # Every input document gets the same output, serialized once
+        self._shards = []
+        shard_count = -(-pages // pages_per_shard)
+        text_offset = 0
+        for index in range(shard_count):
+            shard_pages = min(pages_per_shard, pages - index * pages_per_shard)
+            document = synthetic_document(
+                pages=shard_pages, seed=seed + index, first_page=index * pages_per_shard + 1, text_offset=text_offset
+            )
+            document.shard_info.shard_index = index
+            document.shard_info.shard_count = shard_count
+            text_offset += len(document.text)
+            self._shards.append(documentai.Document.to_json(document).encode())
+
+    def _request(self, name: str) -> None:
+        with self._lock:
+            self.calls[name] += 1
+            quota_error = self._random.random() < self.quota_error_rate
+        if quota_error:
+            with self._lock:
+                self.calls["quota_errors"] += 1
+            raise ResourceExhausted("Quota exceeded for documentai.googleapis.com/concurrent_batch_process_requests")
+
+    @staticmethod
+    def common_location_path(project: str, location: str) -> str:
+        return f"projects/{project}/locations/{location}"
+
+    def processor_path(self, project: str, location: str, processor: str) -> str:
+        return f"{self.common_location_path(project, location)}/processors/{processor}"
+
+    def processor_version_path(self, project: str, location: str, processor: str, processor_version: str) -> str:
+        return f"{self.processor_path(project, location, processor)}/processorVersions/{processor_version}"
+
+    def list_processors(self, parent: str) -> list:
+        self._request("list_processors")
+        return [processor for processor in self.processors if processor.name.startswith(parent + "/")]
+
+    def create_processor(self, parent: str, processor: documentai.Processor) -> documentai.Processor:
+        self._request("create_processor")
+        created = documentai.Processor(name=f"{parent}/processors/{uuid.uuid4().hex[:16]}", display_name=processor.display_name, type_=processor.type_)
+        self.processors.append(created)
+        return created
+
+    def get_processor(self, name: str) -> documentai.Processor:
+        self._request("get_processor")
+        return documentai.Processor(name=name, state=self.state)
+
+    def enable_processor(self, request: documentai.EnableProcessorRequest) -> FakeOperation:
+        self._request("enable_processor")
+        if self.state == documentai.Processor.State.ENABLED:
+            raise FailedPrecondition("Processor is already enabled")
+        self.state = documentai.Processor.State.ENABLED
+        return FakeOperation(f"{request.name}/operations/enable", time.monotonic())
+
+    def disable_processor(self, request: documentai.DisableProcessorRequest) -> FakeOperation:
+        self._request("disable_processor")
+        if self.state == documentai.Processor.State.DISABLED:
+            raise FailedPrecondition("Processor is already disabled")
+        self.state = documentai.Processor.State.DISABLED
+        return FakeOperation(f"{request.name}/operations/disable", time.monotonic())
+
+    def batch_process_documents(self, request: documentai.BatchProcessRequest) -> FakeOperation:
+        self._request("batch_process_documents")
+        if self.state != documentai.Processor.State.ENABLED:
+            raise FailedPrecondition(f"Processor {request.name} is not enabled")
+
+        operation_id = uuid.uuid4().hex[:16]
+        bucket, _, prefix = request.document_output_config.gcs_output_config.gcs_uri[len("gs://"):].partition("/")
+        statuses = []
+        for index, gcs_document in enumerate(request.input_documents.gcs_documents.documents):
+            output_prefix = f"{prefix}{operation_id}/{index}/"
+            stem = gcs_document.gcs_uri.rsplit("/", 1)[-1].rsplit(".", 1)[0]
+            for shard_index, data in enumerate(self._shards):
+                self.storage.upload(bucket, f"{output_prefix}{stem}-{shard_index}.json", data)
+            statuses.append(
+                documentai.BatchProcessMetadata.IndividualProcessStatus(
+                    input_gcs_source=gcs_document.gcs_uri,
+                    output_gcs_destination=f"gs://{bucket}/{output_prefix}",
+                    status={"code": 0},
+                )
+            )
+
+        metadata = documentai.BatchProcessMetadata(state=documentai.BatchProcessMetadata.State.SUCCEEDED, individual_process_statuses=statuses)
+        ready_at = time.monotonic() + self.latency + self.per_page_latency * self.pages * len(statuses)
+        operation = FakeOperation(f"{request.name.split('/processors/')[0]}/operations/{operation_id}", ready_at, metadata)
+        with self._lock:
+            self.operations[operation.operation.name] = operation
+        return operation
+
+    def get_operation(self, request: dict) -> operations_pb2.Operation:
+        self._request("get_operation")
+        operation = self.operations[request["name"]]
+        result = operations_pb2.Operation(name=request["name"], done=operation.done())
+        if result.done:
+            result.metadata.Pack(documentai.BatchProcessMetadata.pb(operation.metadata))
+        return result
+
+
+class StubSigner(Signing):
+    """
+    Signs bytes locally with a hash after `latency` seconds, like a call to the IAM
+    signBlob API would take. Signatures are counted in `calls` and fail with
+    `ResourceExhausted` with probability `quota_error_rate`.
+    """
+
+    def __init__(self, latency: float = 0.0, quota_error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.quota_error_rate = quota_error_rate
+        self.calls = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sign_bytes(self, message: bytes) -> bytes:
+        with self._lock:
+            self.calls["sign_blob"] += 1
+            quota_error = self._random.random() < self.quota_error_rate
+        time.sleep(self.latency)
+        if quota_error:
+            with self._lock:
+                self.calls["quota_errors"] += 1
+            raise ResourceExhausted("Quota exceeded for iamcredentials.googleapis.com/sign_blob_requests")
+        return hashlib.sha256(b"stub-key" + message).digest()
+
+    @property
+    def signer_email(self) -> str:
+        return "signer@bench.iam.gserviceaccount.com"
+
+    @property
+    def signer(self):
+        return self
+
+
+_WORDS = (
+    "agreement party shall term payment invoice service delivery notice liability "
+    "contract clause period obligation warranty supplier customer fee date product"
+).split()
+
+
+def synthetic_document(
+    pages: int = 10,
+    paragraphs_per_page: int = 30,
+    words_per_paragraph: int = 40,
+    segments_per_paragraph: int = 1,
+    seed: int = 0,
+    first_page: int = 1,
+    text_offset: int = 0,
+) -> documentai.Document:
+    """
+    Builds a Document AI OCR output with `pages` pages of `paragraphs_per_page`
+    paragraphs. Every page starts with a numbered heading, and each paragraph's text
+    anchor is split into `segments_per_paragraph` segments, like the lines of a
+    multi-column scan.
+
+    To build a shard of a larger document, pass the number of its first page and the
+    offset of its text in the document's text: like Document AI's, the text anchors then
+    index the text of the whole document.
+    """
+    rng = random.Random(seed)
+    text_parts = []
+    offset = text_offset
+    document_pages = []
+    for page_number in range(first_page, first_page + pages):
+        paragraphs = []
+        for idx in range(paragraphs_per_page):
+            if idx == 0:
+                paragraph_text = f"{page_number}. Section {page_number}\n"
+            else:
+                words = [rng.choice(_WORDS) for _ in range(words_per_paragraph)]
+                paragraph_text = " ".join(words).capitalize() + ".\n"
+
+            step = max(1, len(paragraph_text) // segments_per_paragraph)
+            segments = []
+            for start in range(0, len(paragraph_text), step):
+                end = min(len(paragraph_text), start + step)
+                segments.append(documentai.Document.TextAnchor.TextSegment(start_index=offset + start, end_index=offset + end))
+            text_parts.append(paragraph_text)
+            offset += len(paragraph_text)
+
+            layout = documentai.Document.Page.Layout(text_anchor=documentai.Document.TextAnchor(text_segments=segments))
+            paragraphs.append(documentai.Document.Page.Paragraph(layout=layout))
+
+        document_pages.append(
+            documentai.Document.Page(
+                page_number=page_number,
+                paragraphs=paragraphs,
+                blocks=[documentai.Document.Page.Block(layout=p.layout) for p in paragraphs],
+                detected_languages=[documentai.Document.Page.DetectedLanguage(language_code="en", confidence=0.99)],
+            )
+        )
+
+    document = documentai.Document(text="".join(text_parts), pages=document_pages)
+    document.shard_info.text_offset = text_offset
+    return document
@@ -0,0 +1,48 @@
+"""
+Compares one-RPC-per-paragraph Firestore writes against the chunker's BatchedWriter.
+
+    python benchmarks/firestore_writes.py --paragraphs 3000 --latency 0.02
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "chunker"))
+
+from fakes import FakeFirestore  # noqa: E402
+from firestore_writer import BatchedWriter  # noqa: E402
+
+
+def sequential(paragraphs: int, latency: float) -> tuple:
+    db = FakeFirestore(latency=latency)
+    doc_ref = db.collection("bench").document("contract.pdf")
+    started = time.monotonic()
+    for idx in range(paragraphs):
+        doc_ref.collection("paragraphs").document(f"1.{idx}").set({"text": "x" * 200, "indexed": False, "page": 1})
+    return time.monotonic() - started, sum(db.calls.values())
+
+
+def batched(paragraphs: int, latency: float, batch_size: int, max_in_flight: int) -> tuple:
+    db = FakeFirestore(latency=latency)
+    doc_ref = db.collection("bench").document("contract.pdf")
+    started = time.monotonic()
+    with BatchedWriter(db, batch_size=batch_size, max_in_flight=max_in_flight) as writer:
+        for idx in range(paragraphs):
+            writer.set(doc_ref.collection("paragraphs").document(f"1.{idx}"), {"text": "x" * 200, "indexed": False, "page": 1})
+    return time.monotonic() - started, sum(db.calls.values())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--paragraphs", type=int, default=3000)
+    parser.add_argument("--latency", type=float, default=0.02, help="Simulated seconds per Firestore RPC")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--max-in-flight", type=int, default=8)
+    args = parser.parse_args()
+
+    for name, (elapsed, rpcs) in (
+        ("sequential", sequential(args.paragraphs, args.latency)),
+        ("batched", batched(args.paragraphs, args.latency, args.batch_size, args.max_in_flight)),
+    ):
+        print(f"{name:>10}: {elapsed:7.2f}s  {rpcs:6d} RPCs  {args.paragraphs / elapsed:9.1f} writes/s")
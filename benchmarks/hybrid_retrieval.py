@@ -0,0 +1,192 @@
+"""
+Compares the retrieval quality and latency of the query function's vector search,
+keyword index and hybrid retriever (with the reranker, as by default, and with reciprocal
+rank fusion only, HYBRID_RERANK=false) on a synthetic contract corpus. Half of the questions name a contract by its number, which the
+embeddings blur; the other half paraphrase a clause with synonyms, which the keyword
+index cannot match.
+
+    python benchmarks/hybrid_retrieval.py --contracts 500 --queries 400 --k 3
+"""
+import argparse
+import os
+import random
+import re
+import statistics
+import sys
+import time
+import zlib
+from typing import List
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "query"))
+
+from langchain_core.documents import Document  # noqa: E402
+from langchain_core.vectorstores import VectorStore  # noqa: E402
+
+from fakes import FakeFirestore  # noqa: E402
+from hybrid_search import HybridRetriever, TermOverlapReranker  # noqa: E402
+from lexical_index import LexicalIndex  # noqa: E402
+from local_index import ExactSearch  # noqa: E402
+
+TOPICS = {
+    # topic: (words of the clause, synonyms a reader may use instead)
+    "payment": ("payment invoice due days", "remittance bill owed"),
+    "delivery": ("delivery shipment warehouse schedule", "dispatch consignment depot timetable"),
+    "warranty": ("warranty defect repair replacement", "guarantee fault fix substitute"),
+    "termination": ("termination notice breach", "cancellation warning violation"),
+    "liability": ("liability damages cap indemnity", "responsibility losses limit compensation"),
+}
+PRODUCTS = 200
+SYLLABLES = ["ka", "lo", "mi", "ter", "van", "sor", "bel", "dun", "ric", "ap", "om", "zel"]
+
+
+def pseudo_word(number: int) -> str:
+    word = ""
+    for _ in range(3):
+        number, syllable = divmod(number, len(SYLLABLES))
+        word += SYLLABLES[syllable]
+    return word
+
+
+class SemanticEmbeddings:
+    """
+    Stands in for an embedding model: a hashed bag of the words of a text, with synonyms
+    mapped to the same word. Like real models, it captures meaning but blurs numbers
+    and identifiers (tokens with digits are dropped).
+    """
+
+    def __init__(self, synonyms: dict, dimensions: int = 256):
+        self.synonyms = synonyms
+        self.dimensions = dimensions
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for word in re.findall(r"[a-z0-9-]+", text.lower()):
+            if any(character.isdigit() for character in word):
+                continue
+            vector[zlib.crc32(self.synonyms.get(word, word).encode()) % self.dimensions] += 1.0
+        return (vector / (np.linalg.norm(vector) or 1.0)).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+
+class EmbeddingStore(VectorStore):
+    """
+    In-memory vector store with the local index's exact Euclidean search; every search
+    sleeps for `latency` seconds like a BigQuery job would.
+    """
+
+    def __init__(self, documents: List[Document], embedding: SemanticEmbeddings, latency: float = 0.0):
+        self.documents = documents
+        self.embedding = embedding
+        self.latency = latency
+        self.search_index = ExactSearch(np.asarray(embedding.embed_documents([d.page_content for d in documents]), dtype=np.float32))
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError
+
+    def similarity_search(self, query: str, k: int = 4, filter: dict = None, **kwargs) -> List[Document]:
+        if self.latency:
+            time.sleep(self.latency)
+        indices, _ = self.search_index.search(np.asarray(self.embedding.embed_query(query), dtype=np.float32), k)
+        return [self.documents[i] for i in indices]
+
+
+def synthetic_corpus(contracts: int, seed: int = 0):
+    """
+    Returns the paragraphs of the contracts in the Firestore layout the chunker writes,
+    the synonym map of the embeddings, and the questions with the paragraph that answers them.
+    """
+    rng = random.Random(seed)
+    synonyms = {}
+    for words, alternatives in TOPICS.values():
+        synonyms.update(zip(alternatives.split(), words.split()))
+    products = [pseudo_word(i) for i in range(PRODUCTS)]
+    # Every product also has a synonym, e.g. a brand name and its generic name
+    synonyms.update((pseudo_word(i + PRODUCTS), products[i]) for i in range(PRODUCTS))
+
+    paragraphs, questions = [], []
+    for number in range(contracts):
+        contract_id = f"CN-{2020 + number % 5}-{number:04d}"
+        filename = f"contract_{number:04d}.pdf"
+        for page, (topic, (words, _)) in enumerate(TOPICS.items(), start=1):
+            items = rng.sample(range(len(products)), 3)
+            text = f"Contract {contract_id} {topic} clause: the {' '.join(products[i] for i in items)} are subject to {words}."
+            paragraphs.append((filename, f"{page}.0", {"text": text, "page": page, "indexed": True}))
+            key = (filename, text)
+            alternatives = TOPICS[topic][1]
+            questions.append(("identifier", f"What does contract {contract_id} say about {topic}?", key))
+            # Paraphrase with the synonyms of two of the products and of the clause, without the contract number
+            questions.append(("paraphrase", f"Which {' '.join(pseudo_word(i + PRODUCTS) for i in items[:2])} {alternatives}?", key))
+    rng.shuffle(questions)
+    return paragraphs, synonyms, questions
+
+
+def evaluate(retrieve, questions: list, k: int) -> dict:
+    ranks, latencies = {"identifier": [], "paraphrase": []}, []
+    for kind, question, key in questions:
+        started = time.perf_counter()
+        documents = retrieve(question)
+        latencies.append(time.perf_counter() - started)
+        keys = [(d.metadata.get("source"), d.page_content) for d in documents]
+        ranks[kind].append(keys.index(key) + 1 if key in keys else None)
+    latencies.sort()
+    result = {"p50": latencies[len(latencies) // 2], "p99": latencies[int(len(latencies) * 0.99) - 1]}
+    for kind, kind_ranks in ranks.items():
+        result[f"{kind} recall@1"] = statistics.mean(r is not None and r <= 1 for r in kind_ranks)
+        result[f"{kind} recall@{k}"] = statistics.mean(r is not None and r <= k for r in kind_ranks)
+        result[f"{kind} mrr"] = statistics.mean(1 / r if r else 0 for r in kind_ranks)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--contracts", type=int, default=500)
+    parser.add_argument("--queries", type=int, default=400)
+    parser.add_argument("--k", type=int, default=3, help="Documents passed to the LLM")
+    parser.add_argument("--candidates", type=int, default=20, help="Documents taken from each search before fusion")
+    parser.add_argument("--vector-latency", type=float, default=0.0, help="Seconds per vector search (BigQuery job)")
+    args = parser.parse_args()
+
+    paragraphs, synonyms, questions = synthetic_corpus(args.contracts)
+    questions = questions[: args.queries]
+
+    db = FakeFirestore()
+    for filename, paragraph_id, data in paragraphs:
+        db.collection("contracts").document(filename).collection("paragraphs").document(paragraph_id).set(data)
+    lexical_index = LexicalIndex(db)
+    started = time.perf_counter()
+    lexical_index.load()
+    print(f"keyword index of {len(paragraphs)} paragraphs built in {(time.perf_counter() - started) * 1000:.0f}ms")
+
+    documents = [
+        Document(page_content=data["text"], metadata={"collection": "contracts", "source": filename, "page": data["page"]})
+        for filename, _, data in paragraphs
+    ]
+    store = EmbeddingStore(documents, SemanticEmbeddings(synonyms), args.vector_latency)
+    fused = HybridRetriever(vectorstore=store, lexical_index=lexical_index, search_kwargs={"k": args.k}, candidates=args.candidates)
+    hybrid = fused.copy(update={"reranker": TermOverlapReranker(lexical_index)})
+
+    retrievers = {
+        "vector": lambda q: store.similarity_search(q, k=args.k),
+        "keyword": lambda q: [d for d, _ in lexical_index.search(q, k=args.k)],
+        "hybrid": hybrid.get_relevant_documents,
+        "hybrid-rrf": fused.get_relevant_documents,
+    }
+    for name, retrieve in retrievers.items():
+        result = evaluate(retrieve, questions, args.k)
+        print(
+            f"{name:>13}: "
+            + "  ".join(
+                f"{kind[:5]} r@1 {result[f'{kind} recall@1']:.2f} r@{args.k} {result[f'{kind} recall@{args.k}']:.2f} mrr {result[f'{kind} mrr']:.2f}"
+                for kind in ("identifier", "paraphrase")
+            )
+            + f"  p50 {result['p50'] * 1000:6.2f}ms  p99 {result['p99'] * 1000:6.2f}ms"
+        )
@@ -0,0 +1,142 @@
+"""
+Measures the end-to-end ingestion latency of a large document, from its first Document
+AI output shard to the file being "Indexed", with the chunker and indexer functions
+running against fakes:
+
+    sequential  the chunker writes every chunk, then the indexer indexes the whole document (workflow.yaml)
+    pipeline    the chunker publishes work items of --pages-per-item pages as it writes them, and
+                --workers indexer instances index them concurrently from an in-memory queue
+
+With --redelivery-rate, that fraction of the work items is delivered again after it was
+indexed (an acknowledgement lost by Pub/Sub); the benchmark checks that no paragraph is
+inserted twice.
+
+    python benchmarks/ingestion_pipeline.py --shards 10 --pages-per-shard 10 --workers 4
+"""
+import argparse
+import contextlib
+import importlib.util
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from fakes import FakeEmbeddings, FakeFirestore, FakeVectorStore, InMemoryPubSub, synthetic_document  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+OBJECT = "contracts/contract.pdf"
+# Modules both functions have a copy of
+SHARED_MODULES = ("clients", "work_items")
+
+
+def load_main(function: str):
+    """
+    Imports the main.py of a function with its own folder first on the path.
+    """
+    function_dir = os.path.join(ROOT, function)
+    for name in SHARED_MODULES:
+        sys.modules.pop(name, None)
+    sys.path.insert(0, function_dir)
+    try:
+        spec = importlib.util.spec_from_file_location(f"{function}_main", os.path.join(function_dir, "main.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(function_dir)
+    return module
+
+
+def shards(count: int, pages: int, latency: float):
+    """
+    Yields the Document AI output shards of a document of count * pages pages, each after
+    `latency` seconds (downloading and parsing it).
+    """
+    text_offset = 0
+    for index in range(count):
+        document = synthetic_document(pages=pages, seed=index, first_page=index * pages + 1, text_offset=text_offset)
+        document.shard_info.shard_index = index
+        document.shard_info.shard_count = count
+        text_offset += len(document.text)
+        time.sleep(latency)
+        yield document
+
+
+def run(mode: str, chunker, indexer, args) -> dict:
+    db = FakeFirestore(latency=args.firestore_latency)
+    embeddings = FakeEmbeddings(latency=args.embedding_latency, per_text_latency=args.per_text_latency)
+    store = FakeVectorStore(embeddings, latency=args.insert_latency)
+    for module in (chunker, indexer):
+        module.clients.reset()
+        module.clients.provide("db", db)
+    indexer.clients.provide("cached_embeddings", indexer.CachedEmbeddings(embeddings, "bench"))
+    indexer.clients.provide("store", store)
+
+    file_ref = db.collection(OBJECT.split("/")[0]).document(OBJECT.split("/")[-1])
+    rng = random.Random(0)
+
+    def deliver(event) -> None:
+        indexer.index_work_item(event)
+        if rng.random() < args.redelivery_rate:
+            raise RuntimeError("Acknowledgement lost")
+
+    queue = None
+    if mode == "pipeline":
+        queue = InMemoryPubSub(deliver, workers=args.workers)
+        chunker.clients.provide("publisher", queue)
+        chunker.PIPELINE_TOPIC = "projects/bench/topics/work-items"
+        chunker.PIPELINE_PAGES_PER_ITEM = args.pages_per_item
+    else:
+        chunker.PIPELINE_TOPIC = None
+
+    started = time.perf_counter()
+    chunker.extract_document(OBJECT, shards(args.shards, args.pages_per_shard, args.shard_latency))
+    chunked = time.perf_counter() - started
+    if queue:
+        queue.join()
+        if queue.errors:
+            raise queue.errors[0]
+    else:
+        indexer.indexer(SimpleNamespace(get_json=lambda silent=False: {"object": OBJECT}))
+    elapsed = time.perf_counter() - started
+
+    status = file_ref.get().to_dict()["status"]
+    sources = [text for _, text, _, _ in store.rows]
+    return {
+        "chunked": chunked,
+        "elapsed": elapsed,
+        "status": status,
+        "rows": len(sources),
+        "duplicates": len(sources) - len(set(sources)),
+        "deliveries": queue.calls["acked"] + queue.calls["nacked"] if queue else 0,
+        "items": queue.calls["published"] if queue else 0,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, default=10)
+    parser.add_argument("--pages-per-shard", type=int, default=10)
+    parser.add_argument("--pages-per-item", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=4, help="Indexer instances consuming the work items")
+    parser.add_argument("--shard-latency", type=float, default=0.5, help="Seconds to download and parse each shard")
+    parser.add_argument("--firestore-latency", type=float, default=0.01, help="Seconds per Firestore RPC")
+    parser.add_argument("--embedding-latency", type=float, default=0.2, help="Seconds per embedding request")
+    parser.add_argument("--per-text-latency", type=float, default=0.002, help="Additional seconds per embedded text")
+    parser.add_argument("--insert-latency", type=float, default=0.5, help="Seconds per BigQuery load job")
+    parser.add_argument("--redelivery-rate", type=float, default=0.1)
+    args = parser.parse_args()
+
+    chunker = load_main("chunker")
+    indexer = load_main("indexer")
+    for mode in ("sequential", "pipeline"):
+        # The functions log every chunk
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            result = run(mode, chunker, indexer, args)
+        print(
+            f"{mode:>10}: chunker {result['chunked']:6.2f}s  end to end {result['elapsed']:6.2f}s  "
+            f"status {result['status']}  {result['rows']} rows ({result['duplicates']} duplicates)  "
+            f"{result['items']} work items, {result['deliveries']} deliveries"
+        )
@@ -0,0 +1,141 @@
+"""
+LangChain stand-ins for the Vertex AI chat model and the BigQuery vector store, and a
+loader that imports the query function with them in place of the GCP clients.
+"""
+import importlib.util
+import os
+import sys
+import time
+from typing import Any, List, Optional
+from unittest import mock
+
+from langchain_community.chat_models.fake import FakeListChatModel
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessageChunk
+from langchain_core.outputs import ChatGenerationChunk
+from langchain_core.vectorstores import VectorStore
+
+from fakes import FakeEmbeddings, FakeFirestore
+
+QUERY_DIR = os.path.join(os.path.dirname(__file__), "..", "query")
+
+
+class FakeChatModel(FakeListChatModel):
+    """
+    `FakeListChatModel` that counts its calls, and takes `latency` seconds to produce the
+    first character of a response and `sleep` seconds for each of the following ones.
+    """
+
+    latency: float = 0.0
+    calls: int = 0
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs: Any) -> str:
+        self.calls += 1
+        response = super()._call(messages, stop=stop, run_manager=run_manager, **kwargs)
+        time.sleep(self.latency + (self.sleep or 0) * max(0, len(response) - 1))
+        return response
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs: Any):
+        self.calls += 1
+        response = self.responses[self.i]
+        self.i = (self.i + 1) % len(self.responses)
+        time.sleep(self.latency)
+        for i, character in enumerate(response):
+            if i and self.sleep:
+                time.sleep(self.sleep)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=character))
+
+    def get_num_tokens(self, text: str) -> int:
+        # The default tokenizer needs transformers; use the usual four characters per token estimate
+        return len(text) // 4 + 1
+
+
+class FakeRequest:
+    """
+    Stand-in for the Flask request passed to an HTTP function.
+    """
+
+    def __init__(self, json: dict, headers: dict = None, method: str = "POST"):
+        self._json = json
+        self.headers = headers or {}
+        self.method = method
+
+    def get_json(self, silent: bool = False) -> dict:
+        return self._json
+
+
+class FakeDocumentStore(VectorStore):
+    """
+    In-memory stand-in for `BigQueryVectorSearch`. Every search sleeps for `latency`
+    seconds and returns the `k` documents (matching the metadata `filter`) sharing the most
+    words with the query.
+    """
+
+    def __init__(self, documents: List[Document] = None, latency: float = 0.0, embedding=None):
+        self.documents = list(documents or [])
+        self.latency = latency
+        self.embedding = embedding
+        self.searches = 0
+
+    def add_texts(self, texts, metadatas: Optional[list] = None, **kwargs: Any) -> List[str]:
+        metadatas = metadatas or [{} for _ in texts]
+        start = len(self.documents)
+        self.documents.extend(Document(page_content=text, metadata=metadata) for text, metadata in zip(texts, metadatas))
+        return [str(i) for i in range(start, len(self.documents))]
+
+    def similarity_search(self, query: str, k: int = 4, filter: dict = None, **kwargs: Any) -> List[Document]:
+        self.searches += 1
+        if self.embedding is not None:
+            # BigQueryVectorSearch embeds the query before searching
+            self.embedding.embed_query(query)
+        if self.latency:
+            time.sleep(self.latency)
+        words = set(query.lower().split())
+        documents = [
+            document for document in self.documents
+            if all(document.metadata.get(field) == value for field, value in (filter or {}).items())
+        ]
+        ranked = sorted(documents, key=lambda document: -len(words & set(document.page_content.lower().split())))
+        return ranked[:k]
+
+    @classmethod
+    def from_texts(cls, texts, embedding=None, metadatas: Optional[list] = None, **kwargs: Any) -> "FakeDocumentStore":
+        store = cls(**kwargs)
+        store.add_texts(texts, metadatas)
+        return store
+
+
+def load_query_function(
+    chat_llm: FakeChatModel,
+    store: FakeDocumentStore,
+    embeddings=None,
+    db: FakeFirestore = None,
+    module_name: str = "query_main",
+):
+    """
+    Imports query/main.py with the Vertex AI, BigQuery and Firestore clients replaced by the given fakes.
+    """
+    query_dir = os.path.abspath(QUERY_DIR)
+    if query_dir not in sys.path:
+        sys.path.insert(0, query_dir)
+
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(query_dir, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    def vector_store(embedding=None, **kwargs):
+        # Search with whatever embeddings wrapper the function passes to the store
+        if embeddings is not None:
+            store.embedding = embedding
+        return store
+
+    with mock.patch("langchain_google_vertexai.VertexAIEmbeddings", return_value=embeddings or FakeEmbeddings()), mock.patch(
+        "google.cloud.firestore.Client", return_value=db or FakeFirestore()
+    ), mock.patch(
+        "langchain_google_vertexai.ChatVertexAI", return_value=chat_llm
+    ), mock.patch(
+        "scoped_search.ScopedBigQueryVectorSearch", side_effect=vector_store
+    ):
+        spec.loader.exec_module(module)
+        # The function creates its clients on first use; create them while the fakes are in place
+        module.clients.warm()
+    sys.modules[module_name] = module
+    return module
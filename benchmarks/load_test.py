@@ -0,0 +1,304 @@
+"""
+Load-tests the functions' entry points against the in-process fakes of every GCP service
+they call, with configurable latencies and quota errors, and reports for each stage and
+concurrency: throughput, p50/p95/p99 latency, failed requests, quota errors, API calls per
+request and the peak Python memory of the run (traced with tracemalloc, which slows
+allocation-heavy code down; --no-memory turns it off).
+
+    signed_url  generate_signed_url, with a stub signer in place of the IAM signBlob API
+    chunker     chunker: Document AI batch processing of a --pages page document, output shards
+                read from Cloud Storage, chunks written to Firestore
+    indexer     indexer: the paragraphs of one chunked document embedded and inserted into BigQuery
+    query       query: answer cache, vector search and Gemini, --questions distinct questions
+
+The requests of a run are sent by --concurrency threads to one instance of the function,
+like Cloud Functions (2nd gen) does with concurrency enabled. The modules are imported once;
+every run starts with fresh fakes, so the clients built on them are created by its first requests.
+
+--save writes the results as JSON; --baseline compares them with a saved run and exits
+with status 1 if the p95 latency, API calls per request or peak memory grew, or the
+throughput dropped, by more than --tolerance, or requests failed that did not before:
+
+    python benchmarks/load_test.py --requests 20 --concurrency 1 4 16 --save baseline.json
+    python benchmarks/load_test.py --requests 20 --concurrency 1 4 16 --baseline baseline.json
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from langchain_core.documents import Document  # noqa: E402
+
+from fakes import (  # noqa: E402
+    FakeDocumentAI,
+    FakeEmbeddings,
+    FakeFirestore,
+    FakeStorage,
+    FakeVectorStore,
+    StubSigner,
+    synthetic_document,
+)
+from ingestion_pipeline import load_main  # noqa: E402
+from langchain_fakes import FakeChatModel, FakeDocumentStore, FakeRequest, load_query_function  # noqa: E402
+from signed_urls import load_function  # noqa: E402
+
+STAGES = ("signed_url", "chunker", "indexer", "query")
+# Counted by the fakes, but not API calls
+NOT_CALLS = ("texts", "quota_errors", "instance_limit_errors")
+# Metrics compared with --baseline, and whether a higher value is worse
+METRICS = {"p95_ms": True, "throughput": False, "api_calls_per_request": True, "peak_mib": True}
+
+
+def api_calls(*counters) -> dict:
+    return {
+        "api_calls": sum(value for counter in counters for name, value in counter.items() if name not in NOT_CALLS),
+        "quota_errors": sum(counter.get("quota_errors", 0) for counter in counters),
+    }
+
+
+def signed_url_stage(functions: dict, args) -> Tuple[Callable, Callable]:
+    from google.cloud import storage
+
+    from signing import SigningCredentialsCache, SigningSession
+
+    function = functions["signed_url"]
+    signer = StubSigner(args.sign_latency, quota_error_rate=args.quota_error_rate)
+
+    def create_session() -> SigningSession:
+        signer.calls["refresh"] += 1
+        time.sleep(args.auth_latency)
+        return SigningSession(
+            storage.Client.create_anonymous_client(), signer, datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        )
+
+    function.sessions = SigningCredentialsCache(create_session)
+
+    def handle(i: int):
+        return function.generate_signed_url(FakeRequest({"collection_name": "loadtest", "object_name": f"document-{i}.pdf"}))
+
+    return handle, lambda: api_calls(signer.calls)
+
+
+def chunker_stage(functions: dict, args) -> Tuple[Callable, Callable]:
+    chunker = functions["chunker"]
+    db = FakeFirestore(latency=args.firestore_latency)
+    storage = FakeStorage(latency=args.storage_latency)
+    documentai = FakeDocumentAI(
+        storage,
+        pages=args.pages,
+        pages_per_shard=args.pages_per_shard,
+        latency=args.documentai_latency,
+        per_page_latency=args.per_page_latency,
+        quota_error_rate=args.quota_error_rate,
+    )
+    chunker.clients.reset()
+    chunker.clients.provide("db", db)
+    chunker.clients.provide("storage_client", storage)
+    chunker.clients.provide(f"documentai_{chunker.LOCATION}", documentai)
+    chunker.PIPELINE_TOPIC = None
+    os.environ.setdefault("OUTPUT_BUCKET_NAME", "loadtest-output")
+
+    def handle(i: int):
+        return chunker.chunker(FakeRequest({"bucket": "loadtest-input", "object": f"loadtest/document-{i}.pdf"}))
+
+    return handle, lambda: api_calls(db.calls, storage.calls, documentai.calls)
+
+
+def indexer_stage(functions: dict, args) -> Tuple[Callable, Callable]:
+    chunker, indexer = functions["chunker"], functions["indexer"]
+    # The documents to index are chunked beforehand, without latency
+    db = FakeFirestore()
+    chunker.clients.reset()
+    chunker.clients.provide("db", db)
+    chunker.PIPELINE_TOPIC = None
+    for i in range(args.requests):
+        chunker.extract_document(f"loadtest/document-{i}.pdf", iter([synthetic_document(pages=args.pages, seed=i)]))
+    db.latency = args.firestore_latency
+    db.calls.clear()
+
+    embeddings = FakeEmbeddings(latency=args.embedding_latency, quota_error_rate=args.quota_error_rate)
+    store = FakeVectorStore(embeddings, latency=args.insert_latency)
+    indexer.clients.reset()
+    indexer.clients.provide("db", db)
+    indexer.clients.provide("cached_embeddings", indexer.CachedEmbeddings(embeddings, "loadtest"))
+    indexer.clients.provide("store", store)
+
+    def handle(i: int):
+        return indexer.indexer(FakeRequest({"object": f"loadtest/document-{i}.pdf"}))
+
+    return handle, lambda: api_calls(db.calls, embeddings.calls, store.calls)
+
+
+def query_stage(functions: dict, args) -> Tuple[Callable, Callable]:
+    query = functions["query"]
+    db = FakeFirestore(latency=args.firestore_latency)
+    embeddings = FakeEmbeddings(latency=args.embedding_latency, quota_error_rate=args.quota_error_rate)
+    documents = [
+        Document(page_content=f"Clause {i}: payment is due within {i + 10} days of the invoice date.", metadata={"source": "contract.pdf", "page": i})
+        for i in range(args.questions)
+    ]
+    store = FakeDocumentStore(documents, latency=args.search_latency)
+    chat_llm = FakeChatModel(responses=["Payment is due within 30 days.\nSOURCES: contract.pdf"], latency=args.llm_latency)
+    query_embeddings = query.MemoizedQueryEmbeddings(embeddings)
+    # BigQueryVectorSearch embeds the question with the function's embeddings
+    store.embedding = query_embeddings
+    query.clients.reset()
+    query.clients.provide("db", db)
+    query.clients.provide("query_embeddings", query_embeddings)
+    query.clients.provide("store", store)
+    query.clients.provide("chat_llm", chat_llm)
+
+    def handle(i: int):
+        return query.query(FakeRequest({"query": f"What is the payment term of clause {i % args.questions}?"}))
+
+    return handle, lambda: api_calls(
+        db.calls, embeddings.calls, {"vector_search": store.searches, "llm": chat_llm.calls}
+    )
+
+
+STAGE_SETUPS = {"signed_url": signed_url_stage, "chunker": chunker_stage, "indexer": indexer_stage, "query": query_stage}
+
+
+def failed(response) -> bool:
+    # HTTP functions return (body, status, ...) tuples for errors
+    return isinstance(response, tuple) and len(response) > 1 and isinstance(response[1], int) and response[1] >= 400
+
+
+def percentile(values: list, p: int) -> float:
+    """
+    Nearest-rank percentile of sorted values.
+    """
+    return values[max(0, -(-len(values) * p // 100) - 1)]
+
+
+def run(stage: str, concurrency: int, functions: dict, args) -> dict:
+    handle, calls = STAGE_SETUPS[stage](functions, args)
+
+    def timed(i: int) -> Tuple[float, bool]:
+        started = time.perf_counter()
+        try:
+            ok = not failed(handle(i))
+        except Exception:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    if args.memory:
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, range(args.requests)))
+    elapsed = time.perf_counter() - started
+    peak = 0
+    if args.memory:
+        peak = tracemalloc.get_traced_memory()[1] - before
+        tracemalloc.stop()
+
+    latencies = sorted(latency for latency, _ in results)
+    counted = calls()
+    return {
+        "stage": stage,
+        "concurrency": concurrency,
+        "requests": len(results),
+        "errors": sum(not ok for _, ok in results),
+        "quota_errors": counted["quota_errors"],
+        "throughput": len(results) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "api_calls_per_request": counted["api_calls"] / len(results),
+        "peak_mib": peak / 2**20,
+    }
+
+
+def regressions(results: list, baseline: list, tolerance: float) -> list:
+    """
+    Lists the metrics of `results` worse than in `baseline` by more than `tolerance` (a fraction).
+    """
+    previous = {(result["stage"], result["concurrency"]): result for result in baseline}
+    found = []
+    for result in results:
+        before = previous.get((result["stage"], result["concurrency"]))
+        if before is None:
+            continue
+        name = f"{result['stage']} x{result['concurrency']}"
+        if result["errors"] and not before["errors"]:
+            found.append(f"{name}: {result['errors']} failed requests, none in the baseline")
+        for metric, higher_is_worse in METRICS.items():
+            if not before[metric]:
+                continue
+            change = result[metric] / before[metric] - 1
+            if (change if higher_is_worse else -change) > tolerance:
+                found.append(f"{name}: {metric} {before[metric]:.2f} -> {result[metric]:.2f} ({change:+.0%})")
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16], help="Concurrent requests to sweep")
+    parser.add_argument("--requests", type=int, default=20, help="Requests per stage and concurrency")
+    parser.add_argument("--pages", type=int, default=10, help="Pages per document")
+    parser.add_argument("--pages-per-shard", type=int, default=5, help="Pages per Document AI output shard")
+    parser.add_argument("--questions", type=int, default=10, help="Distinct questions sent to the query function")
+    parser.add_argument("--quota-error-rate", type=float, default=0.0, help="Fraction of Document AI, embedding and signBlob requests failing with ResourceExhausted")
+    parser.add_argument("--firestore-latency", type=float, default=0.005, help="Seconds per Firestore RPC")
+    parser.add_argument("--storage-latency", type=float, default=0.02, help="Seconds per Cloud Storage request")
+    parser.add_argument("--documentai-latency", type=float, default=0.5, help="Seconds per Document AI batch operation")
+    parser.add_argument("--per-page-latency", type=float, default=0.005, help="Additional seconds per processed page")
+    parser.add_argument("--embedding-latency", type=float, default=0.1, help="Seconds per embedding request")
+    parser.add_argument("--insert-latency", type=float, default=0.3, help="Seconds per BigQuery load job")
+    parser.add_argument("--search-latency", type=float, default=0.2, help="Seconds per vector search")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Seconds per Gemini call")
+    parser.add_argument("--sign-latency", type=float, default=0.02, help="Seconds per signBlob call")
+    parser.add_argument("--auth-latency", type=float, default=0.05, help="Seconds to refresh the signing credentials")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="Do not trace the peak memory")
+    parser.add_argument("--save", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare the results with this JSON file written by --save")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative regression against --baseline")
+    args = parser.parse_args()
+
+    # The functions log every request, chunk and URL
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        functions = {
+            "signed_url": load_function(),
+            "chunker": load_main("chunker"),
+            "indexer": load_main("indexer"),
+            "query": load_query_function(FakeChatModel(responses=["-"]), FakeDocumentStore()),
+        }
+
+    print(
+        f"{'stage':>10} {'conc':>4} {'reqs':>5} {'errors':>6} {'quota':>5} {'req/s':>8} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'calls/req':>9} {'peak MiB':>8}"
+    )
+    results = []
+    for stage in args.stages:
+        for concurrency in args.concurrency:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                result = run(stage, concurrency, functions, args)
+            results.append(result)
+            print(
+                f"{stage:>10} {concurrency:4d} {result['requests']:5d} {result['errors']:6d} {result['quota_errors']:5d} "
+                f"{result['throughput']:8.2f} {result['p50_ms']:8.1f} {result['p95_ms']:8.1f} {result['p99_ms']:8.1f} "
+                f"{result['api_calls_per_request']:9.1f} {result['peak_mib']:8.1f}"
+            )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if found else 0)
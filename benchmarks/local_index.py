@@ -0,0 +1,76 @@
+"""
+Measures the recall and latency of the query function's local vector index on
+synthetic clustered embeddings: exact NumPy search and IVF with several numbers of
+probed lists, plus the size and load time of the GCS snapshot format.
+
+    python benchmarks/local_index.py --rows 50000 --dimensions 768 --lists 256
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "query"))
+
+from local_index import ExactSearch, IVFSearch  # noqa: E402
+
+
+def synthetic_vectors(rows: int, dimensions: int, clusters: int, seed: int = 0) -> np.ndarray:
+    # Embeddings of a document corpus are clustered by topic rather than uniformly spread
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dimensions)).astype(np.float32)
+    members = rng.integers(0, clusters, rows)
+    return centers[members] + 0.6 * rng.normal(size=(rows, dimensions)).astype(np.float32)
+
+
+def measure(search, queries: np.ndarray, k: int, truth: list = None):
+    latencies, results = [], []
+    for query in queries:
+        started = time.perf_counter()
+        indices, _ = search.search(query, k)
+        latencies.append(time.perf_counter() - started)
+        results.append(set(indices.tolist()))
+    recall = statistics.mean(len(r & t) / len(t) for r, t in zip(results, truth)) if truth else 1.0
+    return results, recall, sorted(latencies)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--dimensions", type=int, default=768)
+    parser.add_argument("--clusters", type=int, default=100, help="Topics in the synthetic corpus")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--lists", type=int, default=256, help="IVF lists")
+    args = parser.parse_args()
+
+    vectors = synthetic_vectors(args.rows + args.queries, args.dimensions, args.clusters)
+    vectors, queries = vectors[: args.rows], vectors[args.rows :]
+
+    started = time.perf_counter()
+    exact = ExactSearch(vectors)
+    print(f"exact index built in {time.perf_counter() - started:.2f}s")
+    truth, _, latencies = measure(exact, queries, args.k)
+    print(f"{'exact':>14}: recall@{args.k} 1.000  p50 {latencies[len(latencies) // 2] * 1000:7.2f}ms  p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:7.2f}ms")
+
+    started = time.perf_counter()
+    ivf = IVFSearch(vectors, args.lists)
+    print(f"IVF index with {args.lists} lists built in {time.perf_counter() - started:.2f}s")
+    for probes in (1, 2, 4, 8, 16, 32):
+        ivf.probes = probes
+        _, recall, latencies = measure(ivf, queries, args.k, truth)
+        print(f"{f'ivf probes={probes}':>14}: recall@{args.k} {recall:.3f}  p50 {latencies[len(latencies) // 2] * 1000:7.2f}ms  p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:7.2f}ms")
+
+    # Snapshot in the format written to GCS
+    buffer = io.BytesIO()
+    started = time.perf_counter()
+    np.savez_compressed(buffer, vectors=vectors, generation=np.array(1))
+    saved = time.perf_counter() - started
+    started = time.perf_counter()
+    with np.load(io.BytesIO(buffer.getvalue())) as snapshot:
+        ExactSearch(snapshot["vectors"])
+    print(f"snapshot: {len(buffer.getvalue()) / 2**20:.1f} MiB ({vectors.nbytes / 2**20:.1f} MiB in memory), saved in {saved:.2f}s, loaded in {time.perf_counter() - started:.2f}s")
@@ -0,0 +1,72 @@
+"""
+Measures the per-request latency of the query function's chain when it is rebuilt on
+every request with global debug logging (the previous behaviour) against the chain
+built once at cold start, with a fake chat model and vector store.
+
+    python benchmarks/query_chain.py --requests 200 --llm-latency 0.0
+"""
+import argparse
+import contextlib
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from langchain.globals import set_debug, set_verbose  # noqa: E402
+from langchain_core.documents import Document  # noqa: E402
+
+from langchain_fakes import FakeChatModel, FakeDocumentStore, load_query_function  # noqa: E402
+
+
+def percentile(values: list, p: float) -> float:
+    return statistics.quantiles(values, n=100)[int(p) - 1] if len(values) > 1 else values[0]
+
+
+def run(requests: int, handle) -> list:
+    latencies = []
+    # Debug output goes to stdout; discard it so the terminal does not dominate the timings
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for i in range(requests):
+            started = time.perf_counter()
+            handle(f"What is the payment term of clause {i % 20}?")
+            latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Simulated seconds per chat model call")
+    parser.add_argument("--search-latency", type=float, default=0.0, help="Simulated seconds per vector search")
+    args = parser.parse_args()
+
+    documents = [
+        Document(page_content=f"Clause {i}: payment is due within {i + 10} days of the invoice date.", metadata={"source": "contract.pdf", "page": i})
+        for i in range(20)
+    ]
+    chat_llm = FakeChatModel(responses=["Payment is due within 30 days.\nSOURCES: contract.pdf"], latency=args.llm_latency)
+    store = FakeDocumentStore(documents, latency=args.search_latency)
+    query_main = load_query_function(chat_llm, store)
+
+    def per_request(question: str) -> dict:
+        set_debug(True)
+        set_verbose(True)
+        retriever = store.as_retriever(search_kwargs={"k": 1}, return_source_documents=True)
+        return query_main.build_chain(chat_llm, retriever)({"question": question})
+
+    def prebuilt(question: str) -> dict:
+        return query_main.chatbot()({"question": question})
+
+    results = {}
+    for name, handle in (("rebuilt + debug", per_request), ("built once", prebuilt)):
+        results[name] = run(args.requests, handle)
+        set_debug(False)
+        set_verbose(False)
+
+    for name, latencies in results.items():
+        print(
+            f"{name:>16}: p50 {percentile(latencies, 50) * 1000:7.2f}ms  "
+            f"p99 {percentile(latencies, 99) * 1000:7.2f}ms  mean {statistics.mean(latencies) * 1000:7.2f}ms"
+        )
@@ -0,0 +1,72 @@
+"""
+Measures the time to first byte, time to the first answer token and total time of the
+query function's JSON and streaming (server-sent events) replies, with a fake chat
+model that generates the answer one character at a time.
+
+    python benchmarks/query_streaming.py --requests 20 --llm-latency 0.5 --token-latency 0.01
+"""
+import argparse
+import contextlib
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from flask import Flask  # noqa: E402
+from langchain_core.documents import Document  # noqa: E402
+
+from langchain_fakes import FakeChatModel, FakeDocumentStore, FakeRequest, load_query_function  # noqa: E402
+
+ANSWER = "Payment is due within 30 days of the invoice date, unless the parties agreed otherwise in writing.\nSOURCES: contract.pdf"
+
+
+def json_reply(query_main, question: str) -> dict:
+    started = time.perf_counter()
+    query_main.query(FakeRequest({"query": question}))
+    elapsed = time.perf_counter() - started
+    # The whole body is sent at once
+    return {"first byte": elapsed, "first token": elapsed, "total": elapsed}
+
+
+def streamed_reply(query_main, question: str) -> dict:
+    started = time.perf_counter()
+    timings = {}
+    # Streamed responses need a Flask request context, as within the functions framework
+    with Flask(__name__).test_request_context():
+        response = query_main.query(FakeRequest({"query": question, "stream": True}))
+        for part in response.response:
+            now = time.perf_counter() - started
+            timings.setdefault("first byte", now)
+            if part.startswith("event: token"):
+                timings.setdefault("first token", now)
+    timings["total"] = time.perf_counter() - started
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Simulated seconds to the first generated character")
+    parser.add_argument("--token-latency", type=float, default=0.01, help="Simulated seconds per following character")
+    parser.add_argument("--search-latency", type=float, default=0.3, help="Simulated seconds per vector search")
+    args = parser.parse_args()
+
+    # Every request is a different question, so the answer cache is not involved
+    os.environ["ANSWER_CACHE_SIZE"] = "0"
+    documents = [
+        Document(page_content=f"Clause {i}: payment is due within {i + 10} days.", metadata={"source": "contract.pdf", "page": i})
+        for i in range(20)
+    ]
+    chat_llm = FakeChatModel(responses=[ANSWER], latency=args.llm_latency, sleep=args.token_latency)
+    store = FakeDocumentStore(documents, latency=args.search_latency)
+    query_main = load_query_function(chat_llm, store)
+
+    for name, reply in (("json", json_reply), ("streaming", streamed_reply)):
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            results = [reply(query_main, f"What is the payment term of clause {i}?") for i in range(args.requests)]
+        print(
+            f"{name:>10}: "
+            + "  ".join(f"{metric} {statistics.median(r[metric] for r in results) * 1000:7.1f}ms" for metric in ("first byte", "first token", "total"))
+        )
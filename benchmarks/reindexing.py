@@ -0,0 +1,174 @@
+"""
+Measures the cost of indexing a new version of a document that was already indexed, with
+the chunker and indexer functions running against fakes. The document (--shards *
+--pages-per-shard pages) is indexed once, then a few of its paragraphs are edited
+(--changes changed, --deletions deleted and --insertions inserted, on random pages):
+
+    full          the new version is extracted as if the file were new, which is what the
+                  chunker used to do: every chunk is embedded and inserted again, and the
+                  rows of the previous version stay in the table
+    incremental   only the chunks that changed are embedded and inserted; the rows the new
+                  version no longer has are tombstoned, then deleted by compact_vectors
+
+Both re-extractions use a fresh embedding cache, like a new indexer instance would
+without the Firestore tier.
+
+    python benchmarks/reindexing.py --shards 20 --pages-per-shard 25 --changes 10
+"""
+import argparse
+import contextlib
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from fakes import FakeEmbeddings, FakeFirestore, FakeVectorStore, _WORDS  # noqa: E402
+from google.cloud import documentai  # type: ignore  # noqa: E402
+from ingestion_pipeline import OBJECT, load_main, shards  # noqa: E402
+
+
+def edit(document: documentai.Document, edits: dict, rng: random.Random, text_offset: int) -> documentai.Document:
+    """
+    Returns a copy of a synthetic shard with the paragraph edits of its pages applied:
+    `edits` maps a page number to "change", "delete" or "insert". The edited shard's text
+    starts at `text_offset` in the text of the edited document.
+    """
+    text_parts = []
+    offset = text_offset
+    pages = []
+    start = document.shard_info.text_offset
+    for page in document.pages:
+        texts = [
+            "".join(
+                document.text[segment.start_index - start : segment.end_index - start]
+                for segment in paragraph.layout.text_anchor.text_segments
+            )
+            for paragraph in page.paragraphs
+        ]
+        # The first paragraph of every page is its heading
+        idx = rng.randrange(1, len(texts))
+        operation = edits.get(page.page_number)
+        if operation == "change":
+            words = texts[idx].split(" ")
+            words[rng.randrange(len(words))] = rng.choice(_WORDS)
+            texts[idx] = " ".join(words)
+        elif operation == "delete":
+            del texts[idx]
+        elif operation == "insert":
+            texts.insert(idx, " ".join(rng.choice(_WORDS) for _ in range(40)).capitalize() + ".\n")
+
+        paragraphs = []
+        for text in texts:
+            segment = documentai.Document.TextAnchor.TextSegment(start_index=offset, end_index=offset + len(text))
+            layout = documentai.Document.Page.Layout(text_anchor=documentai.Document.TextAnchor(text_segments=[segment]))
+            paragraphs.append(documentai.Document.Page.Paragraph(layout=layout))
+            text_parts.append(text)
+            offset += len(text)
+        pages.append(
+            documentai.Document.Page(
+                page_number=page.page_number,
+                paragraphs=paragraphs,
+                blocks=[documentai.Document.Page.Block(layout=p.layout) for p in paragraphs],
+                detected_languages=page.detected_languages,
+            )
+        )
+    edited = documentai.Document(text="".join(text_parts), pages=pages, shard_info=document.shard_info)
+    edited.shard_info.text_offset = text_offset
+    return edited
+
+
+def edited_shards(args, edits: dict, rng: random.Random):
+    """
+    Yields the shards of the document with the paragraph edits applied.
+    """
+    text_offset = 0
+    for document in shards(args.shards, args.pages_per_shard, 0):
+        document = edit(document, edits, rng, text_offset)
+        text_offset += len(document.text)
+        yield document
+
+
+def index(chunker, indexer, documents, embeddings: FakeEmbeddings) -> tuple:
+    """
+    Extracts and indexes a version of the document. Returns the seconds spent by the chunker and the indexer.
+    """
+    indexer.clients.provide("cached_embeddings", indexer.CachedEmbeddings(embeddings, "bench"))
+    started = time.perf_counter()
+    chunker.extract_document(OBJECT, documents)
+    chunked = time.perf_counter()
+    indexer.indexer(SimpleNamespace(get_json=lambda silent=False: {"object": OBJECT}))
+    return chunked - started, time.perf_counter() - chunked
+
+
+def run(mode: str, chunker, indexer, args) -> dict:
+    db = FakeFirestore(latency=args.firestore_latency)
+    embeddings = FakeEmbeddings(latency=args.embedding_latency, per_text_latency=args.per_text_latency)
+    store = FakeVectorStore(embeddings, latency=args.insert_latency)
+    for module in (chunker, indexer):
+        module.clients.reset()
+        module.clients.provide("db", db)
+    indexer.clients.provide("store", store)
+    chunker.PIPELINE_TOPIC = None
+
+    index(chunker, indexer, shards(args.shards, args.pages_per_shard, 0), embeddings)
+
+    rng = random.Random(args.seed)
+    pages = rng.sample(range(1, args.shards * args.pages_per_shard + 1), args.changes + args.deletions + args.insertions)
+    operations = ["change"] * args.changes + ["delete"] * args.deletions + ["insert"] * args.insertions
+    edits = dict(zip(pages, operations))
+    file_ref = db.collection(OBJECT.split("/")[0]).document(OBJECT.split("/")[-1])
+    if mode == "full":
+        for snapshot in file_ref.collection("paragraphs").stream():
+            snapshot.reference._apply_delete()
+
+    texts = embeddings.calls["texts"]
+    inserted = len(store.rows)
+    chunked, indexed = index(chunker, indexer, edited_shards(args, edits, rng), embeddings)
+
+    live = store.live_rows()
+    chunks = sum(1 for _ in file_ref.collection("paragraphs").stream())
+    sources = [text for _, text, _, _ in live]
+    result = {
+        "chunked": chunked,
+        "indexed": indexed,
+        "status": file_ref.get().to_dict()["status"],
+        "chunks": chunks,
+        "embedded": embeddings.calls["texts"] - texts,
+        "inserted": len(store.rows) - inserted,
+        "tombstoned": len(store.tombstones),
+        "live": len(live),
+        "duplicates": len(sources) - len(set(sources)),
+    }
+    result["compacted"], _ = indexer.compact_vectors(SimpleNamespace(get_json=lambda silent=False: {}))
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, default=20)
+    parser.add_argument("--pages-per-shard", type=int, default=25)
+    parser.add_argument("--changes", type=int, default=10, help="Paragraphs changed")
+    parser.add_argument("--deletions", type=int, default=3, help="Paragraphs deleted")
+    parser.add_argument("--insertions", type=int, default=3, help="Paragraphs inserted")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--firestore-latency", type=float, default=0.0, help="Seconds per Firestore RPC")
+    parser.add_argument("--embedding-latency", type=float, default=0.02, help="Seconds per embedding request")
+    parser.add_argument("--per-text-latency", type=float, default=0.0005, help="Additional seconds per embedded text")
+    parser.add_argument("--insert-latency", type=float, default=0.2, help="Seconds per BigQuery load job")
+    args = parser.parse_args()
+
+    chunker = load_main("chunker")
+    indexer = load_main("indexer")
+    for mode in ("full", "incremental"):
+        # The functions log every chunk
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            result = run(mode, chunker, indexer, args)
+        print(
+            f"{mode:>11}: chunker {result['chunked']:5.2f}s  indexer {result['indexed']:5.2f}s  status {result['status']}  {result['chunks']} chunks  "
+            f"{result['embedded']} texts embedded  {result['inserted']} rows inserted  "
+            f"{result['tombstoned']} tombstoned  {result['live']} live rows ({result['duplicates']} duplicates)  "
+            f"compact_vectors: {result['compacted']}"
+        )
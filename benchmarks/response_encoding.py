@@ -0,0 +1,65 @@
+"""
+Compares the size and encode/decode time of the query function's reply serialised with
+jsonpickle (the previous format, embedding the LangChain Document objects) and with the
+response schema, with and without the source texts.
+
+    python benchmarks/response_encoding.py --documents 4 --words 300 --iterations 2000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import jsonpickle
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "query"))
+
+from langchain_core.documents import Document  # noqa: E402
+
+from response import encode, from_answer, parse_fields, to_dict  # noqa: E402
+
+
+def timed(function, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - started) / iterations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=4, help="Source documents in the reply")
+    parser.add_argument("--words", type=int, default=300, help="Words per source document")
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    text = " ".join(["the supplier shall deliver the products on the agreed date"] * (args.words // 10))
+    answer = {
+        "question": "What is the payment term?",
+        "filter": {},
+        "answer": "Payment is due within 30 days of the invoice date.\n",
+        "sources": "contract.pdf",
+        "source_documents": [
+            Document(
+                page_content=f"Clause {i}: {text}",
+                metadata={"collection": "contracts", "source": "contract.pdf", "page": i, "__id": f"{i:032x}", "__job_id": "job", "__distance": 0.1 * i},
+            )
+            for i in range(args.documents)
+        ],
+        "llm_calls": 1,
+    }
+
+    encoders = {
+        "jsonpickle": (lambda: jsonpickle.encode(answer).encode("utf-8"), jsonpickle.decode),
+        "schema": (lambda: encode(to_dict(from_answer(answer))), json.loads),
+        "schema, no text": (
+            lambda: encode(to_dict(from_answer(answer), *parse_fields(["question", "answer", "sources.source", "sources.page", "sources.score"]))),
+            json.loads,
+        ),
+    }
+    for name, (encoder, decoder) in encoders.items():
+        body = encoder()
+        encode_time = timed(encoder, args.iterations)
+        decode_time = timed(lambda: decoder(body), args.iterations)
+        print(f"{name:>16}: {len(body):7d} bytes  encode {encode_time * 1e6:8.1f}us  decode {decode_time * 1e6:8.1f}us")
@@ -0,0 +1,90 @@
+"""
+Measures the throughput of the presigned-URL function in URLs per second, with a local
+signer stub in place of the IAM signBlob API (--sign-latency seconds per signature) and
+of the credential refresh (--refresh-latency seconds):
+
+    per-call    one call per file, refreshing the credentials every time (how the function used to work)
+    cached      one call per file, with the cached signing credentials
+    batch       generate_signed_urls with --batch-size files per call
+
+Every call of the function also costs --request-latency seconds of round trip.
+
+    python benchmarks/signed_urls.py --files 500 --batch-size 100 --sign-latency 0.02
+"""
+import argparse
+import contextlib
+import datetime
+import importlib.util
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+from google.cloud import storage
+
+FUNCTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "presigned-url")
+sys.path.insert(0, FUNCTION_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import StubSigner  # noqa: E402
+from signing import SigningCredentialsCache, SigningSession  # noqa: E402
+
+
+def load_function():
+    # The folder name is not a valid module name
+    spec = importlib.util.spec_from_file_location("presigned_url_main", os.path.join(FUNCTION_DIR, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def request(body: dict, latency: float):
+    time.sleep(latency)
+    return SimpleNamespace(method="POST", get_json=lambda silent=False: body, headers={})
+
+
+def run(mode: str, function, args) -> tuple:
+    def create_session() -> SigningSession:
+        time.sleep(args.refresh_latency)
+        return SigningSession(
+            storage.Client.create_anonymous_client(),
+            StubSigner(args.sign_latency),
+            datetime.datetime.utcnow() + datetime.timedelta(hours=1),
+        )
+
+    function.sessions = SigningCredentialsCache(create_session)
+    names = [f"file_{i:05d}.pdf" for i in range(args.files)]
+    urls = 0
+    started = time.perf_counter()
+    if mode == "batch":
+        for i in range(0, len(names), args.batch_size):
+            body = {"collection_name": "bench", "objects": names[i : i + args.batch_size]}
+            reply, status, _ = function.generate_signed_urls(request(body, args.request_latency))
+            assert status == 200, reply
+            urls += len(json.loads(reply)["urls"])
+    else:
+        for name in names:
+            if mode == "per-call":
+                function.sessions.invalidate()
+            function.generate_signed_url(request({"collection_name": "bench", "object_name": name}, args.request_latency))
+            urls += 1
+    elapsed = time.perf_counter() - started
+    return elapsed, urls, function.sessions.refreshes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--sign-latency", type=float, default=0.02, help="Seconds per signBlob call")
+    parser.add_argument("--refresh-latency", type=float, default=0.05, help="Seconds to refresh the credentials")
+    parser.add_argument("--request-latency", type=float, default=0.03, help="Seconds of round trip per function call")
+    args = parser.parse_args()
+
+    function = load_function()
+    for mode in ("per-call", "cached", "batch"):
+        # The single-URL function logs every URL
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            elapsed, urls, refreshes = run(mode, function, args)
+        print(f"{mode:>9}: {elapsed:7.2f}s  {urls / elapsed:8.1f} URLs/s  {refreshes:4d} credential refreshes")
@@ -0,0 +1,82 @@
+"""
+Compares building paragraph texts by joining every text segment slice (the former
+layout_to_text) against the chunker's OffsetIndex, which keeps start/end offsets in
+arrays and slices the shared text lazily, on a large synthetic Document AI output.
+Also checks the offsets the index reports for a second shard, whose text starts after
+the first shard's in the text of the document.
+
+    python benchmarks/text_offsets.py --pages 300 --segments-per-paragraph 12
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "chunker"))
+
+from fakes import synthetic_document  # noqa: E402
+from offsets import OffsetIndex  # noqa: E402
+
+
+def joined_paragraphs(document) -> list:
+    text = document.text
+    # Text anchors index the text of the whole document
+    offset = int(document.shard_info.text_offset)
+    return [
+        "".join(
+            text[int(segment.start_index) - offset : int(segment.end_index) - offset]
+            for segment in paragraph.layout.text_anchor.text_segments
+        )
+        for page in document.pages
+        for paragraph in page.paragraphs
+    ]
+
+
+def measure(func, *args) -> tuple:
+    tracemalloc.start()
+    started = time.monotonic()
+    result = func(*args)
+    elapsed = time.monotonic() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--paragraphs-per-page", type=int, default=30)
+    parser.add_argument("--segments-per-paragraph", type=int, default=12)
+    args = parser.parse_args()
+
+    document = synthetic_document(args.pages, args.paragraphs_per_page, segments_per_paragraph=args.segments_per_paragraph)
+    print(f"Document: {len(document.pages)} pages, {len(document.text)} characters")
+
+    paragraphs, elapsed, peak = measure(joined_paragraphs, document)
+    size = sum(sys.getsizeof(paragraph) for paragraph in paragraphs)
+    print(f"  joined slices: {elapsed:6.2f}s  peak {peak / 2**20:7.2f} MiB  {len(paragraphs)} strings holding {size / 2**20:6.2f} MiB")
+
+    index, elapsed, peak = measure(OffsetIndex.from_document, document)
+    print(f"   offset index: {elapsed:6.2f}s  peak {peak / 2**20:7.2f} MiB  {len(index)} spans in {index.nbytes() / 2**20:6.2f} MiB of arrays")
+
+    _, elapsed, peak = measure(lambda: sum(len(index.layout_text(i)) for i in range(len(index))))
+    print(f"  lazy slicing:  {elapsed:6.2f}s  peak {peak / 2**20:7.2f} MiB  (one paragraph materialised at a time)")
+
+    # The same pages as the next shard of a longer document
+    shard = synthetic_document(
+        args.pages,
+        args.paragraphs_per_page,
+        segments_per_paragraph=args.segments_per_paragraph,
+        first_page=args.pages + 1,
+        text_offset=len(document.text),
+    )
+    text = document.text + shard.text
+    index = OffsetIndex.from_document(shard)
+    expected = joined_paragraphs(shard)
+    mismatches = sum(
+        1
+        for layout in range(len(index))
+        if index.layout_text(layout) != expected[layout] or text[slice(*index.span(layout))] != expected[layout]
+    )
+    print(f"  second shard:  text_offset {index.text_offset}, {mismatches} of {len(index)} spans differ from the document text")
@@ -0,0 +1,86 @@
+"""
+Ingests a synthetic document through the chunker and indexer against fakes, in one
+trace, and reports where the time went (the per-stage summary the functions log for
+every request), along with the cost of the logging itself under each setting:
+
+    default   one summary record per request (TRACE_SAMPLE_RATE=0, VERBOSE_LOGGING=false)
+    sampled   every span logged (TRACE_SAMPLE_RATE=1)
+    verbose   every span and the text of every chunk logged (VERBOSE_LOGGING=true), like the chunker used to
+
+    python benchmarks/tracing_overhead.py --shards 4 --pages-per-shard 25
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from fakes import FakeEmbeddings, FakeFirestore, FakeVectorStore  # noqa: E402
+from ingestion_pipeline import OBJECT, load_main, shards  # noqa: E402
+
+SETTINGS = {
+    "default": {"TRACE_SAMPLE_RATE": 0.0, "VERBOSE_LOGGING": False},
+    "sampled": {"TRACE_SAMPLE_RATE": 1.0, "VERBOSE_LOGGING": False},
+    "verbose": {"TRACE_SAMPLE_RATE": 1.0, "VERBOSE_LOGGING": True},
+}
+
+
+def ingest(chunker, indexer, tracing, args) -> float:
+    db = FakeFirestore(latency=args.firestore_latency)
+    embeddings = FakeEmbeddings(latency=args.embedding_latency)
+    for module in (chunker, indexer):
+        module.clients.reset()
+        module.clients.provide("db", db)
+    indexer.clients.provide("cached_embeddings", indexer.CachedEmbeddings(embeddings, "bench"))
+    indexer.clients.provide("store", FakeVectorStore(embeddings, latency=args.insert_latency))
+    chunker.PIPELINE_TOPIC = None
+
+    collection_name, filename = OBJECT.split("/")
+    started = time.perf_counter()
+    with tracing.trace("ingestion", object=OBJECT):
+        chunker.extract_document(OBJECT, shards(args.shards, args.pages_per_shard, args.shard_latency))
+        indexer.index_paragraphs(db.collection(collection_name).document(filename), collection_name, filename)
+    return time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--pages-per-shard", type=int, default=25)
+    parser.add_argument("--shard-latency", type=float, default=0.1, help="Seconds to download and parse each shard")
+    parser.add_argument("--firestore-latency", type=float, default=0.01, help="Seconds per Firestore RPC")
+    parser.add_argument("--embedding-latency", type=float, default=0.1, help="Seconds per embedding request")
+    parser.add_argument("--insert-latency", type=float, default=0.3, help="Seconds per BigQuery load job")
+    args = parser.parse_args()
+
+    chunker = load_main("chunker")
+    indexer = load_main("indexer")
+    # Both functions were loaded with the same copy of tracing.py
+    import tracing
+
+    summary = None
+    for name, settings in SETTINGS.items():
+        for setting, value in settings.items():
+            setattr(tracing, setting, value)
+        records = []
+        tracing.export = lambda record: (records.append(record), tracing.export_json(record))
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            elapsed = ingest(chunker, indexer, tracing, args)
+        logged = output.getvalue()
+        print(
+            f"{name:>8}: {elapsed:6.2f}s  {len(logged.encode()) / 1024:8.1f} KiB logged  "
+            f"{len(logged.splitlines()):6d} lines  {len(records):5d} span records"
+        )
+        if name == "default":
+            summary = records[-1]
+    tracing.export = tracing.export_json
+
+    print(f"\nStages of the ingestion ({summary['duration_ms'] / 1000:.2f}s end to end; stages overlap and nest):")
+    for stage, totals in sorted(summary["stages"].items(), key=lambda item: -item[1]["duration_ms"]):
+        counters = {key: value for key, value in totals.items() if key not in ("spans", "duration_ms", "errors")}
+        print(f"{stage:>18}: {totals['spans']:4d} spans  {totals['duration_ms'] / 1000:7.2f}s  {json.dumps(counters)}")
@@ -0,0 +1,237 @@
+import math
+import re
+from typing import Callable, Iterable, Iterator, NamedTuple
+
+from google.cloud import documentai  # type: ignore
+
+from offsets import OffsetIndex
+
+MAX_TOKENS = 512
+OVERLAP_TOKENS = 50
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+(?=[\"'(\[]?[A-Z0-9])")
+_NUMBERED_HEADING = re.compile(r"^(\d+(\.\d+)*\.?|[IVXLC]+\.|[A-Z]\.)\s+\S")
+
+
+class Unit(NamedTuple):
+    """
+    The smallest piece of text a strategy works with (a paragraph, block or sentence).
+    """
+    text: str
+    page: int
+    heading: bool = False
+    start: int = 0  # Offsets in the text of the whole document
+    end: int = 0
+
+
+class Chunk(NamedTuple):
+    """
+    A piece of text that is stored in Firestore and indexed as one unit.
+    """
+    text: str
+    page: int
+    end_page: int
+    start: int  # Offsets in the text of the whole document
+    end: int
+
+
+class ChunkingStrategy(NamedTuple):
+    """
+    A strategy splits each page into units and combines the units of a document into chunks.
+    `layout` is the Document AI page element ("paragraphs", "blocks", ...) the units are built from.
+    """
+    units: Callable[[OffsetIndex, int], Iterator[Unit]]
+    combine: Callable[..., Iterator[Chunk]]
+    layout: str = "paragraphs"
+
+
+def count_tokens(text: str) -> int:
+    """
+    Estimates the number of tokens of a text (about four characters per token).
+    """
+    return math.ceil(len(text) / 4)
+
+
+def is_heading(text: str) -> bool:
+    """
+    Guesses whether a paragraph is a heading: a short single line without closing
+    punctuation that is numbered, title case or upper case.
+    """
+    stripped = text.strip()
+    if not stripped or len(stripped) > 80 or "\n" in stripped:
+        return False
+    if stripped.endswith((".", ",", ";", ":")) and not _NUMBERED_HEADING.match(stripped):
+        return False
+    return bool(_NUMBERED_HEADING.match(stripped)) or stripped.isupper() or stripped.istitle()
+
+
+def layout_units(index: OffsetIndex, page: int) -> Iterator[Unit]:
+    """
+    One unit per indexed layout (paragraph or block) of the page.
+    """
+    page_number = index.page_numbers[page]
+    for layout in index.page_range(page):
+        text = index.layout_text(layout)
+        start, end = index.span(layout)
+        yield Unit(text, page_number, is_heading(text), start, end)
+
+
+def sentence_units(index: OffsetIndex, page: int) -> Iterator[Unit]:
+    """
+    One unit per sentence of the page's paragraphs; headings are kept whole.
+    """
+    for unit in layout_units(index, page):
+        if unit.heading:
+            yield unit
+            continue
+
+        # Sentence offsets are relative to the start of the paragraph
+        position = 0
+        for sentence in _SENTENCE_END.split(unit.text):
+            position = unit.text.find(sentence, position)
+            if sentence.strip():
+                start = min(unit.start + position, unit.end)
+                yield Unit(sentence, unit.page, False, start, min(start + len(sentence), unit.end))
+            position += len(sentence)
+
+
+def _make_chunk(units: list) -> Chunk:
+    return Chunk(
+        text="\n".join(unit.text.strip() for unit in units),
+        page=units[0].page,
+        end_page=units[-1].page,
+        start=units[0].start,
+        end=units[-1].end,
+    )
+
+
+def merge_units(
+    units: Iterable[Unit],
+    max_tokens: int = MAX_TOKENS,
+    overlap_tokens: int = OVERLAP_TOKENS,
+    respect_pages: bool = True,
+) -> Iterator[Chunk]:
+    """
+    Merges adjacent units into chunks of at most `max_tokens` tokens. A new chunk is
+    started at every heading (and page, if `respect_pages`), and chunks split because
+    of their size repeat up to `overlap_tokens` tokens of trailing units. A unit longer
+    than `max_tokens` becomes a chunk of its own. With `max_tokens` set to 0, every unit
+    is a chunk.
+    """
+    current = []
+    tokens = 0
+    for unit in units:
+        if not unit.text.strip():
+            continue
+
+        unit_tokens = count_tokens(unit.text)
+        if current:
+            boundary = unit.heading or (respect_pages and unit.page != current[-1].page)
+            if boundary or tokens + unit_tokens > max_tokens:
+                yield _make_chunk(current)
+
+                # Carry over trailing units as overlap, unless a new section or page begins
+                overlap = []
+                if not boundary:
+                    overlap_budget = min(overlap_tokens, max_tokens - unit_tokens)
+                    for previous in reversed(current):
+                        previous_tokens = count_tokens(previous.text)
+                        if previous.heading or previous_tokens > overlap_budget:
+                            break
+                        overlap.insert(0, previous)
+                        overlap_budget -= previous_tokens
+                current = overlap
+                tokens = sum(count_tokens(previous.text) for previous in overlap)
+
+        current.append(unit)
+        tokens += unit_tokens
+
+    if current:
+        yield _make_chunk(current)
+
+
+def fixed_windows(
+    units: Iterable[Unit],
+    max_tokens: int = MAX_TOKENS,
+    overlap_tokens: int = OVERLAP_TOKENS,
+    respect_pages: bool = True,
+) -> Iterator[Chunk]:
+    """
+    Splits the text into windows of about `max_tokens` tokens that overlap by about
+    `overlap_tokens` tokens, ignoring paragraph and heading boundaries.
+    """
+    def windows(words: list) -> Iterator[Chunk]:
+        # Word-level windows, converted from the token budget with the same four characters per token estimate
+        average_tokens = max(1.0, sum(count_tokens(word) + 0.25 for word, _, _ in words) / len(words))
+        size = max(1, int(max_tokens / average_tokens))
+        step = max(1, size - int(overlap_tokens / average_tokens))
+        for start in range(0, len(words), step):
+            window = words[start : start + size]
+            yield Chunk(
+                " ".join(word for word, _, _ in window),
+                window[0][1],
+                window[-1][1],
+                window[0][2],
+                window[-1][2] + len(window[-1][0]),
+            )
+            if start + size >= len(words):
+                break
+
+    words = []
+    for unit in units:
+        if respect_pages and words and unit.page != words[-1][1]:
+            yield from windows(words)
+            words = []
+        # Keep the document offset of every word so windows can be mapped back to the text
+        words.extend(
+            (match.group(), unit.page, unit.start + match.start())
+            for match in re.finditer(r"\S+", unit.text)
+        )
+
+    if words:
+        yield from windows(words)
+
+
+STRATEGIES = {
+    "paragraph": ChunkingStrategy(layout_units, merge_units, "paragraphs"),
+    "block": ChunkingStrategy(layout_units, merge_units, "blocks"),
+    "sentence-merge": ChunkingStrategy(sentence_units, merge_units, "paragraphs"),
+    "fixed-window": ChunkingStrategy(layout_units, fixed_windows, "paragraphs"),
+}
+
+
+def register_strategy(name: str, units, combine, layout: str = "paragraphs") -> None:
+    """
+    Makes a custom chunking strategy available under `name`.
+    """
+    STRATEGIES[name] = ChunkingStrategy(units, combine, layout)
+
+
+def chunk_documents(
+    documents: Iterable[documentai.Document],
+    strategy: str = "paragraph",
+    max_tokens: int = MAX_TOKENS,
+    overlap_tokens: int = OVERLAP_TOKENS,
+    respect_pages: bool = True,
+) -> Iterator[Chunk]:
+    """
+    Chunks the output shards of a document with the given strategy. Each shard is
+    indexed by offset once and its text is only sliced for the units being chunked.
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown chunking strategy: {strategy}. Available: {', '.join(STRATEGIES)}")
+
+    units, combine, layout = STRATEGIES[strategy]
+
+    def document_units() -> Iterator[Unit]:
+        for document in documents:
+            index = OffsetIndex.from_document(document, layout)
+            for page in range(index.page_count):
+                yield from units(index, page)
+
+    return combine(
+        document_units(),
+        max_tokens=max_tokens,
+        overlap_tokens=overlap_tokens,
+        respect_pages=respect_pages,
+    )
@@ -0,0 +1,99 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from typing import Any, Callable, Dict, Optional
+
+
+class ClientRegistry:
+    """
+    Creates the clients and resources of a function on first use and returns the same
+    instance afterwards, instead of building them all when the module is imported.
+
+    Factories import their libraries themselves, so a cold start only pays for the
+    imports, connections and API calls of the resources a request actually uses. Each
+    resource is created once per instance even when concurrent requests ask for it.
+
+    Usage:
+        clients = ClientRegistry()
+
+        @clients.register
+        def db():
+            from google.cloud import firestore
+            return firestore.Client()
+
+        db().collection(...)  # The client is created by the first call
+
+    Every function is deployed from its own folder, so each folder has a copy of this module.
+    """
+
+    def __init__(self):
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._instances: Dict[str, Any] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self.timings: Dict[str, float] = {}  # Seconds it took to create each resource
+
+    def register(self, factory: Callable[[], Any]) -> Callable[[], Any]:
+        """
+        Registers a factory under its function name. Returns an accessor that creates the
+        resource on its first call and returns the same instance on every call.
+        """
+        name = factory.__name__
+        self._factories[name] = factory
+
+        @wraps(factory)
+        def accessor():
+            return self.get(name)
+
+        return accessor
+
+    def get(self, name: str, factory: Optional[Callable[[], Any]] = None) -> Any:
+        """
+        Returns the resource `name`, creating it with its registered factory (or `factory`,
+        for resources that depend on a parameter such as a location) if needed.
+        """
+        try:
+            return self._instances[name]
+        except KeyError:
+            pass
+        with self._lock:
+            lock = self._locks.setdefault(name, threading.Lock())
+        with lock:
+            if name not in self._instances:
+                started = time.monotonic()
+                self._instances[name] = (factory or self._factories[name])()
+                self.timings[name] = time.monotonic() - started
+        return self._instances[name]
+
+    def provide(self, name: str, instance: Any) -> None:
+        """
+        Uses `instance` as the resource `name` instead of creating it, e.g. to substitute a fake.
+        """
+        with self._lock:
+            self._instances[name] = instance
+
+    def created(self, name: str) -> bool:
+        return name in self._instances
+
+    def warm(self, *names: str) -> None:
+        """
+        Creates the given resources (all registered ones by default) concurrently, so their
+        network round trips overlap instead of adding up.
+        """
+        # Every request calls this: skip the thread pool once the resources exist
+        names = [name for name in names or self._factories if name not in self._instances]
+        if not names:
+            return
+        with ThreadPoolExecutor(max_workers=len(names)) as executor:
+            # Raises the first error, like creating them one by one would
+            list(executor.map(self.get, names))
+
+    def reset(self, *names: str) -> None:
+        """
+        Drops the given resources (all of them by default); they are created again on next use.
+        """
+        with self._lock:
+            for name in names or list(self._instances):
+                self._instances.pop(name, None)
+                self.timings.pop(name, None)
@@ -0,0 +1,90 @@
+import threading
+from concurrent.futures import Future
+
+BATCH_WINDOW_SECONDS = 2.0
+MAX_BATCH_DOCUMENTS = 50
+
+
+class DocumentBatcher:
+    """
+    Collects the documents uploaded within a short window (or until `max_documents`
+    are pending) and sends them to Document AI as a single batch, instead of paying
+    the operation overhead and polling latency once per file.
+
+    `process_batch` is called with the list of GCS URIs of a batch and must return the
+    `BatchProcessMetadata` of the finished operation. Each caller of `submit` gets a
+    future resolving to the `IndividualProcessStatus` of its own document.
+    """
+
+    def __init__(
+        self,
+        process_batch,
+        window_seconds: float = BATCH_WINDOW_SECONDS,
+        max_documents: int = MAX_BATCH_DOCUMENTS,
+    ):
+        self.process_batch = process_batch
+        self.window_seconds = window_seconds
+        self.max_documents = max_documents
+
+        self._pending = []
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def submit(self, gcs_uri: str) -> Future:
+        """
+        Adds a document to the next batch. Returns a future of its process status.
+        """
+        future = Future()
+        with self._lock:
+            self._pending.append((gcs_uri, future))
+            if len(self._pending) >= self.max_documents:
+                batch = self._take()
+            else:
+                batch = None
+                if self._timer is None:
+                    self._timer = threading.Timer(self.window_seconds, self._flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+        # A full batch is processed right away by the invocation that filled it
+        if batch:
+            self._process(batch)
+
+        return future
+
+    def _take(self) -> list:
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        return batch
+
+    def _flush(self) -> None:
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._process(batch)
+
+    def _process(self, batch: list) -> None:
+        # The same object may have been uploaded twice within the window; process it once
+        gcs_uris = list(dict.fromkeys(gcs_uri for gcs_uri, _ in batch))
+        print(f"Processing a batch of {len(gcs_uris)} document(s)")
+
+        try:
+            metadata = self.process_batch(gcs_uris)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        # Fan the per-document statuses back out to the invocations waiting for them
+        statuses = {
+            status.input_gcs_source: status
+            for status in metadata.individual_process_statuses
+        }
+        for gcs_uri, future in batch:
+            status = statuses.get(gcs_uri)
+            if status is None:
+                future.set_exception(ValueError(f"No process status returned for {gcs_uri}"))
+            else:
+                future.set_result(status)
@@ -0,0 +1,176 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core.exceptions import (Aborted, DeadlineExceeded,
+                                        InternalServerError,
+                                        ResourceExhausted, ServiceUnavailable)
+
+import tracing
+
+MAX_BATCH_SIZE = 500  # Firestore accepts at most 500 writes per commit. See: https://cloud.google.com/firestore/quotas#writes_and_transactions
+MAX_IN_FLIGHT = 8
+MAX_RETRIES = 5
+INITIAL_BACKOFF = 0.5  # seconds
+
+# Errors worth retrying a commit for; anything else is raised straight away
+RETRYABLE_ERRORS = (
+    Aborted,
+    DeadlineExceeded,
+    InternalServerError,
+    ResourceExhausted,
+    ServiceUnavailable,
+)
+
+
+class BatchedWriter:
+    """
+    Groups Firestore `set` and `delete` mutations into batched commits instead of issuing one
+    round trip per document. Full batches are committed on a thread pool, so
+    several commits can be in flight while new writes are being queued.
+
+    Usage:
+        with BatchedWriter(db) as writer:
+            writer.set(doc_ref, {"text": "..."})
+        print(writer.stats())
+    """
+
+    def __init__(
+        self,
+        client,
+        batch_size: int = MAX_BATCH_SIZE,
+        max_in_flight: int = MAX_IN_FLIGHT,
+        max_retries: int = MAX_RETRIES,
+        initial_backoff: float = INITIAL_BACKOFF,
+    ):
+        if not 0 < batch_size <= MAX_BATCH_SIZE:
+            raise ValueError(f"batch_size must be between 1 and {MAX_BATCH_SIZE}")
+
+        self.client = client
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+
+        self._pending = []
+        self._futures = []
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        # Bounds the number of queued + running commits so a fast producer can't buffer the whole document in memory
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self.writes = 0
+        self.batches = 0
+        self.retries = 0
+        self._started = time.monotonic()
+        self._finished = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def set(self, doc_ref, data: dict) -> None:
+        """
+        Queues a `set` of `data` on `doc_ref`, committing a batch once it is full.
+        """
+        if self._closed:
+            raise RuntimeError("Cannot write to a closed BatchedWriter")
+
+        self._pending.append((doc_ref, data))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def delete(self, doc_ref) -> None:
+        """
+        Queues the deletion of `doc_ref`, committing a batch once it is full.
+        """
+        self.set(doc_ref, None)
+
+    def flush(self) -> None:
+        """
+        Submits the pending writes as one batch without waiting for it to commit.
+        """
+        if not self._pending:
+            return
+
+        writes, self._pending = self._pending, []
+        self._slots.acquire()
+        future = self._executor.submit(tracing.bind(self._commit), writes)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+
+    def wait(self) -> None:
+        """
+        Flushes the pending writes and waits until every batch submitted so far is committed.
+        Raises the first commit error, if any.
+        """
+        self.flush()
+        for future in self._futures:
+            future.result()
+
+    def close(self) -> None:
+        """
+        Flushes the remaining writes and waits for every batch to be committed.
+        Raises the first commit error, if any.
+        """
+        if self._closed:
+            return
+
+        try:
+            self.flush()
+        finally:
+            self._closed = True
+            self._executor.shutdown(wait=True)
+            self._finished = time.monotonic()
+
+        for future in self._futures:
+            future.result()
+
+    def _commit(self, writes: list) -> None:
+        """
+        Commits `writes` in a single batch, retrying transient errors with exponential backoff.
+        """
+        with tracing.span("paragraph_write") as span:
+            span.add(items=len(writes), bytes=sum(len(str(data.get("text", "")).encode()) for _, data in writes if data is not None))
+            self._commit_batch(writes, span)
+
+    def _commit_batch(self, writes: list, span: tracing.Span) -> None:
+        for attempt in range(self.max_retries + 1):
+            batch = self.client.batch()
+            for doc_ref, data in writes:
+                if data is None:
+                    batch.delete(doc_ref)
+                else:
+                    batch.set(doc_ref, data)
+
+            try:
+                span.add(api_calls=1)
+                batch.commit()
+                break
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                with self._lock:
+                    self.retries += 1
+                delay = self.initial_backoff * 2**attempt
+                print(f"Batch commit failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+        with self._lock:
+            self.writes += len(writes)
+            self.batches += 1
+
+    def stats(self) -> dict:
+        """
+        Returns the write counters and throughput of this writer.
+        """
+        elapsed = (self._finished or time.monotonic()) - self._started
+        return {
+            "writes": self.writes,
+            "batches": self.batches,
+            "retries": self.retries,
+            "seconds": round(elapsed, 3),
+            "writes_per_second": round(self.writes / elapsed, 1) if elapsed else 0.0,
+        }
@@ -1,47 +1,116 @@
+import json
 import os
 import re
-from typing import Optional, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, Optional, Sequence
 
 import functions_framework
 from google.api_core.client_options import ClientOptions
+from google.api_core.operation import Operation
 from google.api_core.exceptions import (FailedPrecondition,
                                         InternalServerError, RetryError)
 from google.cloud import documentai, firestore, storage  # type: ignore
 
+from chunking import Chunk, chunk_documents
+from clients import ClientRegistry
+from document_batcher import DocumentBatcher
+from firestore_writer import BatchedWriter
+from operation_store import DONE, OperationStore
+from paragraph_versions import STALE_ROWS_FIELD, ParagraphVersions
+from processor_manager import ProcessorManager
+from work_items import (COUNT_FIELD, DONE_FIELD, FINISH_ITEM_ID, PAGES_PER_ITEM, WorkItem,
+                        WorkItemPublisher, is_complete, publish_work_item)
+import tracing
+
 PROJECT_ID = "YOUR_PROJECT"
 LOCATION = "YOUR_LOCATION"
 PROCESSOR_DISPLAY_NAME = "document_ai_ocr_processor"
 PROCESSOR_TYPE = "OCR_PROCESSOR"
+PROCESSOR_IDLE_SECONDS = int(os.environ.get("PROCESSOR_IDLE_SECONDS", 600))
+# Set to a positive number of seconds to send the documents uploaded within that window to Document AI as one batch
+BATCH_WINDOW_SECONDS = float(os.environ.get("BATCH_WINDOW_SECONDS", 0))
+MAX_BATCH_DOCUMENTS = int(os.environ.get("MAX_BATCH_DOCUMENTS", 50))
+# Seconds to wait for Document AI to process one document, and for each further document of a batch
+PROCESS_TIMEOUT_SECONDS = int(os.environ.get("PROCESS_TIMEOUT_SECONDS", 400))
+BATCH_TIMEOUT_PER_DOCUMENT_SECONDS = int(os.environ.get("BATCH_TIMEOUT_PER_DOCUMENT_SECONDS", 60))
+# How Document AI paragraphs are turned into indexed chunks: paragraph, block, sentence-merge or fixed-window
+CHUNK_STRATEGY = os.environ.get("CHUNK_STRATEGY", "paragraph")
+CHUNK_MAX_TOKENS = int(os.environ.get("CHUNK_MAX_TOKENS", 512))  # 0 stores every paragraph/block/sentence on its own
+CHUNK_OVERLAP_TOKENS = int(os.environ.get("CHUNK_OVERLAP_TOKENS", 50))
+CHUNK_RESPECT_PAGES = os.environ.get("CHUNK_RESPECT_PAGES", "true").lower() == "true"
+# Set to "true" to also store the full text of each document in its Firestore document (limited to 1 MiB)
+STORE_FULL_TEXT = os.environ.get("STORE_FULL_TEXT", "false").lower() == "true"
+# Set to "true" to return as soon as Document AI has accepted the document; see complete_batch and on_output_written
+ASYNC_PROCESSING = os.environ.get("ASYNC_PROCESSING", "false").lower() == "true"
+# Set to a Pub/Sub topic (projects/PROJECT/topics/TOPIC) to publish the chunks for indexing page range by page range as they are written, instead of leaving the whole document to the indexer
+PIPELINE_TOPIC = os.environ.get("PIPELINE_TOPIC")
+PIPELINE_PAGES_PER_ITEM = int(os.environ.get("PIPELINE_PAGES_PER_ITEM", PAGES_PER_ITEM))
 
-db = firestore.Client()
+# Clients are created on first use and reused by the following requests, see clients.py
+clients = ClientRegistry()
 
-def batch_process_documents(
+
+@clients.register
+def db():
+    return firestore.Client()
+
+
+@clients.register
+def operation_store():
+    return OperationStore(db())
+
+
+@clients.register
+def storage_client():
+    return storage.Client()
+
+
+@clients.register
+def publisher():
+    from google.cloud import pubsub_v1  # type: ignore
+
+    return pubsub_v1.PublisherClient()
+
+
+def documentai_client(location: str) -> documentai.DocumentProcessorServiceClient:
+    """
+    Returns the Document AI client of a location, created once per instance.
+    """
+    # You must set the `api_endpoint` if you use a location other than "us".
+    return clients.get(
+        f"documentai_{location}",
+        lambda: documentai.DocumentProcessorServiceClient(
+            client_options=ClientOptions(api_endpoint=f"{location}-documentai.googleapis.com")
+        ),
+    )
+
+
+def submit_batch_process(
     project_id: str,
     location: str,
     processor_id: str,
     gcs_output_uri: str,
     processor_version_id: Optional[str] = None,
     gcs_input_uri: Optional[str] = None,
+    gcs_input_uris: Optional[Sequence[str]] = None,
     input_mime_type: str = "application/pdf",
     gcs_input_prefix: Optional[str] = None,
     field_mask: Optional[str] = None,
-    timeout: int = 400,
-) -> None:
+) -> Operation:
     """
-    Batch processes the documents from Cloud Storage using a Document AI Processor.
+    Starts batch processing the documents from Cloud Storage using a Document AI Processor.
+    Returns the Long Running Operation (LRO) without waiting for it.
     """
-    # You must set the `api_endpoint` if you use a location other than "us".
-    opts = ClientOptions(api_endpoint=f"{location}-documentai.googleapis.com")
-
-    client = documentai.DocumentProcessorServiceClient(client_options=opts)
+    client = documentai_client(location)
 
-    if gcs_input_uri:
+    if gcs_input_uri or gcs_input_uris:
         # Specify specific GCS URIs to process individual documents
-        gcs_document = documentai.GcsDocument(
-            gcs_uri=gcs_input_uri, mime_type=input_mime_type
-        )
-        # Load GCS Input URI into a List of document files
-        gcs_documents = documentai.GcsDocuments(documents=[gcs_document])
+        gcs_document_list = [
+            documentai.GcsDocument(gcs_uri=uri, mime_type=input_mime_type)
+            for uri in (gcs_input_uris or [gcs_input_uri])
+        ]
+        # Load GCS Input URIs into a List of document files
+        gcs_documents = documentai.GcsDocuments(documents=gcs_document_list)
         input_config = documentai.BatchDocumentsInputConfig(gcs_documents=gcs_documents)
     else:
         # Specify a GCS URI Prefix to process an entire directory
@@ -74,24 +143,39 @@ def batch_process_documents(
     )
 
     # BatchProcess returns a Long Running Operation (LRO)
-    operation = client.batch_process_documents(request)
+    # Format: projects/{project_id}/locations/{location}/operations/{operation_id}
+    with tracing.span("lro_submit", documents=len(gcs_input_uris or [gcs_input_uri])) as span:
+        span.add(api_calls=1)
+        return client.batch_process_documents(request)
+
+
+def batch_process_documents(
+    project_id: str,
+    location: str,
+    processor_id: str,
+    gcs_output_uri: str,
+    timeout: int = 400,
+    **kwargs,
+) -> documentai.BatchProcessMetadata:
+    """
+    Batch processes the documents from Cloud Storage using a Document AI Processor and waits for the result.
+    Returns the metadata of the finished operation; use `iter_output_documents` to read the results.
+    """
+    operation = submit_batch_process(project_id, location, processor_id, gcs_output_uri, **kwargs)
 
     # Continually polls the operation until it is complete.
     # This could take some time for larger files
-    # Format: projects/{project_id}/locations/{location}/operations/{operation_id}
-    try:
-        print(f"Waiting for operation {operation.operation.name} to complete...")
-        operation.result(timeout=timeout)
-    # Catch exception when operation doesn't finish before timeout
-    except (RetryError, InternalServerError) as e:
-        print(e.message)
-
-    # NOTE: Can also use callbacks for asynchronous processing
-    #
-    # def my_callback(future):
-    #   result = future.result()
-    #
-    # operation.add_done_callback(my_callback)
+    with tracing.span("lro_wait", operation=operation.operation.name):
+        try:
+            print(f"Waiting for operation {operation.operation.name} to complete...")
+            operation.result(timeout=timeout)
+        # Catch exception when operation doesn't finish before timeout
+        except (RetryError, InternalServerError, TimeoutError) as e:
+            print(e)
+
+    # The metadata of an unfinished operation doesn't list any output yet
+    if not operation.done():
+        raise TimeoutError(f"Operation {operation.operation.name} did not complete within {timeout}s")
 
     # Once the operation is complete,
     # get output document information from operation metadata
@@ -100,45 +184,104 @@ def batch_process_documents(
     if metadata.state != documentai.BatchProcessMetadata.State.SUCCEEDED:
         raise ValueError(f"Batch Process Failed: {metadata.state_message}")
 
-    storage_client = storage.Client()
+    return metadata
 
-    print("Output files:")
-    # One process per Input Document
-    for process in list(metadata.individual_process_statuses):
-        # output_gcs_destination format: gs://BUCKET/PREFIX/OPERATION_NUMBER/INPUT_FILE_NUMBER/
-        # The Cloud Storage API requires the bucket name and URI prefix separately
-        matches = re.match(r"gs://(.*?)/(.*)", process.output_gcs_destination)
-        if not matches:
-            print(
-                "Could not parse output GCS destination:",
-                process.output_gcs_destination,
-            )
-            continue
 
-        output_bucket, output_prefix = matches.groups()
+def get_batch_process_metadata(location: str, operation_name: str) -> Optional[documentai.BatchProcessMetadata]:
+    """
+    Looks up a batch process operation by name. Returns its metadata once it is done, None while it is still running.
+    """
+    client = documentai_client(location)
+
+    with tracing.span("lro_poll", operation=operation_name) as span:
+        span.add(api_calls=1)
+        operation = client.get_operation(request={"name": operation_name})
+    if not operation.done:
+        return None
+
+    if operation.HasField("error"):
+        raise ValueError(f"Batch Process Failed: {operation.error.message}")
+
+    metadata = documentai.BatchProcessMetadata.deserialize(operation.metadata.value)
+
+    if metadata.state != documentai.BatchProcessMetadata.State.SUCCEEDED:
+        raise ValueError(f"Batch Process Failed: {metadata.state_message}")
+
+    return metadata
+
+
+def shard_sort_key(blob_name: str) -> tuple:
+    """
+    Sorts the output shards of a document (e.g. `doc-0.json`, `doc-1.json`, ..., `doc-10.json`) by shard number.
+    """
+    matches = re.search(r"-(\d+)\.json$", blob_name)
+    return (int(matches.group(1)) if matches else 0, blob_name)
 
-        # Get List of Document Objects from the Output Bucket
-        output_blobs = storage_client.list_blobs(output_bucket, prefix=output_prefix)
 
-        # Document AI may output multiple JSON files per source file
-        for blob in output_blobs:
-            # Document AI should only output JSON files to GCS
-            if blob.content_type != "application/json":
-                print(
-                    f"Skipping non-supported file: {blob.name} - Mimetype: {blob.content_type}"
-                )
-                continue
+def download_shard(blob: storage.Blob) -> documentai.Document:
+    """
+    Downloads a JSON output shard and converts it to a Document object.
+    """
+    with tracing.span("shard_download", blob=blob.name) as span:
+        data = blob.download_as_bytes()
+        span.add(items=1, bytes=len(data), api_calls=1)
+        return documentai.Document.from_json(data, ignore_unknown_fields=True)
 
-            # Download JSON File as bytes object and convert to Document Object
-            print(f"Fetching {blob.name}")
-            document = documentai.Document.from_json(
-                blob.download_as_bytes(), ignore_unknown_fields=True
+
+def iter_process_shards(
+    output_gcs_destination: str, storage_client: storage.Client
+) -> Iterator[documentai.Document]:
+    """
+    Yields the output shards of one processed input document in order. While a shard is
+    being consumed, the next one is downloaded in the background, so at most two shards
+    are held in memory at a time.
+    """
+    # output_gcs_destination format: gs://BUCKET/PREFIX/OPERATION_NUMBER/INPUT_FILE_NUMBER/
+    # The Cloud Storage API requires the bucket name and URI prefix separately
+    matches = re.match(r"gs://(.*?)/(.*)", output_gcs_destination)
+    if not matches:
+        print("Could not parse output GCS destination:", output_gcs_destination)
+        return
+
+    output_bucket, output_prefix = matches.groups()
+
+    # Document AI may output multiple JSON files per source file
+    blobs = []
+    for blob in storage_client.list_blobs(output_bucket, prefix=output_prefix):
+        # Document AI should only output JSON files to GCS
+        if blob.content_type != "application/json":
+            print(
+                f"Skipping non-supported file: {blob.name} - Mimetype: {blob.content_type}"
             )
+            continue
+        blobs.append(blob)
+    blobs.sort(key=lambda blob: shard_sort_key(blob.name))
+
+    if not blobs:
+        return
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        download = tracing.bind(download_shard)
+        next_shard = executor.submit(download, blobs[0])
+        for idx in range(len(blobs)):
+            document = next_shard.result()
+            if idx + 1 < len(blobs):
+                next_shard = executor.submit(download, blobs[idx + 1])
 
             # For a full list of Document object attributes, please reference this page:
             # https://cloud.google.com/python/docs/reference/documentai/latest/google.cloud.documentai_v1.types.Document
+            yield document
 
-            return document
+
+def iter_output_documents(
+    metadata: documentai.BatchProcessMetadata,
+) -> Iterator[documentai.Document]:
+    """
+    Yields the output shards of every document processed by a batch operation.
+    """
+    # One process per Input Document
+    for process in list(metadata.individual_process_statuses):
+        yield from iter_process_shards(process.output_gcs_destination, storage_client())
 
 
 def create_processor(
@@ -147,11 +290,8 @@ def create_processor(
     """
     Creates the Document AI Processor.
     """
-    # You must set the api_endpoint if you use a location other than 'us'.
     print(f"Checking for existing processor: {processor_display_name}")
-    opts = ClientOptions(api_endpoint=f"{location}-documentai.googleapis.com")
-
-    client = documentai.DocumentProcessorServiceClient(client_options=opts)
+    client = documentai_client(location)
 
      # The full resource name of the location
     # e.g.: projects/project_id/locations/location
@@ -186,10 +326,7 @@ def enable_processor(project_id: str, location: str, processor_id: str) -> None:
     """
     Enables the Document AI Processor.
     """
-    # You must set the api_endpoint if you use a location other than 'us'.
-    opts = ClientOptions(api_endpoint=f"{location}-documentai.googleapis.com")
-
-    client = documentai.DocumentProcessorServiceClient(client_options=opts)
+    client = documentai_client(location)
 
     # The full resource name of the location
     # e.g.: projects/project_id/locations/location/processors/processor_id
@@ -197,26 +334,25 @@ def enable_processor(project_id: str, location: str, processor_id: str) -> None:
     request = documentai.EnableProcessorRequest(name=processor_name)
 
     # Make EnableProcessor request
-    try:
-        operation = client.enable_processor(request=request)
+    with tracing.span("processor_enable", processor=processor_id) as span:
+        try:
+            span.add(api_calls=1)
+            operation = client.enable_processor(request=request)
 
-        # Print operation name
-        print(operation.operation.name)
-        # Wait for operation to complete
-        operation.result()
-    # Cannot enable a processor that is already enabled
-    except FailedPrecondition as e:
-        print(e.message)
+            # Print operation name
+            print(operation.operation.name)
+            # Wait for operation to complete
+            operation.result()
+        # Cannot enable a processor that is already enabled
+        except FailedPrecondition as e:
+            print(e.message)
 
 
 def disable_processor(project_id: str, location: str, processor_id: str) -> None:
     """
     Disables the Document AI Processor.
     """
-    # You must set the api_endpoint if you use a location other than 'us'.
-    opts = ClientOptions(api_endpoint=f"{location}-documentai.googleapis.com")
-
-    client = documentai.DocumentProcessorServiceClient(client_options=opts)
+    client = documentai_client(location)
 
     # The full resource name of the processor
     # e.g.: projects/project_id/locations/location/processors/processor_id
@@ -235,53 +371,232 @@ def disable_processor(project_id: str, location: str, processor_id: str) -> None
     except FailedPrecondition as e:
         print(e.message)
 
-def layout_to_text(layout: documentai.Document.Page.Layout, text: str) -> str:
+
+def get_processor_state(project_id: str, location: str, processor_id: str) -> documentai.Processor.State:
     """
-    Document AI identifies text in different parts of the document by their
-    offsets in the entirety of the document"s text. This function converts
-    offsets to a string.
+    Returns the state of the Document AI Processor (ENABLED, DISABLED, ENABLING, ...).
     """
-    # If a text segment spans several lines, it will
-    # be stored in different text segments.
-    return "".join(
-        text[int(segment.start_index) : int(segment.end_index)]
-        for segment in layout.text_anchor.text_segments
+    client = documentai_client(location)
+
+    # The full resource name of the processor
+    # e.g.: projects/project_id/locations/location/processors/processor_id
+    processor_name = client.processor_path(project_id, location, processor_id)
+
+    return client.get_processor(name=processor_name).state
+
+# The processor is resolved once per instance and only disabled after PROCESSOR_IDLE_SECONDS without any document to process
+@clients.register
+def processor_manager():
+    return ProcessorManager(
+        db(),
+        resolve_processor=lambda: create_processor(
+            project_id = PROJECT_ID, location = LOCATION, processor_display_name = PROCESSOR_DISPLAY_NAME, processor_type = PROCESSOR_TYPE
+        ),
+        enable=lambda processor_id: enable_processor(project_id = PROJECT_ID, location = LOCATION, processor_id = processor_id),
+        disable=lambda processor_id: disable_processor(project_id = PROJECT_ID, location = LOCATION, processor_id = processor_id),
+        get_state=lambda processor_id: get_processor_state(project_id = PROJECT_ID, location = LOCATION, processor_id = processor_id),
+        idle_seconds = PROCESSOR_IDLE_SECONDS,
     )
-    
-def extract_paragraphs(
-    page_number: int, paragraphs: Sequence[documentai.Document.Page.Paragraph], text: str, doc_ref
-) -> None:
+
+
+def process_batch(gcs_input_uris: Sequence[str]) -> documentai.BatchProcessMetadata:
     """
-    Print all paragraphs from the page and writes them into Firestore.
-    """
-    for idx, paragraph in enumerate(paragraphs):
-        paragraph_text = layout_to_text(paragraph.layout, text)
-        print(f"Paragraph text: {paragraph_text}")  
-        
-        # Create a paragraph id
-        paragraph_id = str(page_number) + "." + str(idx)
-        
-        # Update the document with paragraph data and set the indexed status to false
-        doc_ref.collection("paragraphs").document(paragraph_id).set({"text": paragraph_text, "indexed": False, "page": page_number})
-        
-def extract_blocks(
-    page_number: int, blocks: Sequence[documentai.Document.Page.Block], text: str, doc_ref
-) -> None:
+    Processes several documents in a single Document AI batch operation. The operation is
+    given longer to complete the more documents it holds.
+    """
+    timeout = PROCESS_TIMEOUT_SECONDS + BATCH_TIMEOUT_PER_DOCUMENT_SECONDS * (len(gcs_input_uris) - 1)
+    with processor_manager().processor() as processor_id:
+        return batch_process_documents(
+            project_id = PROJECT_ID,
+            location = LOCATION,
+            processor_id = processor_id,
+            gcs_output_uri = f"gs://{os.environ.get('OUTPUT_BUCKET_NAME')}/",
+            timeout = timeout,
+            gcs_input_uris = gcs_input_uris
+        )
+
+document_batcher = (
+    DocumentBatcher(process_batch, window_seconds = BATCH_WINDOW_SECONDS, max_documents = MAX_BATCH_DOCUMENTS)
+    if BATCH_WINDOW_SECONDS > 0
+    else None
+)
+
+def extract_chunks(
+    chunks: Iterable[Chunk],
+    doc_ref,
+    writer: BatchedWriter,
+    work_items: Optional[WorkItemPublisher] = None,
+    versions: Optional[ParagraphVersions] = None,
+) -> int:
+    """
+    Logs all chunks of the document (with VERBOSE_LOGGING) and queues them on the batched Firestore writer. Returns the number of chunks.
+    With `work_items`, the chunks are also published for indexing page range by page range.
+    With the `versions` of the previous extraction, only the chunks that changed are written and left to index.
     """
-    Extract all blocks from the page and writes them into Firestore.
+    count = 0
+    chunks_per_page = {}
+    for chunk in chunks:
+        tracing.verbose(f"Chunk text: {chunk.text}")
+
+        # Create a paragraph id from the page the chunk starts on
+        idx = chunks_per_page.get(chunk.page, 0)
+        chunks_per_page[chunk.page] = idx + 1
+        paragraph_id = str(chunk.page) + "." + str(idx)
+
+        # Update the document with chunk data and set the indexed status to false
+        data = {
+            "text": chunk.text,
+            "indexed": False,
+            "page": chunk.page,
+            "end_page": chunk.end_page,
+            # Where the chunk starts and ends in the text of the document
+            "offsets": [chunk.start, chunk.end],
+        }
+        if versions:
+            data = versions.paragraph(paragraph_id, data)
+        if data is not None:
+            writer.set(doc_ref.collection("paragraphs").document(paragraph_id), data)
+        if work_items:
+            work_items.add(paragraph_id, chunk.page)
+        count += 1
+
+    return count
+
+def extract_document(object: str, documents: Iterator[documentai.Document]) -> Optional[int]:
     """
-    for idx, block in enumerate(blocks):
-        paragraph_text = layout_to_text(block.layout, text)
-        print(f"Paragraph text: {paragraph_text}")  
-        
-        # Create a paragraph id
-        paragraph_id = str(page_number) + "." + str(idx)
-        
-        # Update the document with block data and set the indexed status to false
-        doc_ref.collection("blocks").document(paragraph_id).set({"text": paragraph_text, "indexed": False, "page": page_number})
+    Writes the chunks and metadata of a processed document into Firestore, given the shards of its Document AI output.
+    Returns the number of work items published for indexing when PIPELINE_TOPIC is set, None otherwise.
+    """
+    filename = object.split("/")[-1]
+    collection_name = object.split("/")[0]
+    
+    #Create a file reference in Firestore
+    doc_ref = db().collection(collection_name).document(filename)
+    
+    languages = []
+    page_count = 0
+    text_length = 0
+    texts = []
+
+    def shards() -> Iterator[documentai.Document]:
+        nonlocal page_count, text_length
+        # Large documents are split into several shards; each one is processed as soon as it has been downloaded
+        for document in documents:
+            page_count += len(document.pages)
+            text_length += len(document.text)
+            if STORE_FULL_TEXT:
+                texts.append(document.text)
+            print(f"Shard {document.shard_info.shard_index}: {len(document.pages)} page(s), {len(document.text)} characters")
+
+            # Get all detected langauges
+            for page in document.pages:
+                for lang in page.detected_languages:
+                    if lang.language_code not in languages and lang.confidence > 0.8:
+                        languages.append(lang.language_code)
+
+            yield document
+
+    chunks = chunk_documents(
+        shards(),
+        strategy = CHUNK_STRATEGY,
+        max_tokens = CHUNK_MAX_TOKENS,
+        overlap_tokens = CHUNK_OVERLAP_TOKENS,
+        respect_pages = CHUNK_RESPECT_PAGES,
+    )
+
+    if PIPELINE_TOPIC:
+        # Forget the work items of a previous extraction of the same file
+        doc_ref.set({"status": "Processing...", COUNT_FIELD: firestore.DELETE_FIELD, DONE_FIELD: firestore.DELETE_FIELD}, merge=True)
+
+    # A file uploaded again keeps the paragraphs (and vector rows) of the chunks that did not change
+    with tracing.span("paragraph_versions") as span:
+        versions = ParagraphVersions(doc_ref.collection("paragraphs"))
+        span.add(items=len(versions.previous), api_calls=1)
+
+    # Chunks are written in batched commits rather than one round trip each
+    item_count = None
+    with tracing.span("extract_document", object=object) as span, BatchedWriter(db()) as writer:
+        work_items = WorkItemPublisher(publisher(), PIPELINE_TOPIC, writer, object, PIPELINE_PAGES_PER_ITEM) if PIPELINE_TOPIC else None
+        chunk_count = extract_chunks(chunks, doc_ref, writer, work_items, versions)
+        for paragraph_id in versions.removed():
+            writer.delete(doc_ref.collection("paragraphs").document(paragraph_id))
+        if work_items:
+            item_count = work_items.close()
+        span.add(items=chunk_count, pages=page_count, bytes=text_length, changed=versions.changed)
+
+    print(f"There are {page_count} page(s) and {chunk_count} chunk(s) in this document.\n")
+    print(f"Changes since the previous version of {object}: {versions.stats()}")
+    print(f"Firestore writes for {object}: {writer.stats()}")
+
+    # The text itself is kept in the chunks (and the Document AI output); the file only records its size
+    data = {"status": "Processing...", "languages": ",".join(languages), "pages": page_count, "text_length": text_length}
+    # The indexer tombstones the vector rows of the previous version once the new one is indexed
+    data[STALE_ROWS_FIELD] = versions.stale_rows()
+    if STORE_FULL_TEXT:
+        data["text"] = "".join(texts)
+    if item_count is None:
+        doc_ref.set(data)
+        return None
+
+    # The indexer records the items it finished in the same document while it is being extracted; keep them
+    data.update({"status": "Indexing...", COUNT_FIELD: item_count})
+    doc_ref.set(data, merge=True)
+    # The last item may have been indexed before the count was written
+    if is_complete(doc_ref.get().to_dict()):
+        if data[STALE_ROWS_FIELD]:
+            # The indexer tombstones the rows of the previous version when it completes a file; give it an empty item to complete
+            publish_work_item(publisher(), PIPELINE_TOPIC, WorkItem(object, FINISH_ITEM_ID, 0, 0, [])).result()
+        else:
+            doc_ref.update({"status": "Indexed"})
+    return item_count
+
+def complete_operation(operation_name: str) -> bool:
+    """
+    Extracts the output of an asynchronous Document AI operation into Firestore once it is done.
+    Returns False while the operation is still running or being extracted by another invocation.
+    """
+    record = operation_store().get(operation_name)
+    if record is None:
+        raise ValueError(f"Unknown operation: {operation_name}")
+    if record["status"] == DONE:
+        return True
+
+    error = None
+    try:
+        metadata = get_batch_process_metadata(LOCATION, record["name"])
+        if metadata is None:
+            print(f"Operation {record['name']} is still running")
+            return False
+    except ValueError as e:
+        error = str(e)
+
+    if not operation_store().claim(record["name"]):
+        return operation_store().get(record["name"])["status"] == DONE
+
+    # The processor is no longer needed once the operation is done
+    if not record.get("processor_released"):
+        processor_manager().release(detached=True)
+        operation_store().update(record["name"], {"processor_released": True})
+
+    try:
+        if error:
+            raise ValueError(error)
+
+        for status in metadata.individual_process_statuses:
+            object = record["objects"][status.input_gcs_source]
+            if status.status.code != 0:
+                raise ValueError(f"Processing {status.input_gcs_source} failed: {status.status.message}")
+            extract_document(object, iter_process_shards(status.output_gcs_destination, storage_client()))
+    except Exception as e:
+        operation_store().finish(record["name"], error=str(e))
+        raise
+
+    operation_store().finish(record["name"])
+    return True
 
 # Triggered by the workflow
 @functions_framework.http
+@tracing.traced("chunker")
 def chunker(request) -> tuple:
     """
     Given a Cloud Storage object, parse the object using Document AI and put all the relevant metadata into Firestore.
@@ -291,62 +606,105 @@ def chunker(request) -> tuple:
     object = request_json['object']
     bucket = request_json['bucket']
     print(f"bucket: {bucket}, object: {object}")
+    tracing.current().set(object=object)
     
     blob_uri = f"gs://{bucket}/{object}"
 
-    output_bucket = os.environ.get("OUTPUT_BUCKET_NAME")
-    output_uri = f"gs://{output_bucket}/"
-    
-    # Create a Document AI processor
-    processor = create_processor(
-        project_id = PROJECT_ID, location = LOCATION, processor_display_name = PROCESSOR_DISPLAY_NAME, processor_type = PROCESSOR_TYPE
-    )
-    
-    processor_id = processor.name.split("/")[-1]
-    
-    # To save costs, we disable the processor at the end of this function, hence enable it
-    print("Enabling processor")
-    enable_processor(project_id = PROJECT_ID, location = LOCATION, processor_id = processor_id)
-    
-    print("Processing document")
-    document = batch_process_documents(
-        project_id = PROJECT_ID,
-        location = LOCATION,
-        processor_id = processor_id, 
-        gcs_output_uri = output_uri,
-        gcs_input_uri = blob_uri
-    )
-        
-    text = document.text
-    print(f"Full document text: {text}\n")
-    
-    filename = object.split("/")[-1]
-    collection_name = object.split("/")[0]
-    
-    #Create a file reference in Firestore
-    doc_ref = db.collection(collection_name).document(filename)
-    
-    languages = ""
-    
-    print(f"There are {len(document.pages)} page(s) in this document.\n")
-
-    for page in document.pages:
-        print(f"Page {page.page_number}:")
-        
-        # Get all detected langauges
-        for lang in page.detected_languages:
-            if lang.language_code not in languages and lang.confidence > 0.8:
-                languages += lang.language_code + ","
-        
-        # Extract metadata and write it to Firestore
-        extract_paragraphs(page.page_number, page.paragraphs, text, doc_ref)
-        #extract_blocks(page.page_number, page.blocks, text, doc_ref)
-        
-    languages = languages[:-1]
-    data = {"text": text, "status": "Processing...", "languages": languages}
-    doc_ref.set(data)
-    
-    # Disable the processor to reduce the costs
-    disable_processor(project_id = PROJECT_ID, location = LOCATION, processor_id = processor_id)
-    
+    if ASYNC_PROCESSING:
+        # Hand the operation off instead of holding this instance until Document AI is done;
+        # the processor lease is released by whichever invocation completes the operation
+        processor_id = processor_manager().acquire(detached=True)
+        try:
+            operation = submit_batch_process(
+                project_id = PROJECT_ID,
+                location = LOCATION,
+                processor_id = processor_id,
+                gcs_output_uri = f"gs://{os.environ.get('OUTPUT_BUCKET_NAME')}/",
+                gcs_input_uri = blob_uri
+            )
+        except Exception:
+            processor_manager().release(detached=True)
+            raise
+
+        operation_name = operation.operation.name
+        print(f"Submitted operation {operation_name}")
+        operation_store().record(operation_name, {blob_uri: object})
+        db().collection(object.split("/")[0]).document(object.split("/")[-1]).set(
+            {"status": "Parsing...", "operation": operation_name}, merge=True
+        )
+
+        return (json.dumps({"operation": operation_name}), 202, {"Content-Type": "application/json"})
+
+    if document_batcher:
+        # Wait for the batch this document is part of, then only read this document's output
+        print("Processing document in a batch")
+        status = document_batcher.submit(blob_uri).result()
+        if status.status.code != 0:
+            raise ValueError(f"Processing {blob_uri} failed: {status.status.message}")
+        documents = iter_process_shards(status.output_gcs_destination, storage_client())
+    else:
+        output_bucket = os.environ.get("OUTPUT_BUCKET_NAME")
+        output_uri = f"gs://{output_bucket}/"
+
+        # Keep the Document AI processor enabled while the document is being processed
+        with processor_manager().processor() as processor_id:
+            print("Processing document")
+            metadata = batch_process_documents(
+                project_id = PROJECT_ID,
+                location = LOCATION,
+                processor_id = processor_id, 
+                gcs_output_uri = output_uri,
+                timeout = PROCESS_TIMEOUT_SECONDS,
+                gcs_input_uri = blob_uri
+            )
+        documents = iter_output_documents(metadata)
+
+    item_count = extract_document(object, documents)
+    if item_count is not None:
+        # The workflow skips the indexer: the work items are indexed as they are published
+        return (json.dumps({"work_items": item_count}), 200, {"Content-Type": "application/json"})
+
     return ('Document processed successfully', 200)
+
+
+
+# Polled by the workflow when ASYNC_PROCESSING is enabled
+@functions_framework.http
+@tracing.traced("complete_batch")
+def complete_batch(request) -> tuple:
+    """
+    Given the name of an operation started by the chunker, extracts its output into Firestore once it is done.
+    Responds with 202 while the operation is still running.
+    """
+    request_json = request.get_json(silent=True)
+    operation_name = request_json["operation"]
+
+    if complete_operation(operation_name):
+        return (json.dumps({"operation": operation_name, "status": DONE}), 200, {"Content-Type": "application/json"})
+    return (json.dumps({"operation": operation_name, "status": "RUNNING"}), 202, {"Content-Type": "application/json"})
+
+# Triggered by Document AI writing its output to OUTPUT_BUCKET_NAME
+@functions_framework.cloud_event
+@tracing.traced("on_output_written")
+def on_output_written(cloud_event) -> None:
+    """
+    Completes the operation an output file belongs to, as soon as Document AI has finished it.
+    """
+    # Output format: OPERATION_ID/INPUT_FILE_NUMBER/FILENAME-SHARD.json
+    operation_id = cloud_event.data["name"].split("/")[0]
+    if operation_store().get(operation_id) is None:
+        print(f"Ignoring output of unknown operation: {operation_id}")
+        return
+
+    complete_operation(operation_id)
+
+# Triggered by Cloud Scheduler
+@functions_framework.http
+@tracing.traced("disable_idle_processor")
+def disable_idle_processor(request) -> tuple:
+    """
+    Disables the Document AI processor if no document has been processed for PROCESSOR_IDLE_SECONDS, to reduce the costs.
+    """
+    if processor_manager().disable_if_idle():
+        return ('Processor disabled', 200)
+    return ('Processor in use', 200)
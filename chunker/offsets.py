@@ -0,0 +1,105 @@
+from array import array
+
+from google.cloud import documentai  # type: ignore
+
+
+class OffsetIndex:
+    """
+    Compact, array-backed index of the text spans of one Document AI output shard.
+
+    Instead of materialising a string per paragraph (or block), only integer offsets
+    into the shard's text are kept:
+
+        segments          start/end pairs into the shard's `text`, flattened; segments that
+                          follow each other directly (e.g. the lines of a paragraph) are merged
+        layout_segments   layout i owns segment pairs layout_segments[i]:layout_segments[i + 1]
+        page_layouts      page j owns layouts page_layouts[j]:page_layouts[j + 1]
+        page_numbers      the page number of page j
+
+    The text of a layout is only sliced out of the shared `text` buffer when it is
+    requested, with a single slice for layouts made of contiguous segments.
+
+    Document AI text anchors index the text of the whole document: they are made
+    shard-local when the index is built, and `span` adds `text_offset` back.
+    """
+
+    def __init__(self, text: str, text_offset: int = 0):
+        self.text = text
+        # Offset of this shard's text in the text of the whole document
+        self.text_offset = text_offset
+        self.segments = array("q")
+        self.layout_segments = array("q", [0])
+        self.page_layouts = array("q", [0])
+        self.page_numbers = array("q")
+
+    @classmethod
+    def from_document(cls, document: documentai.Document, layout: str = "paragraphs") -> "OffsetIndex":
+        """
+        Builds the index of the `layout` elements ("paragraphs", "blocks" or "lines") of every page of a shard.
+        """
+        index = cls(document.text, int(document.shard_info.text_offset))
+        segments = index.segments
+        offset, length = index.text_offset, len(index.text)
+        # Walk the raw protobuf message: the proto-plus wrappers allocate an object per field access
+        for page in documentai.Document.pb(document).pages:
+            for element in getattr(page, layout):
+                first = len(segments)
+                for segment in element.layout.text_anchor.text_segments:
+                    # Text anchors index the text of the whole document, not the shard's: keep
+                    # the part of the segment that falls inside this shard's text
+                    start = min(max(segment.start_index - offset, 0), length)
+                    end = min(max(segment.end_index - offset, 0), length)
+                    if start >= end:
+                        continue
+                    if len(segments) > first and segments[-1] == start:
+                        segments[-1] = end
+                    else:
+                        segments.append(start)
+                        segments.append(end)
+                index.layout_segments.append(len(segments) // 2)
+            index.page_layouts.append(len(index.layout_segments) - 1)
+            index.page_numbers.append(page.page_number)
+        return index
+
+    @property
+    def page_count(self) -> int:
+        return len(self.page_numbers)
+
+    def __len__(self) -> int:
+        return len(self.layout_segments) - 1
+
+    def page_range(self, page: int) -> range:
+        """
+        Returns the indices of the layouts on the `page`-th page of the shard.
+        """
+        return range(self.page_layouts[page], self.page_layouts[page + 1])
+
+    def span(self, layout: int) -> tuple:
+        """
+        Returns the start and end offset of a layout in the text of the whole document.
+        """
+        first, last = self.layout_segments[layout], self.layout_segments[layout + 1]
+        if first == last:
+            return (self.text_offset, self.text_offset)
+        return (self.text_offset + self.segments[2 * first], self.text_offset + self.segments[2 * last - 1])
+
+    def layout_text(self, layout: int) -> str:
+        """
+        Materialises the text of a layout from the shared text buffer.
+        """
+        first, last = self.layout_segments[layout], self.layout_segments[layout + 1]
+        if last - first == 1:
+            return self.text[self.segments[2 * first] : self.segments[2 * first + 1]]
+        return "".join(
+            self.text[self.segments[2 * i] : self.segments[2 * i + 1]]
+            for i in range(first, last)
+        )
+
+    def nbytes(self) -> int:
+        """
+        Returns the memory used by the offset arrays.
+        """
+        return sum(
+            a.itemsize * len(a)
+            for a in (self.segments, self.layout_segments, self.page_layouts, self.page_numbers)
+        )
@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta, timezone
+
+from google.cloud import firestore  # type: ignore
+
+OPERATIONS_COLLECTION = "operations"
+EXTRACTION_TIMEOUT = 3600  # An extraction still claimed after this long is assumed to have crashed
+
+RUNNING = "RUNNING"
+EXTRACTING = "EXTRACTING"
+DONE = "DONE"
+FAILED = "FAILED"
+
+
+@firestore.transactional
+def _claim(transaction, operation_ref) -> bool:
+    snapshot = operation_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return False
+
+    operation = snapshot.to_dict()
+    if operation["status"] == EXTRACTING:
+        claimed_at = operation.get("claimed_at")
+        if claimed_at and datetime.now(timezone.utc) - claimed_at < timedelta(seconds=EXTRACTION_TIMEOUT):
+            return False
+    elif operation["status"] not in (RUNNING, FAILED):
+        return False
+
+    transaction.update(operation_ref, {"status": EXTRACTING, "claimed_at": firestore.SERVER_TIMESTAMP})
+    return True
+
+
+class OperationStore:
+    """
+    Persists the Document AI operations started by the chunker, so that their results can
+    be extracted by whichever invocation notices they are done (a poll step of the workflow
+    or the output bucket trigger) rather than by the invocation that started them.
+    """
+
+    def __init__(self, db, collection: str = OPERATIONS_COLLECTION):
+        self.db = db
+        self.collection = db.collection(collection)
+
+    def _ref(self, operation_name: str):
+        # Format: projects/{project_id}/locations/{location}/operations/{operation_id}
+        return self.collection.document(operation_name.split("/")[-1])
+
+    def record(self, operation_name: str, objects: dict) -> None:
+        """
+        Records a running operation. `objects` maps the GCS URI of every input document to its object name.
+        """
+        self._ref(operation_name).set(
+            {
+                "name": operation_name,
+                "objects": objects,
+                "status": RUNNING,
+                "submitted_at": firestore.SERVER_TIMESTAMP,
+            }
+        )
+
+    def get(self, operation_id: str) -> dict:
+        """
+        Returns the recorded operation with the given ID (or full name), None if it is unknown.
+        """
+        snapshot = self._ref(operation_id).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+    def claim(self, operation_name: str) -> bool:
+        """
+        Marks the operation as being extracted. Returns False if it is unknown, already done
+        or being extracted by another invocation.
+        """
+        return _claim(self.db.transaction(), self._ref(operation_name))
+
+    def update(self, operation_name: str, data: dict) -> None:
+        self._ref(operation_name).update(data)
+
+    def finish(self, operation_name: str, error: str = None) -> None:
+        self._ref(operation_name).update(
+            {
+                "status": FAILED if error else DONE,
+                "error": error,
+                "finished_at": firestore.SERVER_TIMESTAMP,
+            }
+        )
@@ -0,0 +1,106 @@
+import hashlib
+from typing import Optional
+
+HASH_FIELD = "hash"  # Hash of the text and page of the chunk, see chunk_hash
+ROW_ID_FIELD = "row_id"  # Id of the paragraph's row in the vector table, set by the indexer
+STALE_ROWS_FIELD = "stale_rows"  # Field of the file document with the number of rows of the previous version no chunk kept
+# The fields of a paragraph compared between versions; the text is covered by the hash
+VERSIONED_FIELDS = (HASH_FIELD, ROW_ID_FIELD, "indexed", "page", "end_page", "offsets")
+
+
+def chunk_hash(text: str, page: int) -> str:
+    """
+    Identifies the vector row of a chunk: its text and the page stored in the row's metadata.
+    """
+    return hashlib.sha256(f"{page}\n{text}".encode()).hexdigest()
+
+
+class ParagraphVersions:
+    """
+    The paragraphs of the previous version of a document, so that extracting a new version
+    only rewrites the chunks that changed. A chunk whose text and page are unchanged keeps
+    the vector row of the previous version, even if it moved to another paragraph id (e.g.
+    after a paragraph was inserted above it on the same page), and is not embedded again.
+
+    The rows of the previous version no chunk kept are left to the indexer, which tombstones
+    them once the new version is indexed (see `stale_rows`).
+
+    Usage:
+        versions = ParagraphVersions(doc_ref.collection("paragraphs"))
+        data = versions.paragraph(paragraph_id, {"text": ..., "page": ...})
+        if data is not None:
+            writer.set(paragraph_ref, data)
+        for paragraph_id in versions.removed():
+            writer.delete(...)
+    """
+
+    def __init__(self, paragraphs_ref):
+        self.previous = {}  # Paragraph id -> versioned fields
+        self.rows = {}  # Hash -> row ids of the indexed paragraphs of the previous version
+        self.untracked_rows = 0  # Indexed paragraphs without a row id (indexed before row ids were recorded)
+        for snapshot in paragraphs_ref.select(list(VERSIONED_FIELDS)).stream():
+            data = snapshot.to_dict()
+            self.previous[snapshot.id] = data
+            if not data.get("indexed"):
+                continue
+            if data.get(HASH_FIELD) and data.get(ROW_ID_FIELD):
+                self.rows.setdefault(data[HASH_FIELD], []).append(data[ROW_ID_FIELD])
+            else:
+                self.untracked_rows += 1
+
+        self._seen = set()
+        self.unchanged = 0
+        self.reused = 0
+        self.changed = 0
+
+    def _take_row(self, paragraph_id: str, digest: str) -> Optional[str]:
+        rows = self.rows.get(digest)
+        if not rows:
+            return None
+        # Prefer the paragraph's own row, so that an unchanged paragraph needs no write
+        own_row = (self.previous.get(paragraph_id) or {}).get(ROW_ID_FIELD)
+        if own_row in rows:
+            rows.remove(own_row)
+            return own_row
+        return rows.pop()
+
+    def paragraph(self, paragraph_id: str, data: dict) -> Optional[dict]:
+        """
+        Returns the data to write for a chunk of the new version (`data` with its hash, and
+        the row it keeps if it is unchanged), or None if the paragraph is already up to date.
+        """
+        self._seen.add(paragraph_id)
+        digest = chunk_hash(data["text"], data["page"])
+        row_id = self._take_row(paragraph_id, digest)
+        data = {**data, HASH_FIELD: digest, "indexed": row_id is not None}
+        if row_id is None:
+            self.changed += 1
+            return data
+
+        data[ROW_ID_FIELD] = row_id
+        if self.previous.get(paragraph_id) == {field: data[field] for field in VERSIONED_FIELDS}:
+            self.unchanged += 1
+            return None
+        self.reused += 1
+        return data
+
+    def removed(self) -> list:
+        """
+        The ids of the paragraphs of the previous version that are not in the new one.
+        """
+        return [paragraph_id for paragraph_id in self.previous if paragraph_id not in self._seen]
+
+    def stale_rows(self) -> int:
+        """
+        The number of rows of the previous version that no chunk of the new version kept.
+        """
+        return sum(len(rows) for rows in self.rows.values()) + self.untracked_rows
+
+    def stats(self) -> dict:
+        return {
+            "unchanged": self.unchanged,
+            "reused": self.reused,
+            "changed": self.changed,
+            "removed": len(self.removed()),
+            "stale_rows": self.stale_rows(),
+        }
@@ -0,0 +1,204 @@
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+from google.cloud import documentai, firestore  # type: ignore
+
+IDLE_SECONDS = 600  # Keep the processor enabled for this long after the last document finished
+STALE_SECONDS = 3600  # Ignore in-flight counts older than the maximum function timeout (e.g. after a crash)
+ENABLE_TIMEOUT = 600
+STATE_POLL_INTERVAL = 5
+LEASE_COLLECTION = "processor_leases"
+
+ProcessorState = documentai.Processor.State
+
+
+@firestore.transactional
+def _claim_idle(transaction, lease_ref, idle_seconds: int) -> bool:
+    """
+    Returns True (and resets the lease) if no invocation has used the processor for `idle_seconds`.
+    The lease is marked as `disabling` in the same transaction, so that an invocation acquiring
+    it before the processor is disabled waits for the disable to finish before enabling it again.
+    """
+    snapshot = lease_ref.get(transaction=transaction)
+    lease = snapshot.to_dict() if snapshot.exists else {}
+
+    now = datetime.now(timezone.utc)
+    last_used = max(
+        [lease[field] for field in ("last_acquired", "last_released") if lease.get(field)],
+        default=None,
+    )
+    if last_used and now - last_used < timedelta(seconds=idle_seconds):
+        return False
+    if lease.get("in_flight", 0) > 0 and last_used and now - last_used < timedelta(seconds=STALE_SECONDS):
+        return False
+
+    transaction.set(lease_ref, {"in_flight": 0, "disabling": True, "disabled_at": firestore.SERVER_TIMESTAMP}, merge=True)
+    return True
+
+
+def _is_disabling(lease: dict) -> bool:
+    # A marker older than a disable can take was left by an instance that crashed while disabling
+    disabled_at = lease.get("disabled_at")
+    return bool(lease.get("disabling")) and (
+        disabled_at is None or datetime.now(timezone.utc) - disabled_at < timedelta(seconds=ENABLE_TIMEOUT)
+    )
+
+
+class ProcessorManager:
+    """
+    Resolves the Document AI processor once per instance and keeps it enabled while
+    documents are being processed, instead of enabling and disabling it on every call.
+
+    Every invocation holds a lease on the processor while it uses it. The number of
+    leases is counted locally and in a Firestore document shared by all instances, and
+    the processor is only disabled once no lease has been held for `idle_seconds`.
+    Disabling happens on a background timer after the last local lease is released;
+    since Cloud Functions may throttle CPU between requests, `disable_if_idle` should
+    also be called periodically (e.g. by Cloud Scheduler).
+
+    Usage:
+        with manager.processor() as processor_id:
+            batch_process_documents(processor_id=processor_id, ...)
+    """
+
+    def __init__(
+        self,
+        db,
+        resolve_processor,
+        enable,
+        disable,
+        get_state,
+        idle_seconds: int = IDLE_SECONDS,
+        lease_collection: str = LEASE_COLLECTION,
+    ):
+        self.db = db
+        self.resolve_processor = resolve_processor
+        self.enable = enable
+        self.disable = disable
+        self.get_state = get_state
+        self.idle_seconds = idle_seconds
+        self.lease_collection = lease_collection
+
+        self._processor_id = None
+        self._lock = threading.Lock()
+        self._enable_lock = threading.Lock()
+        self._in_flight = 0
+        self._timer = None
+
+    @property
+    def processor_id(self) -> str:
+        """
+        The processor ID, looked up (or created) on first use and cached for the lifetime of the instance.
+        """
+        with self._lock:
+            if self._processor_id is None:
+                processor = self.resolve_processor()
+                self._processor_id = processor.name.split("/")[-1]
+            return self._processor_id
+
+    @property
+    def lease_ref(self):
+        return self.db.collection(self.lease_collection).document(self.processor_id)
+
+    @contextmanager
+    def processor(self):
+        processor_id = self.acquire()
+        try:
+            yield processor_id
+        finally:
+            self.release()
+
+    def acquire(self, detached: bool = False) -> str:
+        """
+        Takes a lease on the processor and makes sure it is enabled. Returns the processor ID.
+        A detached lease is only counted in Firestore, so it can be released by another instance
+        (e.g. once an asynchronous operation completes).
+        """
+        processor_id = self.processor_id
+        if not detached:
+            with self._lock:
+                self._in_flight += 1
+                if self._timer:
+                    self._timer.cancel()
+                    self._timer = None
+
+        self.lease_ref.set(
+            {"in_flight": firestore.Increment(1), "last_acquired": firestore.SERVER_TIMESTAMP},
+            merge=True,
+        )
+
+        try:
+            self._wait_for_disable()
+            self._ensure_enabled(processor_id)
+        except Exception:
+            self.release(detached)
+            raise
+
+        return processor_id
+
+    def release(self, detached: bool = False) -> None:
+        """
+        Releases a lease; the idle timer starts once the last local lease is released.
+        """
+        self.lease_ref.set(
+            {"in_flight": firestore.Increment(-1), "last_released": firestore.SERVER_TIMESTAMP},
+            merge=True,
+        )
+        if detached:
+            return
+
+        with self._lock:
+            self._in_flight -= 1
+            if self._in_flight == 0:
+                self._timer = threading.Timer(self.idle_seconds, self.disable_if_idle)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def disable_if_idle(self) -> bool:
+        """
+        Disables the processor if no instance has used it for `idle_seconds`. Returns True if it was disabled.
+        """
+        with self._lock:
+            if self._in_flight > 0:
+                return False
+
+        if not _claim_idle(self.db.transaction(), self.lease_ref, self.idle_seconds):
+            return False
+
+        print(f"Processor idle for {self.idle_seconds}s, disabling it")
+        try:
+            self.disable(self.processor_id)
+        finally:
+            self.lease_ref.set({"disabling": False}, merge=True)
+        return True
+
+    def _wait_for_disable(self) -> None:
+        # The processor still reports ENABLED for a moment after another instance claimed it
+        # idle; submitting to it then would fail once the disable goes through
+        deadline = time.monotonic() + ENABLE_TIMEOUT
+        while time.monotonic() < deadline:
+            snapshot = self.lease_ref.get()
+            if not _is_disabling(snapshot.to_dict() if snapshot.exists else {}):
+                return
+            print("Processor is being disabled by another instance, waiting...")
+            time.sleep(STATE_POLL_INTERVAL)
+
+    def _ensure_enabled(self, processor_id: str) -> None:
+        # Only one enable operation per instance; concurrent invocations wait for it instead of starting their own
+        with self._enable_lock:
+            deadline = time.monotonic() + ENABLE_TIMEOUT
+            while time.monotonic() < deadline:
+                state = self.get_state(processor_id)
+                if state == ProcessorState.ENABLED:
+                    return
+                if state in (ProcessorState.ENABLING, ProcessorState.DISABLING):
+                    print(f"Processor is {state.name}, waiting...")
+                    time.sleep(STATE_POLL_INTERVAL)
+                    continue
+
+                print("Enabling processor")
+                self.enable(processor_id)
+
+        raise TimeoutError(f"Processor {processor_id} was not enabled within {ENABLE_TIMEOUT}s")
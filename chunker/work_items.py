@@ -0,0 +1,111 @@
+import json
+from typing import List, NamedTuple
+
+import tracing
+
+PAGES_PER_ITEM = 10
+COUNT_FIELD = "work_items"  # Field of the file document with the number of work items published for it
+DONE_FIELD = "indexed_items"  # Map of the work items the indexer has finished, by id
+# Id of the empty item published when every item was indexed before the count was written, so that the indexer
+# still finishes the file (e.g. tombstones the rows of its previous version); not counted in COUNT_FIELD
+FINISH_ITEM_ID = "finish"
+
+
+class WorkItem(NamedTuple):
+    """
+    A range of pages of a document whose paragraphs are written to Firestore and ready to be indexed.
+    """
+    object: str  # The uploaded object, "COLLECTION/FILENAME"
+    id: str  # Unique within the document, and a valid Firestore field name
+    start_page: int
+    end_page: int
+    paragraphs: List[str]  # Ids of the paragraph documents to index
+
+
+def work_item_id(start_page: int, end_page: int) -> str:
+    return f"pages_{start_page}_{end_page}"
+
+
+def publish_work_item(client, topic: str, item: WorkItem):
+    """
+    Publishes a work item to the Pub/Sub topic. Returns the future of the publication.
+    """
+    data = json.dumps(item._asdict()).encode()
+    with tracing.span("work_item_publish", item=item.id) as span:
+        span.add(items=len(item.paragraphs), bytes=len(data), api_calls=1)
+        return client.publish(topic, data)
+
+
+def is_complete(file_data: dict) -> bool:
+    """
+    Whether every work item published for a file has been indexed. The finish item, if any,
+    is recorded on top of the counted ones.
+    """
+    count = file_data.get(COUNT_FIELD)
+    return count is not None and len(file_data.get(DONE_FIELD) or {}) >= count
+
+
+class WorkItemPublisher:
+    """
+    Groups the paragraphs of a document into work items of `pages_per_item` pages while
+    they are being written, and publishes each item to a Pub/Sub topic as soon as its
+    paragraphs are committed, so that the indexer can start on the first pages while the
+    chunker is still extracting the following ones.
+
+    Chunks arrive in page order. An item is published when a chunk starts past its
+    last page, and the remaining paragraphs are published by `close`.
+
+    Usage:
+        publisher = WorkItemPublisher(pubsub_client, topic, writer, object)
+        publisher.add(paragraph_id, page)
+        count = publisher.close()
+    """
+
+    def __init__(self, client, topic: str, writer, object: str, pages_per_item: int = PAGES_PER_ITEM):
+        self.client = client
+        self.topic = topic
+        self.writer = writer
+        self.object = object
+        self.pages_per_item = max(1, pages_per_item)
+
+        self.count = 0
+        self._start_page = None
+        self._end_page = None
+        self._paragraphs = []
+        self._futures = []
+
+    def add(self, paragraph_id: str, page: int) -> None:
+        if self._start_page is not None and page >= self._start_page + self.pages_per_item:
+            self._publish()
+        if self._start_page is None:
+            self._start_page = page
+        self._end_page = page
+        self._paragraphs.append(paragraph_id)
+
+    def _publish(self) -> None:
+        if not self._paragraphs:
+            return
+
+        # The indexer reads the paragraphs from Firestore; they must be committed first
+        with tracing.span("paragraph_wait"):
+            self.writer.wait()
+        item = WorkItem(
+            object=self.object,
+            id=work_item_id(self._start_page, self._end_page),
+            start_page=self._start_page,
+            end_page=self._end_page,
+            paragraphs=self._paragraphs,
+        )
+        self._futures.append(publish_work_item(self.client, self.topic, item))
+        print(f"Published work item {item.id} of {self.object} ({len(item.paragraphs)} paragraphs)")
+        self.count += 1
+        self._start_page, self._end_page, self._paragraphs = None, None, []
+
+    def close(self) -> int:
+        """
+        Publishes the last item and waits until Pub/Sub has accepted every item. Returns the number of items.
+        """
+        self._publish()
+        for future in self._futures:
+            future.result()
+        return self.count
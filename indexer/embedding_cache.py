@@ -0,0 +1,152 @@
+import hashlib
+import math
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import tracing
+
+LOCAL_CACHE_SIZE = 10000  # Embeddings kept in memory per instance
+CACHE_COLLECTION = "embedding_cache"
+FIRESTORE_BATCH_SIZE = 500  # Firestore accepts at most 500 writes per commit
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalizes a text so that copies differing only in unicode form or whitespace
+    (e.g. the same disclaimer extracted from two layouts) share one cache entry.
+    """
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def cache_key(text: str, model_name: str) -> str:
+    """
+    Returns the cache key of a text for a given embedding model.
+    """
+    return hashlib.sha256(f"{model_name}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class FirestoreEmbeddingStore:
+    """
+    Shared cache tier keeping one Firestore document per embedding, keyed by its cache key.
+    """
+
+    def __init__(self, client, collection: str = CACHE_COLLECTION):
+        self.client = client
+        self.collection = client.collection(collection)
+
+    def get_many(self, keys: list) -> dict:
+        found = {}
+        for i in range(0, len(keys), FIRESTORE_BATCH_SIZE):
+            refs = [self.collection.document(key) for key in keys[i : i + FIRESTORE_BATCH_SIZE]]
+            for snapshot in self.client.get_all(refs):
+                if snapshot.exists:
+                    found[snapshot.id] = snapshot.to_dict()["embedding"]
+        return found
+
+    def put_many(self, embeddings: dict, model_name: str) -> None:
+        items = list(embeddings.items())
+        for i in range(0, len(items), FIRESTORE_BATCH_SIZE):
+            write_batch = self.client.batch()
+            for key, embedding in items[i : i + FIRESTORE_BATCH_SIZE]:
+                write_batch.set(self.collection.document(key), {"model": model_name, "embedding": embedding})
+            write_batch.commit()
+
+
+class CachedEmbeddings:
+    """
+    Wraps an embedding model with a content-hash cache. Lookups go to an in-memory LRU
+    tier first, then to the shared store, and only the remaining (deduplicated) texts
+    are sent to the model. New embeddings are written back to both tiers.
+    """
+
+    def __init__(
+        self,
+        embedding_model,
+        model_name: str,
+        shared_store: FirestoreEmbeddingStore = None,
+        local_cache_size: int = LOCAL_CACHE_SIZE,
+    ):
+        self.embedding_model = embedding_model
+        self.model_name = model_name
+        self.shared_store = shared_store
+        self.local_cache_size = local_cache_size
+
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def _get_local(self, key: str):
+        with self._lock:
+            embedding = self._local.get(key)
+            if embedding is not None:
+                self._local.move_to_end(key)
+            return embedding
+
+    def _put_local(self, key: str, embedding: list) -> None:
+        with self._lock:
+            self._local[key] = embedding
+            self._local.move_to_end(key)
+            while len(self._local) > self.local_cache_size:
+                self._local.popitem(last=False)
+
+    def embed_documents(self, texts: list, batch_size: int = 0) -> list:
+        keys = [cache_key(text, self.model_name) for text in texts]
+        found = {}
+        for key in keys:
+            embedding = self._get_local(key)
+            if embedding is not None:
+                found[key] = embedding
+        local_hits = len(found)
+
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        if missing and self.shared_store:
+            shared = self.shared_store.get_many(missing)
+            for key, embedding in shared.items():
+                self._put_local(key, embedding)
+            found.update(shared)
+        shared_hits = len(found) - local_hits
+
+        # Embed every missing text only once, even if it occurs several times in the batch
+        to_embed = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in to_embed:
+                to_embed[key] = text
+        if to_embed:
+            embs = self.embedding_model.embed_documents(list(to_embed.values()), batch_size=batch_size)
+            computed = dict(zip(to_embed, embs))
+            for key, embedding in computed.items():
+                self._put_local(key, embedding)
+            if self.shared_store:
+                self.shared_store.put_many(computed, self.model_name)
+            found.update(computed)
+
+        with self._lock:
+            self.local_hits += local_hits
+            self.shared_hits += shared_hits
+            self.misses += len(to_embed)
+
+        # Counted on the caller's span (the pipeline's embed_batch): the model request and the shared tier's reads and writes
+        api_calls = int(bool(to_embed))
+        if self.shared_store:
+            api_calls += math.ceil(len(missing) / FIRESTORE_BATCH_SIZE) + math.ceil(len(to_embed) / FIRESTORE_BATCH_SIZE)
+        tracing.current().add(cache_hits=local_hits + shared_hits, cache_misses=len(to_embed), api_calls=api_calls)
+
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> list:
+        return self.embed_documents([text])[0]
+
+    def stats(self) -> dict:
+        lookups = self.local_hits + self.shared_hits + self.misses
+        return {
+            "local_hits": self.local_hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.local_hits + self.shared_hits) / lookups, 3) if lookups else 0.0,
+        }
@@ -1,57 +1,191 @@
+import os
+from typing import List, Optional
+
 import functions_framework
 from google.cloud import firestore  # type: ignore
 from google.cloud.firestore_v1.base_query import FieldFilter
-from langchain.vectorstores.utils import DistanceStrategy
-from langchain_community.vectorstores.bigquery_vector_search import BigQueryVectorSearch
-from langchain_google_vertexai import VertexAIEmbeddings
+
+from clients import ClientRegistry
+from embedding_cache import CachedEmbeddings, FirestoreEmbeddingStore
+from pipeline import AdaptiveBatcher, EmbeddingPipeline
+from work_items import complete_work_item, decode_work_item
+import tracing
 
 PROJECT_ID = "YOUR_PROJECT"
 LOCATION = "YOUR_LOCATION"
-BATCH_SIZE = 5  # Currently the batch size is limited to five. See: https://cloud.google.com/vertex-ai/generative-ai/docs/embeddings/get-text-embeddings#get_text_embeddings_for_a_snippet_of_text
+# Maximum number of texts per embedding request. textembedding-gecko@003 accepts up to 250 (only 5 in some regions, where
+# the pipeline lowers it after the first rejected request). See: https://cloud.google.com/vertex-ai/generative-ai/docs/embeddings/get-text-embeddings#get_text_embeddings_for_a_snippet_of_text
+BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 250))
+EMBED_CONCURRENCY = int(os.environ.get("EMBEDDING_CONCURRENCY", 4))
+FIRESTORE_BATCH_SIZE = 500  # Firestore accepts at most 500 writes per commit
+# Set to "true" once the dataset and table exist (e.g. after calling the setup function) to skip creating them on cold start
+BIGQUERY_PROVISIONED = os.environ.get("BIGQUERY_PROVISIONED", "false").lower() == "true"
+
+EMBEDDING_MODEL = "textembedding-gecko@003"
 
 BIGQUERY_DATASET = "gemini_di"  # @param {type: "string"}
 BIGQUERY_TABLE = "doc_and_vectors"  # @param {type: "string"}
+INDEX_STATE_COLLECTION = "index_state"
+# Must match chunker/paragraph_versions.py
+ROW_ID_FIELD = "row_id"  # Field of a paragraph with the id of its row in the vector table
+STALE_ROWS_FIELD = "stale_rows"  # Field of the file document with the number of rows of its previous version to tombstone
+
+# Clients are created on first use rather than at import, see clients.py
+clients = ClientRegistry()
+
+
+@clients.register
+def db():
+    return firestore.Client()
+
+
+@clients.register
+def embeddings():
+    from langchain_google_vertexai import VertexAIEmbeddings
+
+    return VertexAIEmbeddings(model_name=EMBEDDING_MODEL, project=PROJECT_ID, location=LOCATION)
+
+
+@clients.register
+def cached_embeddings():
+    # Embeddings are cached by content hash, in memory for the lifetime of the instance and in Firestore across instances
+    return CachedEmbeddings(embeddings(), EMBEDDING_MODEL, shared_store=FirestoreEmbeddingStore(db()))
+
+
+@clients.register
+def store():
+    return build_store(provisioned=BIGQUERY_PROVISIONED)
+
+
+def build_store(provisioned: bool = False):
+    """
+    Builds the vector store. Unless `provisioned`, the dataset and table are created if they do not exist yet.
+    """
+    from google.cloud import bigquery
+    from langchain.vectorstores.utils import DistanceStrategy
 
-db = firestore.Client()
-embeddings = VertexAIEmbeddings(
-    model_name="textembedding-gecko@003", project=PROJECT_ID, location=LOCATION
-)
+    from vector_table import CollectionVectorSearch
 
-from google.cloud import bigquery
+    if not provisioned:
+        client = bigquery.Client(project=PROJECT_ID, location=LOCATION)
+        client.create_dataset(dataset=BIGQUERY_DATASET, exists_ok=True)
+
+    # Rows are clustered by collection so that queries scoped to one collection only scan its rows
+    return CollectionVectorSearch(
+        project_id=PROJECT_ID,
+        dataset_name=BIGQUERY_DATASET,
+        table_name=BIGQUERY_TABLE,
+        location=LOCATION,
+        embedding=embeddings(),
+        distance_strategy=DistanceStrategy.EUCLIDEAN_DISTANCE,
+        provisioned=provisioned,
+    )
 
-client = bigquery.Client(project=PROJECT_ID, location=LOCATION)
-client.create_dataset(dataset=BIGQUERY_DATASET, exists_ok=True)
 
-store = BigQueryVectorSearch(
-    project_id=PROJECT_ID,
-    dataset_name=BIGQUERY_DATASET,
-    table_name=BIGQUERY_TABLE,
-    location=LOCATION,
-    embedding=embeddings,
-    distance_strategy=DistanceStrategy.EUCLIDEAN_DISTANCE,
-)
+def mark_indexed(rows: list) -> None:
+    """
+    Sets the indexed status to True and records the vector row id for the given
+    `(paragraph reference, row id)` pairs in batched commits.
+    """
+    with tracing.span("mark_indexed") as span:
+        for i in range(0, len(rows), FIRESTORE_BATCH_SIZE):
+            write_batch = db().batch()
+            for reference, row_id in rows[i : i + FIRESTORE_BATCH_SIZE]:
+                write_batch.update(reference, {"indexed": True, ROW_ID_FIELD: row_id})
+            span.add(items=min(FIRESTORE_BATCH_SIZE, len(rows) - i), api_calls=1)
+            write_batch.commit()
+    print(f"Marked {len(rows)} texts as indexed")
 
 
-def batchify_list(original_list, group_size=BATCH_SIZE):
+def bump_index_generation(collection_name: str) -> None:
     """
-    This function converts a list into a list of lists using list comprehension.
+    Records that the rows of a collection in the vector table changed, so the query function
+    refreshes its in-memory indexes and drops the answers it cached for that collection.
+    """
+    db().collection(INDEX_STATE_COLLECTION).document(BIGQUERY_TABLE).set(
+        {
+            "generation": firestore.Increment(1),
+            # A nested map rather than a field path: collection names may contain dots
+            "collections": {collection_name: firestore.Increment(1)},
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        },
+        merge=True,
+    )
 
-    Args:
-        original_list: The original list to be converted.
-        group_size: The maximum number of elements in each sublist.
 
-    Returns:
-        A list of lists, where each sublist has a maximum of 'group_size' elements.
+def index_paragraphs(file_ref, collection_name: str, filename: str, paragraph_ids: Optional[List[str]] = None) -> int:
     """
-    return [
-        original_list[i : i + group_size]
-        for i in range(0, len(original_list), group_size)
+    Embeds the paragraphs of a file that have not been indexed yet and inserts them into the vector table:
+    all of them, or only those of `paragraph_ids`. Returns the number of paragraphs still left to index.
+    """
+    paragraph_ref = file_ref.collection("paragraphs")
+
+    # Filter out any paragraphs that have already been indexed - we only want to index the ones that haven't been indexed yet in order to save unnecessary calls to the Vertex AI Embedding Model
+    with tracing.span("paragraph_read") as span:
+        if paragraph_ids is None:
+            results = paragraph_ref.where(filter=FieldFilter("indexed", "==", False)).stream()
+        else:
+            # A work item may be delivered again after it was (partly) indexed
+            snapshots = db().get_all([paragraph_ref.document(paragraph_id) for paragraph_id in paragraph_ids])
+            results = [snapshot for snapshot in snapshots if snapshot.exists and not snapshot.to_dict().get("indexed")]
+
+        # Get all the texts/paragraphs to index, keeping their document reference so the indexed status can be updated directly
+        paragraphs = [(result.reference, result.to_dict()) for result in results]
+        span.add(items=len(paragraphs), api_calls=1)
+    print(f"Found {len(paragraphs)} texts to index")
+
+    # Embed several batches concurrently while the embedded rows are inserted into BigQuery on a separate thread
+    pipeline = EmbeddingPipeline(
+        embedding_model=cached_embeddings(),
+        store=store(),
+        on_inserted=mark_indexed,
+        batcher=AdaptiveBatcher(max_instances=BATCH_SIZE),
+        concurrency=EMBED_CONCURRENCY,
+    )
+    items = [
+        (data["text"], {"collection": collection_name, "source": filename, "page": data["page"]}, reference)
+        for reference, data in paragraphs
     ]
+    indexed = pipeline.run(items)
+    print(f"Embedding pipeline: {pipeline.stats()}")
+    print(f"Embedding cache: {cached_embeddings().stats()}")
+
+    if indexed:
+        bump_index_generation(collection_name)
+
+    return len(paragraphs) - indexed
+
+
+def tombstone_stale_rows(file_ref, collection_name: str, filename: str) -> int:
+    """
+    Once every paragraph of a file is indexed, tombstones the rows of the file in the vector
+    table that none of its paragraphs refers to: the rows of the chunks a new version of the
+    file changed or removed (and any row inserted twice after a failure). The query function
+    skips tombstoned rows; `compact_vectors` deletes them. Returns the number of rows tombstoned.
+    """
+    if not (file_ref.get().to_dict() or {}).get(STALE_ROWS_FIELD):
+        return 0
+
+    with tracing.span("vector_tombstone") as span:
+        snapshots = file_ref.collection("paragraphs").select([ROW_ID_FIELD]).stream()
+        row_ids = [row_id for row_id in (snapshot.to_dict().get(ROW_ID_FIELD) for snapshot in snapshots) if row_id]
+        count = store().tombstone_stale_rows(collection_name, filename, row_ids)
+        span.add(items=count, api_calls=2)
+    file_ref.update({STALE_ROWS_FIELD: 0})
+    print(f"Tombstoned {count} rows of the previous version of {collection_name}/{filename}")
+
+    if count:
+        bump_index_generation(collection_name)
+    return count
 
 
 @functions_framework.http
+@tracing.traced("indexer")
 def indexer(request) -> tuple:
 
+    # Create the clients this request needs concurrently, so that their cold start round trips overlap
+    clients.warm("db", "cached_embeddings", "store")
+
     # Get the collection name and file name
     request_json = request.get_json(silent=True)
     object = request_json["object"]
@@ -59,44 +193,68 @@ def indexer(request) -> tuple:
     collection_name = object.split("/")[0]
 
     # Set the status of the file to "Indexing..."
-    file_ref = db.collection(collection_name).document(filename)
+    tracing.current().set(object=object)
+    file_ref = db().collection(collection_name).document(filename)
     file_ref.update({"status": "Indexing..."})
 
-    paragraph_ref = file_ref.collection("paragraphs")
-    
-    # Filter out any paragraphs that have already been indexed - we only want to index the ones that haven't been indexed yet in order to save unnecessary calls to the Vertex AI Embedding Model
-    results = paragraph_ref.where(filter=FieldFilter("indexed", "==", False)).stream()
-    
-    # Get all the texts/paragraphs to index
-    texts = [(result.to_dict()["text"], result.to_dict()["page"]) for result in results]
-    print(f"Found {len(texts)} texts to index")
-
-    # Batchify the texts to index - each batch will be indexed in a single request
-    batchified_texts = batchify_list(texts)
-
-    for batch in batchified_texts:
-        metadatas = [{"source": filename, "page": t[1]} for t in batch]
-        texts_to_embed = [t[0] for t in batch]
-        store.add_texts(texts_to_embed, metadatas=metadatas)
-        
-        # Update the indexed status for each item in the batch
-        for item in batch:
-            print(f"Updating indexing status for: {item}")
-            selected_ref = paragraph_ref.where(
-                filter=FieldFilter("text", "==", item[0])
-            ).stream()
-            for doc_ref in selected_ref:
-                # Set the indexed status to True
-                doc_ref.reference.update({"indexed": True})
-
-    results = list(
-        paragraph_ref.where(filter=FieldFilter("indexed", "==", False)).stream()
-    )
+    remaining = index_paragraphs(file_ref, collection_name, filename)
 
-    if len(results) == 0:
+    if remaining == 0:
         print("All texts have been indexed")
-        db.collection(collection_name).document(filename).update({"status": "Indexed"})
+        tombstone_stale_rows(file_ref, collection_name, filename)
+        file_ref.update({"status": "Indexed"})
     else:
-        print(f"Still {len(results)} texts to index")
+        print(f"Still {remaining} texts to index")
 
     return ("Indexing done!", 200)
+
+
+# Subscribed to the chunker's PIPELINE_TOPIC: indexes the documents page range by page range while they are being extracted
+@functions_framework.cloud_event
+@tracing.traced("index_work_item")
+def index_work_item(cloud_event) -> None:
+    """
+    Indexes the paragraphs of one work item published by the chunker. Raising makes Pub/Sub
+    deliver the item again (with retries enabled on the subscription), and only that item;
+    paragraphs that were already indexed are skipped, so a redelivery only redoes what failed.
+    """
+    clients.warm("db", "cached_embeddings", "store")
+
+    item = decode_work_item(cloud_event)
+    tracing.current().set(object=item["object"], item=item["id"])
+    filename = item["object"].split("/")[-1]
+    collection_name = item["object"].split("/")[0]
+    file_ref = db().collection(collection_name).document(filename)
+
+    remaining = index_paragraphs(file_ref, collection_name, filename, item["paragraphs"])
+    if remaining:
+        raise RuntimeError(f"Still {remaining} texts to index in work item {item['id']} of {item['object']}")
+
+    if complete_work_item(file_ref, item["id"]):
+        print(f"All work items of {item['object']} have been indexed")
+        tombstone_stale_rows(file_ref, collection_name, filename)
+
+
+# Triggered by Cloud Scheduler, e.g. once a day
+@functions_framework.http
+@tracing.traced("compact_vectors")
+def compact_vectors(request) -> tuple:
+    """
+    Deletes the tombstoned rows from the vector table, in one transaction for all the files
+    indexed again since the last compaction, instead of one table rewrite per file.
+    """
+    removed = store().compact()
+    tracing.current().set(removed=removed)
+    return (f"Removed {removed} tombstoned rows", 200)
+
+
+# Run once after deployment, so that the indexer can be deployed with BIGQUERY_PROVISIONED=true
+@functions_framework.http
+def setup(request) -> tuple:
+    """
+    Creates the BigQuery dataset, the vector table (with its collection column and clustering) and the
+    tombstone table if they do not exist. Run it again after upgrading, so that the new tables exist
+    before the functions deployed with BIGQUERY_PROVISIONED=true (and the query function) use them.
+    """
+    build_store(provisioned=False)
+    return ("Setup done!", 200)
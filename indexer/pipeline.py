@@ -0,0 +1,259 @@
+import queue
+import re
+import string
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core.exceptions import InvalidArgument, ResourceExhausted
+
+import tracing
+
+# Per-request limits of the text embedding models. See: https://cloud.google.com/vertex-ai/generative-ai/docs/embeddings/get-text-embeddings#get_text_embeddings_for_a_snippet_of_text
+MAX_INSTANCES_PER_REQUEST = 250
+MAX_TOKENS_PER_REQUEST = 20000
+
+EMBED_CONCURRENCY = 4
+INSERT_BATCH_SIZE = 500  # Rows per BigQuery load job
+MAX_RETRIES = 5
+INITIAL_BACKOFF = 1.0  # seconds
+
+_TOKEN_PATTERN = re.compile(f"[{re.escape(string.punctuation)}\\s]|[^{re.escape(string.punctuation)}\\s]+")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Conservatively estimates the number of tokens of a text as twice the number of
+    words, punctuation and whitespace characters (the same heuristic the Vertex AI
+    embeddings client uses, since calling `count_tokens` would cost a request).
+    """
+    return 2 * len(_TOKEN_PATTERN.findall(text))
+
+
+class AdaptiveBatcher:
+    """
+    Decides how many texts go into the next embedding request. The batch size is
+    capped by the model's per-request instance and token limits, halved whenever the
+    model reports a quota error and grown back by one after each successful request.
+
+    The instance limit depends on the region (250 texts in us-central1, only 5 in some
+    others), where a larger request fails with InvalidArgument; `on_instance_limit` lowers
+    the cap below the size of the rejected request.
+    """
+
+    def __init__(
+        self,
+        max_instances: int = MAX_INSTANCES_PER_REQUEST,
+        max_tokens: int = MAX_TOKENS_PER_REQUEST,
+    ):
+        self.max_instances = max_instances
+        self.max_tokens = max_tokens
+        self.batch_size = max_instances
+        self._lock = threading.Lock()
+
+    def take(self, texts: list, start: int) -> int:
+        """
+        Returns the end index of the next batch starting at `start`.
+        """
+        end = start
+        tokens = 0
+        limit = min(len(texts), start + self.batch_size)
+        while end < limit:
+            text_tokens = estimate_tokens(texts[end])
+            # Always take at least one text, even if it is over the token limit, so the API reports the error
+            if end > start and tokens + text_tokens > self.max_tokens:
+                break
+            tokens += text_tokens
+            end += 1
+        return end
+
+    def on_success(self) -> None:
+        with self._lock:
+            self.batch_size = min(self.max_instances, self.batch_size + 1)
+
+    def on_quota_error(self) -> None:
+        with self._lock:
+            self.batch_size = max(1, self.batch_size // 2)
+
+    def on_instance_limit(self, rejected: int) -> None:
+        with self._lock:
+            self.max_instances = max(1, min(self.max_instances, rejected // 2))
+            self.batch_size = min(self.batch_size, self.max_instances)
+
+
+class EmbeddingPipeline:
+    """
+    Embeds texts with several concurrent requests and inserts the results into the
+    vector store on a separate thread, so embedding and BigQuery inserts overlap.
+
+    Every item is a `(text, metadata, payload)` tuple. Once the rows of a set of items
+    have been inserted, `on_inserted` is called with their `(payload, row id)` pairs.
+    """
+
+    def __init__(
+        self,
+        embedding_model,
+        store,
+        on_inserted=None,
+        batcher: AdaptiveBatcher = None,
+        concurrency: int = EMBED_CONCURRENCY,
+        insert_batch_size: int = INSERT_BATCH_SIZE,
+        max_retries: int = MAX_RETRIES,
+        initial_backoff: float = INITIAL_BACKOFF,
+    ):
+        self.embedding_model = embedding_model
+        self.store = store
+        self.on_inserted = on_inserted
+        self.batcher = batcher or AdaptiveBatcher()
+        self.concurrency = concurrency
+        self.insert_batch_size = insert_batch_size
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+
+        self.embed_requests = 0
+        self.quota_errors = 0
+        self.instance_limit_errors = 0
+        self.insert_jobs = 0
+        self._lock = threading.Lock()
+
+    def run(self, items: list) -> int:
+        """
+        Embeds and inserts all `items`. Returns the number of items inserted.
+        """
+        texts = [item[0] for item in items]
+        inserted = queue.Queue(maxsize=self.concurrency * 2)
+        inserter_result = {"count": 0}
+        # Both threads start their spans in the current request's trace
+        inserter = threading.Thread(target=tracing.bind(self._insert_loop), args=(inserted, inserter_result))
+        inserter.start()
+
+        slots = threading.BoundedSemaphore(self.concurrency)
+        futures = []
+        # Set once an embedding request has failed for good, so the rest of the texts are not embedded for nothing
+        embed_failed = threading.Event()
+        embed = tracing.bind(self._embed)
+
+        def on_embedded(future) -> None:
+            if future.exception() is not None:
+                embed_failed.set()
+            slots.release()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                start = 0
+                while start < len(items) and "error" not in inserter_result:
+                    slots.acquire()
+                    if embed_failed.is_set():
+                        slots.release()
+                        break
+                    end = self.batcher.take(texts, start)
+                    future = executor.submit(embed, items[start:end], inserted)
+                    future.add_done_callback(on_embedded)
+                    futures.append(future)
+                    start = end
+
+                for future in futures:
+                    future.result()
+        finally:
+            inserted.put(None)
+            inserter.join()
+
+        if "error" in inserter_result:
+            raise inserter_result["error"]
+
+        return inserter_result["count"]
+
+    def _embed(self, batch: list, inserted: queue.Queue) -> None:
+        """
+        Embeds a batch of items. On a quota error, backs off and splits the batch to the
+        halved batch size; on a request over the region's instance limit (InvalidArgument),
+        splits it right away. Future batches are shrunk the same way.
+        """
+        with tracing.span("embed_batch") as span:
+            span.add(items=len(batch), tokens=sum(estimate_tokens(item[0]) for item in batch))
+            pending = [batch]
+            attempt = 0
+            while pending:
+                part = pending.pop(0)
+                texts = [item[0] for item in part]
+                try:
+                    with self._lock:
+                        self.embed_requests += 1
+                    span.add(requests=1)
+                    embs = self.embedding_model.embed_documents(texts, batch_size=len(texts))
+                except InvalidArgument:
+                    if len(part) == 1:
+                        raise
+                    self.batcher.on_instance_limit(len(part))
+                    with self._lock:
+                        self.instance_limit_errors += 1
+                    span.add(instance_limit_errors=1)
+                    print(f"Embedding request of {len(part)} texts rejected, retrying with batch size {self.batcher.batch_size}")
+                    pending[:0] = self._split(part)
+                    continue
+                except ResourceExhausted:
+                    self.batcher.on_quota_error()
+                    with self._lock:
+                        self.quota_errors += 1
+                    span.add(quota_errors=1)
+                    if attempt == self.max_retries:
+                        raise
+                    delay = self.initial_backoff * 2**attempt
+                    attempt += 1
+                    print(f"Embedding quota exceeded, retrying in {delay:.1f}s with batch size {self.batcher.batch_size}")
+                    time.sleep(delay)
+                    pending[:0] = self._split(part)
+                    continue
+
+                attempt = 0
+                self.batcher.on_success()
+                inserted.put(list(zip(part, embs)))
+
+    def _split(self, part: list) -> list:
+        size = max(1, self.batcher.batch_size)
+        return [part[i : i + size] for i in range(0, len(part), size)]
+
+    def _insert_loop(self, inserted: queue.Queue, result: dict) -> None:
+        """
+        Collects embedded items and inserts them in load jobs of `insert_batch_size` rows.
+        The number of inserted items (or the insert error) is stored in `result`.
+        """
+        buffer = []
+        while True:
+            rows = inserted.get()
+            # Once an insert has failed, keep draining the queue so the embedding workers don't block
+            if rows is not None and "error" not in result:
+                buffer.extend(rows)
+
+            if "error" not in result and buffer and (rows is None or len(buffer) >= self.insert_batch_size):
+                try:
+                    self._insert(buffer)
+                    result["count"] += len(buffer)
+                except Exception as e:
+                    result["error"] = e
+                buffer = []
+
+            if rows is None:
+                return
+
+    def _insert(self, rows: list) -> None:
+        with tracing.span("vector_insert") as span:
+            span.add(items=len(rows), bytes=sum(len(item[0].encode()) for item, _ in rows), api_calls=1)
+            row_ids = self.store.add_texts_with_embeddings(
+                [item[0] for item, _ in rows],
+                [emb for _, emb in rows],
+                metadatas=[item[1] for item, _ in rows],
+            )
+        self.insert_jobs += 1
+
+        if self.on_inserted:
+            self.on_inserted([(item[2], row_id) for (item, _), row_id in zip(rows, row_ids)])
+
+    def stats(self) -> dict:
+        return {
+            "embed_requests": self.embed_requests,
+            "quota_errors": self.quota_errors,
+            "instance_limit_errors": self.instance_limit_errors,
+            "insert_jobs": self.insert_jobs,
+            "batch_size": self.batcher.batch_size,
+        }
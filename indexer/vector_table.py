@@ -0,0 +1,123 @@
+from typing import Any, Dict, List
+
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+from langchain_community.vectorstores.bigquery_vector_search import BigQueryVectorSearch
+
+COLLECTION_COLUMN = "collection"
+# Table of the ids of the rows to skip in searches until `compact` deletes them (must match query/scoped_search.py)
+TOMBSTONE_SUFFIX = "_tombstones"
+
+
+class CollectionVectorSearch(BigQueryVectorSearch):
+    """
+    BigQueryVectorSearch that also writes the "collection" metadata of every row to a
+    top-level column the table is clustered by, so that searches scoped to one collection
+    only read that collection's blocks instead of the whole table.
+
+    The rows of the chunks a new version of a file no longer has are tombstoned rather than
+    deleted one file at a time: every DELETE rewrites the blocks it touches, while the
+    tombstones are cheap appends that `compact` applies to the table in one statement.
+
+    With `provisioned`, the tables are assumed to exist and are only read, instead of being
+    created if missing (one BigQuery call instead of up to five on every cold start).
+    """
+
+    def __init__(self, *args, provisioned: bool = False, **kwargs):
+        self.provisioned = provisioned
+        super().__init__(*args, **kwargs)
+        self.vectors_table = self._initialize_collection_column()
+        self._initialize_tombstone_table()
+
+    @property
+    def tombstone_table_id(self) -> str:
+        return self.full_table_id + TOMBSTONE_SUFFIX
+
+    def _initialize_table(self):
+        if self.provisioned:
+            return self.bq_client.get_table(self.full_table_id)
+        return super()._initialize_table()
+
+    def _initialize_collection_column(self):
+        table = self.vectors_table
+        fields = []
+        if COLLECTION_COLUMN not in {field.name for field in table.schema}:
+            table.schema = [*table.schema, bigquery.SchemaField(COLLECTION_COLUMN, "STRING")]
+            fields.append("schema")
+        if table.clustering_fields != [COLLECTION_COLUMN]:
+            # Only applies to the rows written from now on; existing rows are reclustered by BigQuery over time
+            table.clustering_fields = [COLLECTION_COLUMN]
+            fields.append("clustering_fields")
+        if fields:
+            table = self.bq_client.update_table(table, fields)
+        return table
+
+    def _initialize_tombstone_table(self, force: bool = False) -> None:
+        if self.provisioned and not force:
+            return
+        table = bigquery.Table(
+            self.tombstone_table_id,
+            schema=[
+                bigquery.SchemaField(self.doc_id_field, "STRING", mode="REQUIRED"),
+                bigquery.SchemaField(COLLECTION_COLUMN, "STRING"),
+                bigquery.SchemaField("source", "STRING"),
+                bigquery.SchemaField("deleted_at", "TIMESTAMP", mode="REQUIRED"),
+            ],
+        )
+        self.bq_client.create_table(table, exists_ok=True)
+
+    def tombstone_stale_rows(self, collection: str, source: str, live_ids: List[str]) -> int:
+        """
+        Tombstones the rows of a file that are not in `live_ids` (the rows its paragraphs
+        refer to) and not tombstoned yet. Returns the number of rows tombstoned.
+
+        Rows inserted before the collection column was added only have the collection in
+        their metadata. If the table was provisioned before tombstones existed, it is created.
+        """
+        query = f"""
+            INSERT INTO `{self.tombstone_table_id}` ({self.doc_id_field}, {COLLECTION_COLUMN}, source, deleted_at)
+            SELECT {self.doc_id_field}, {COLLECTION_COLUMN}, @source, CURRENT_TIMESTAMP()
+            FROM `{self.full_table_id}`
+            WHERE ({COLLECTION_COLUMN} = @collection
+                    OR ({COLLECTION_COLUMN} IS NULL AND JSON_VALUE({self.metadata_field}, '$.collection') = @collection))
+                AND JSON_VALUE({self.metadata_field}, '$.source') = @source
+                AND {self.doc_id_field} NOT IN UNNEST(@live_ids)
+                AND {self.doc_id_field} NOT IN (SELECT {self.doc_id_field} FROM `{self.tombstone_table_id}`)
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ScalarQueryParameter("collection", "STRING", collection),
+                bigquery.ScalarQueryParameter("source", "STRING", source),
+                bigquery.ArrayQueryParameter("live_ids", "STRING", live_ids),
+            ]
+        )
+        try:
+            job = self.bq_client.query(query, job_config=job_config)
+            job.result()
+        except NotFound:
+            self._initialize_tombstone_table(force=True)
+            job = self.bq_client.query(query, job_config=job_config)
+            job.result()
+        return job.num_dml_affected_rows or 0
+
+    def compact(self) -> int:
+        """
+        Deletes the tombstoned rows from the table and clears their tombstones, in one
+        transaction. Returns the number of rows deleted.
+        """
+        query = f"""
+            DECLARE removed INT64;
+            BEGIN TRANSACTION;
+            DELETE FROM `{self.full_table_id}`
+            WHERE {self.doc_id_field} IN (SELECT {self.doc_id_field} FROM `{self.tombstone_table_id}`);
+            SET removed = @@row_count;
+            DELETE FROM `{self.tombstone_table_id}` WHERE TRUE;
+            COMMIT TRANSACTION;
+            SELECT removed;
+        """
+        rows = list(self.bq_client.query(query).result())
+        return rows[0]["removed"] if rows else 0
+
+    def _persist(self, data: Dict[str, Any]) -> None:
+        data[COLLECTION_COLUMN] = [(metadata or {}).get(COLLECTION_COLUMN) for metadata in data[self.metadata_field]]
+        super()._persist(data)
@@ -0,0 +1,35 @@
+import base64
+import json
+
+# Must match chunker/work_items.py
+COUNT_FIELD = "work_items"  # Field of the file document with the number of work items published for it
+DONE_FIELD = "indexed_items"  # Map of the work items the indexer has finished, by id
+FINISH_ITEM_ID = "finish"  # Id of the empty item the chunker publishes to have a file finished; not counted in COUNT_FIELD
+
+
+def decode_work_item(cloud_event) -> dict:
+    """
+    Returns the work item published by the chunker from the CloudEvent of its Pub/Sub
+    message: the object ("COLLECTION/FILENAME"), the item id, its pages and the ids of
+    its paragraph documents.
+    """
+    return json.loads(base64.b64decode(cloud_event.data["message"]["data"]))
+
+
+def complete_work_item(file_ref, item_id: str) -> bool:
+    """
+    Records that a work item of a file has been indexed. Recording the same item twice
+    (when Pub/Sub redelivers it) has no effect. Returns whether every work item of the
+    file has now been indexed, in which case its status is set to "Indexed".
+
+    The finish item (FINISH_ITEM_ID) is not part of the count: once it is recorded, the
+    file has one more done item than COUNT_FIELD, which still means complete.
+    """
+    file_ref.set({DONE_FIELD: {item_id: True}}, merge=True)
+    data = file_ref.get().to_dict() or {}
+    count = data.get(COUNT_FIELD)
+    # The count is only written once the chunker has published every item
+    if count is None or len(data.get(DONE_FIELD) or {}) < count:
+        return False
+    file_ref.update({"status": "Indexed"})
+    return True
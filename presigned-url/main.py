@@ -1,8 +1,67 @@
 import datetime
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 import functions_framework
-from google.cloud import storage
+
+from signing import SigningCredentialsCache, SigningSession
+
+BUCKET_NAME = os.environ.get("BUCKET_NAME")
+# Signed URLs are valid for 15 minutes
+URL_EXPIRATION = datetime.timedelta(minutes=15)
+# Maximum number of objects per call of generate_signed_urls
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 1000))
+# Number of URLs signed concurrently; each signature is a call to the IAM signBlob API
+SIGN_CONCURRENCY = int(os.environ.get("SIGN_CONCURRENCY", 16))
+# Files of at least this many bytes get a resumable upload session instead of a signed URL (0 only when asked for)
+RESUMABLE_THRESHOLD = int(os.environ.get("RESUMABLE_THRESHOLD", 0))
+CONTENT_TYPE = "application/octet-stream"
+
+# The signing credentials and storage client are shared by the requests of an instance until shortly before they expire
+sessions = SigningCredentialsCache()
+
+
+def sign_upload_url(session: SigningSession, object_name: str) -> str:
+    """
+    Generates a v4 signed URL for uploading a blob using HTTP PUT.
+    """
+    blob = session.storage_client.bucket(BUCKET_NAME).blob(object_name)
+    return blob.generate_signed_url(
+        version="v4",
+        expiration=URL_EXPIRATION,
+        # Allow PUT requests using this URL.
+        method="PUT",
+        content_type=CONTENT_TYPE,
+        credentials=session.signing_credentials,
+    )
+
+
+def create_upload_session(session: SigningSession, object_name: str, size: Optional[int], origin: Optional[str]) -> str:
+    """
+    Starts a resumable upload of a blob and returns the session URI, to which the file can
+    be uploaded in chunks with HTTP PUT (and resumed after a failure) without credentials.
+    """
+    blob = session.storage_client.bucket(BUCKET_NAME).blob(object_name)
+    return blob.create_resumable_upload_session(content_type=CONTENT_TYPE, size=size, origin=origin)
+
+
+def parse_upload(item) -> dict:
+    """
+    Normalizes an item of the "objects" list of a batch request: an object name, or
+    {"object_name": ..., "size": ..., "resumable": ...}.
+    """
+    if isinstance(item, str):
+        item = {"object_name": item}
+    if not isinstance(item, dict) or not isinstance(item.get("object_name"), str) or not item["object_name"]:
+        raise ValueError(f"Invalid object: {item!r}")
+    size = item.get("size")
+    # bool is a subclass of int: reject true/false as a size
+    if size is not None and (not isinstance(size, int) or isinstance(size, bool) or size < 0):
+        raise ValueError(f"Invalid size of {item['object_name']}: {size!r}")
+    resumable = bool(item.get("resumable")) or bool(RESUMABLE_THRESHOLD and size is not None and size >= RESUMABLE_THRESHOLD)
+    return {"object_name": item["object_name"], "size": size, "resumable": resumable}
 
 
 @functions_framework.http
@@ -13,11 +72,6 @@ def generate_signed_url(
     """
     Generates a v4 signed URL for uploading a blob using HTTP PUT.
     """
-    request_json = request.get_json(silent=True)
-
-    object_name = f'{request_json["collection_name"]}/{request_json["object_name"]}'
-    bucket_name = os.environ.get("BUCKET_NAME")
-
     # For more information about CORS and CORS preflight requests, see:
     # https://developer.mozilla.org/en-US/docs/Glossary/Preflight_request
 
@@ -37,38 +91,10 @@ def generate_signed_url(
     # Set CORS headers for the main request
     headers = {"Access-Control-Allow-Origin": "*"}
 
-    import google.auth
-
-    credentials, _ = google.auth.default()
-
-    # Perform a refresh request to get the access token of the current credentials (Else, it's None)
-    from google.auth.transport import requests
-
-    r = requests.Request()
-    credentials.refresh(r)
-
-    service_account_email = credentials.service_account_email
-
-    # Get your IDTokenCredentials
-    from google.auth import compute_engine
-
-    signing_credentials = compute_engine.IDTokenCredentials(
-        r, "", service_account_email=service_account_email
-    )
+    request_json = request.get_json(silent=True)
+    object_name = f'{request_json["collection_name"]}/{request_json["object_name"]}'
 
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(object_name)
-
-    url = blob.generate_signed_url(
-        version="v4",
-        # This URL is valid for 15 minutes
-        expiration=datetime.timedelta(minutes=15),
-        # Allow PUT requests using this URL.
-        method="PUT",
-        content_type="application/octet-stream",
-        credentials=signing_credentials,
-    )
+    url = sessions.run(lambda session: sign_upload_url(session, object_name))
 
     print("Generated PUT signed URL:")
     print(url)
@@ -78,3 +104,59 @@ def generate_signed_url(
         "--upload-file my-file '{}'".format(url)
     )
     return url
+
+
+@functions_framework.http
+def generate_signed_urls(request) -> tuple:
+    """
+    Generates the upload URLs of several files of a collection in one call. The request body
+    has the "collection_name" and the "objects" to upload: object names, or objects with an
+    "object_name", an optional "size" in bytes and "resumable" set to true to get a resumable
+    upload session (for large files) rather than a signed PUT URL. The URLs are returned in
+    the order of the objects, e.g.:
+
+        {"expires_at": "...", "urls": [{"object_name": "a.pdf", "method": "PUT", "url": "..."}]}
+    """
+    # Set CORS headers for the preflight request
+    if request.method == "OPTIONS":
+        headers = {
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Methods": "POST",
+            "Access-Control-Allow-Headers": "Content-Type",
+            "Access-Control-Max-Age": "3600",
+        }
+        return ("", 204, headers)
+
+    headers = {"Access-Control-Allow-Origin": "*", "Content-Type": "application/json"}
+
+    request_json = request.get_json(silent=True) or {}
+    collection_name = request_json.get("collection_name")
+    objects = request_json.get("objects")
+    try:
+        if not collection_name or not isinstance(objects, list) or not objects:
+            raise ValueError('The request body must have a "collection_name" and a non-empty list of "objects"')
+        if len(objects) > MAX_BATCH_SIZE:
+            raise ValueError(f"At most {MAX_BATCH_SIZE} objects can be requested at once, got {len(objects)}")
+        uploads = [parse_upload(item) for item in objects]
+    except ValueError as err:
+        return (json.dumps({"error": str(err)}), 400, headers)
+
+    # Resumable sessions only accept uploads from the origin they were created for
+    origin = request.headers.get("Origin")
+
+    def upload_url(upload: dict) -> dict:
+        object_name = f'{collection_name}/{upload["object_name"]}'
+        if upload["resumable"]:
+            url = sessions.run(lambda session: create_upload_session(session, object_name, upload["size"], origin))
+            return {"object_name": upload["object_name"], "method": "RESUMABLE", "url": url}
+        url = sessions.run(lambda session: sign_upload_url(session, object_name))
+        return {"object_name": upload["object_name"], "method": "PUT", "url": url}
+
+    # Each URL costs a round trip to IAM (or to Cloud Storage for a resumable session); overlap them
+    with ThreadPoolExecutor(max_workers=max(1, min(SIGN_CONCURRENCY, len(uploads)))) as executor:
+        urls = list(executor.map(upload_url, uploads))
+
+    # Expiry of the signed URLs; resumable sessions stay valid for a week
+    expires_at = datetime.datetime.now(datetime.timezone.utc) + URL_EXPIRATION
+    print(f"Generated {len(urls)} upload URLs for {collection_name}")
+    return (json.dumps({"expires_at": expires_at.isoformat(), "urls": urls}), 200, headers)
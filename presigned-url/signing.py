@@ -0,0 +1,101 @@
+import datetime
+import threading
+from typing import Any, Callable, NamedTuple, Optional, TypeVar
+
+# Credentials are replaced this long before their access token expires, so that a URL is never signed with a token about to expire
+REFRESH_MARGIN = datetime.timedelta(minutes=5)
+# Assumed lifetime of credentials that do not report their expiry
+DEFAULT_LIFETIME = datetime.timedelta(minutes=55)
+
+T = TypeVar("T")
+
+
+class SigningSession(NamedTuple):
+    storage_client: Any
+    signing_credentials: Any  # Signs the URLs with the IAM signBlob API, as the function's service account
+    expiry: datetime.datetime  # Naive UTC, like google-auth's
+
+
+def create_session() -> SigningSession:
+    """
+    Refreshes the default credentials and builds the signing credentials and the storage client.
+    """
+    import google.auth
+    from google.auth import compute_engine
+    from google.auth.transport import requests
+    from google.cloud import storage
+
+    credentials, _ = google.auth.default()
+
+    # Perform a refresh request to get the access token of the current credentials (Else, it's None)
+    r = requests.Request()
+    credentials.refresh(r)
+
+    # Get your IDTokenCredentials
+    signing_credentials = compute_engine.IDTokenCredentials(
+        r, "", service_account_email=credentials.service_account_email
+    )
+    expiry = credentials.expiry or datetime.datetime.utcnow() + DEFAULT_LIFETIME
+    return SigningSession(storage.Client(), signing_credentials, expiry)
+
+
+class SigningCredentialsCache:
+    """
+    Keeps the signing credentials and the storage client of an instance, and builds them
+    again only once the access token is within `refresh_margin` of its expiry, instead
+    of refreshing the credentials for every URL. Safe to share between threads.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[], SigningSession] = create_session,
+        refresh_margin: datetime.timedelta = REFRESH_MARGIN,
+        now: Callable[[], datetime.datetime] = datetime.datetime.utcnow,
+    ):
+        self.factory = factory
+        self.refresh_margin = refresh_margin
+        self.now = now
+        self.refreshes = 0
+        self._session: Optional[SigningSession] = None
+        self._lock = threading.Lock()
+
+    def _valid(self, session: Optional[SigningSession]) -> bool:
+        return session is not None and self.now() < session.expiry - self.refresh_margin
+
+    def get(self) -> SigningSession:
+        session = self._session
+        if self._valid(session):
+            return session
+        with self._lock:
+            # Another thread may have refreshed it while this one was waiting
+            if not self._valid(self._session):
+                self._session = self.factory()
+                self.refreshes += 1
+            return self._session
+
+    def invalidate(self, session: Optional[SigningSession] = None) -> None:
+        """
+        Drops the cached session, e.g. after the credentials were rejected. With `session`,
+        only drops it if it is still the cached one, so that threads failing with the same
+        session replace it once.
+        """
+        with self._lock:
+            if session is None or self._session is session:
+                self._session = None
+
+    def run(self, action: Callable[[SigningSession], T]) -> T:
+        """
+        Calls `action` with the cached session. If the credentials are rejected (expired or
+        revoked before their reported expiry), builds a new session and calls it once more.
+        """
+        from google.api_core.exceptions import Unauthorized
+        from google.auth.exceptions import RefreshError, TransportError
+
+        session = self.get()
+        try:
+            return action(session)
+        # The IAM signBlob API reports rejected credentials as a TransportError
+        except (RefreshError, TransportError, Unauthorized) as e:
+            print(f"Signing failed, refreshing the signing credentials: {e}")
+            self.invalidate(session)
+            return action(self.get())
@@ -0,0 +1,240 @@
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+CACHE_SIZE = 1000  # Answers kept in memory per instance
+CACHE_TTL = 3600  # Seconds an answer is served from the cache
+SIMILARITY_THRESHOLD = 0.95  # Minimum cosine similarity of two questions sharing an answer
+GENERATION_CHECK_SECONDS = 10  # How often the index generation is read from Firestore
+INDEX_STATE_COLLECTION = "index_state"
+QUERY_EMBEDDING_CACHE_SIZE = 1000
+
+_WHITESPACE = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = re.compile(r"[\s?!.]+$")
+
+
+def normalize_question(question: str) -> str:
+    """
+    Normalizes a question so that copies differing only in case, unicode form, whitespace
+    or trailing punctuation share one cache entry.
+    """
+    question = _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", question)).strip().lower()
+    return _TRAILING_PUNCTUATION.sub("", question)
+
+
+class CachedAnswer(NamedTuple):
+    answer: dict
+    embedding: np.ndarray  # Unit length, None if the question was never embedded
+    generation: int
+    expires_at: float
+    scope: str = ""
+    collection: Optional[str] = None  # The collection the scope is restricted to, None for all of them
+
+
+class IndexGeneration:
+    """
+    Reads the generation counters the indexer increments every time the vector table
+    changes: one for the whole table and one per collection. The values are only read
+    from Firestore every `check_seconds` seconds.
+    """
+
+    def __init__(self, db, table: str, collection: str = INDEX_STATE_COLLECTION, check_seconds: float = GENERATION_CHECK_SECONDS):
+        self.ref = db.collection(collection).document(table)
+        self.check_seconds = check_seconds
+        self._state = {}
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def current(self, collection: Optional[str] = None) -> int:
+        """
+        Returns the generation of the rows of `collection`, or of the whole table if None.
+        """
+        with self._lock:
+            if self._checked_at is None or time.monotonic() - self._checked_at >= self.check_seconds:
+                snapshot = self.ref.get()
+                self._state = (snapshot.to_dict() or {}) if snapshot.exists else {}
+                self._checked_at = time.monotonic()
+            if collection is None:
+                return self._state.get("generation", 0)
+            return self._state.get("collections", {}).get(collection, 0)
+
+
+class MemoizedQueryEmbeddings(Embeddings):
+    """
+    Remembers the embeddings of the last questions, so that a question embedded for a
+    semantic cache lookup is not embedded again by the retriever on a cache miss.
+    """
+
+    def __init__(self, embeddings: Embeddings, size: int = QUERY_EMBEDDING_CACHE_SIZE):
+        self.embeddings = embeddings
+        self.size = size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        with self._lock:
+            if text in self._cache:
+                self._cache.move_to_end(text)
+                return self._cache[text]
+
+        embedding = self.embeddings.embed_query(text)
+        with self._lock:
+            self._cache[text] = embedding
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+        return embedding
+
+
+class AnswerCache:
+    """
+    In-memory cache of the answers given by an instance, in front of the question answering chain.
+
+    Lookups first try the normalized question (no model call at all), then compare the
+    question's embedding with the embeddings of the cached questions and reuse the answer
+    of the most similar one if its cosine similarity is at least `similarity_threshold`.
+    Entries expire after `ttl` seconds, the least recently used ones are evicted beyond
+    `size` entries, and entries are dropped when the generation of the rows they were
+    answered from changes: that of their `collection` if their scope is restricted to
+    one, that of the whole index otherwise. Answers are only shared between questions
+    of the same `scope` (e.g. the search filter).
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        generation=lambda collection=None: 0,
+        size: int = CACHE_SIZE,
+        ttl: float = CACHE_TTL,
+        similarity_threshold: float = SIMILARITY_THRESHOLD,
+    ):
+        self.embeddings = embeddings
+        self.generation = generation
+        self.size = size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+
+        self._entries = OrderedDict()
+        self._matrix = None  # Stacked embeddings of the cached questions, rebuilt after changes
+        self._matrix_keys = []
+        self._matrix_scopes = None
+        self._lock = threading.Lock()
+        self._stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "invalidations": 0}
+
+    def _generations(self, collection: Optional[str]) -> dict:
+        # Read outside the cache lock: the generations may come from Firestore
+        with self._lock:
+            collections = {entry.collection for entry in self._entries.values()}
+        collections.add(collection)
+        return {collection: self.generation(collection) for collection in collections}
+
+    def _check_generation(self, generations: dict) -> None:
+        # Drop what was cached against an older version of the rows it was answered from
+        stale = [
+            key
+            for key, entry in self._entries.items()
+            if entry.collection in generations and entry.generation != generations[entry.collection]
+        ]
+        if stale:
+            for key in stale:
+                del self._entries[key]
+            self._matrix = None
+            self._stats["invalidations"] += 1
+
+    def _embed(self, question: str) -> np.ndarray:
+        embedding = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    def _live(self, key: str, entry: CachedAnswer, now: float) -> bool:
+        if entry.expires_at > now:
+            return True
+        del self._entries[key]
+        self._matrix = None
+        return False
+
+    def _nearest(self, embedding: np.ndarray, scope: str, now: float):
+        if self._matrix is None:
+            self._matrix_keys = [key for key, entry in self._entries.items() if entry.embedding is not None]
+            self._matrix = (
+                np.stack([self._entries[key].embedding for key in self._matrix_keys])
+                if self._matrix_keys
+                else np.empty((0, embedding.shape[0]), dtype=np.float32)
+            )
+            self._matrix_scopes = np.array([self._entries[key].scope for key in self._matrix_keys], dtype=object)
+        if not self._matrix_keys:
+            return None, None
+
+        similarities = np.where(self._matrix_scopes == scope, self._matrix @ embedding, -np.inf)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            return None, None
+        key = self._matrix_keys[best]
+        entry = self._entries.get(key)
+        if entry is None or not self._live(key, entry, now):
+            return None, None
+        return key, entry
+
+    def lookup(self, question: str, semantic: bool = True, scope: str = "", collection: Optional[str] = None):
+        """
+        Returns the cached answer for a question (with a "cache" field set to "exact" or
+        "semantic"), or None on a miss. `collection` is the collection the scope restricts
+        the search to, if any.
+        """
+        key = f"{scope}\0{normalize_question(question)}"
+        generations = self._generations(collection)
+        now = time.monotonic()
+        with self._lock:
+            self._check_generation(generations)
+            entry = self._entries.get(key)
+            if entry is not None and self._live(key, entry, now):
+                self._entries.move_to_end(key)
+                self._stats["exact_hits"] += 1
+                return {**entry.answer, "cache": "exact"}
+            has_embeddings = any(entry.embedding is not None for entry in self._entries.values())
+
+        if not semantic or not has_embeddings:
+            with self._lock:
+                self._stats["misses"] += 1
+            return None
+
+        embedding = self._embed(question)
+        with self._lock:
+            key, entry = self._nearest(embedding, scope, now)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["semantic_hits"] += 1
+            return {**entry.answer, "cache": "semantic"}
+
+    def store(self, question: str, answer: dict, semantic: bool = True, scope: str = "", collection: Optional[str] = None) -> None:
+        """
+        Caches the answer to a question. Its embedding is only computed if the semantic tier is used.
+        """
+        generations = self._generations(collection)
+        embedding = self._embed(question) if semantic else None
+        with self._lock:
+            self._check_generation(generations)
+            key = f"{scope}\0{normalize_question(question)}"
+            self._entries[key] = CachedAnswer(
+                answer, embedding, generations[collection], time.monotonic() + self.ttl, scope, collection
+            )
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._stats["exact_hits"] + self._stats["semantic_hits"] + self._stats["misses"]
+            hits = lookups - self._stats["misses"]
+            return {**self._stats, "entries": len(self._entries), "hit_rate": round(hits / lookups, 3) if lookups else 0.0}
@@ -0,0 +1,158 @@
+import math
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from langchain.chains.combine_documents.base import BaseCombineDocumentsChain
+from langchain.chains.combine_documents.stuff import StuffDocumentsChain
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.documents import Document
+
+import tracing
+
+STUFF = "stuff"
+MAP_REDUCE = "map_reduce"
+REFINE = "refine"
+AUTO = "auto"
+STRATEGIES = (AUTO, STUFF, MAP_REDUCE, REFINE)
+# Tags of the chain steps making LLM calls; the spans of their calls are named "llm_<tag>"
+STAGE_TAGS = ("stuff", "map", "reduce", "refine")
+
+# Gemini Pro accepts 30720 input tokens; keep some room for the estimate's error
+CONTEXT_TOKEN_BUDGET = 28000
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimates the number of tokens of a text (about four characters per token), without
+    the round trip to the model's token counting endpoint.
+    """
+    return math.ceil(len(text) / 4)
+
+
+class LLMCallCounter(BaseCallbackHandler):
+    """
+    Counts the LLM calls made while answering a single query.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _count(self) -> None:
+        with self._lock:
+            self.calls += 1
+
+    def on_llm_start(self, serialized, prompts, **kwargs: Any) -> None:
+        self._count()
+
+    def on_chat_model_start(self, serialized, messages, **kwargs: Any) -> None:
+        self._count()
+
+
+class SpanCallbackHandler(BaseCallbackHandler):
+    """
+    Records the retrieval and every LLM call of a chain run as spans of the request's
+    trace, under `parent`. An LLM call is named after the step making it ("llm_map",
+    "llm_reduce", ...): the tag of the call itself or of its closest tagged parent chain
+    (see STAGE_TAGS). Token counts are estimates, like the rest of this module's.
+    """
+
+    def __init__(self, parent: tracing.Span):
+        self.parent = parent
+        self._spans: Dict[UUID, tracing.Span] = {}
+        # Parent and stage tag of the chain runs in progress
+        self._chains: Dict[UUID, Tuple[Optional[UUID], Optional[str]]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _stage(tags: Optional[List[str]]) -> Optional[str]:
+        return next((tag for tag in tags or () if tag in STAGE_TAGS), None)
+
+    def _start(self, run_id: UUID, name: str, **counters: float) -> None:
+        span = tracing.span(name, parent=self.parent)
+        span.add(**counters)
+        with self._lock:
+            self._spans[run_id] = span
+
+    def _end(self, run_id: UUID, error: Optional[BaseException] = None, **counters: float) -> None:
+        with self._lock:
+            span = self._spans.pop(run_id, None)
+        if span is not None:
+            span.add(**counters)
+            span.end(error)
+
+    def _start_llm(self, run_id: UUID, parent_run_id: Optional[UUID], tags: Optional[List[str]], tokens: int) -> None:
+        stage = self._stage(tags)
+        with self._lock:
+            while stage is None and parent_run_id in self._chains:
+                parent_run_id, stage = self._chains[parent_run_id]
+        self._start(run_id, f"llm_{stage}" if stage else "llm", tokens=tokens, api_calls=1)
+
+    def on_chain_start(self, serialized, inputs, *, run_id: UUID, parent_run_id: Optional[UUID] = None, tags=None, **kwargs: Any) -> None:
+        with self._lock:
+            self._chains[run_id] = (parent_run_id, self._stage(tags))
+
+    def on_chain_end(self, outputs, *, run_id: UUID, **kwargs: Any) -> None:
+        with self._lock:
+            self._chains.pop(run_id, None)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        with self._lock:
+            self._chains.pop(run_id, None)
+
+    def on_retriever_start(self, serialized, query: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self._start(run_id, "retrieval")
+
+    def on_retriever_end(self, documents, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, items=len(documents), bytes=sum(len(document.page_content.encode()) for document in documents))
+
+    def on_retriever_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, error)
+
+    def on_llm_start(self, serialized, prompts, *, run_id: UUID, parent_run_id: Optional[UUID] = None, tags=None, **kwargs: Any) -> None:
+        self._start_llm(run_id, parent_run_id, tags, sum(estimate_tokens(prompt) for prompt in prompts))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, parent_run_id: Optional[UUID] = None, tags=None, **kwargs: Any) -> None:
+        tokens = sum(estimate_tokens(str(message.content)) for batch in messages for message in batch)
+        self._start_llm(run_id, parent_run_id, tags, tokens)
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs: Any) -> None:
+        tokens = sum(estimate_tokens(generation.text) for generations in response.generations for generation in generations)
+        self._end(run_id, tokens=tokens)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, error)
+
+
+class BudgetedCombineDocumentsChain(BaseCombineDocumentsChain):
+    """
+    Stuffs all retrieved documents into a single prompt (one LLM call) when the prompt
+    fits in `token_budget` tokens, and falls back to `fallback_chain` (e.g. map_reduce)
+    when it does not.
+    """
+
+    stuff_chain: StuffDocumentsChain
+    fallback_chain: BaseCombineDocumentsChain
+    token_budget: int = CONTEXT_TOKEN_BUDGET
+
+    def fits(self, docs: List[Document], **kwargs: Any) -> bool:
+        inputs = self.stuff_chain._get_inputs(docs, **kwargs)
+        prompt = self.stuff_chain.llm_chain.prompt.format(**inputs)
+        return estimate_tokens(prompt) <= self.token_budget
+
+    def _select(self, docs: List[Document], **kwargs: Any) -> BaseCombineDocumentsChain:
+        # Recorded on the request's span instead of logged on every request
+        chain = self.stuff_chain if self.fits(docs, **kwargs) else self.fallback_chain
+        tracing.current().set(answer_chain=chain._chain_type, answer_documents=len(docs))
+        return chain
+
+    def combine_docs(self, docs: List[Document], callbacks=None, **kwargs: Any) -> Tuple[str, dict]:
+        return self._select(docs, **kwargs).combine_docs(docs, callbacks=callbacks, **kwargs)
+
+    async def acombine_docs(self, docs: List[Document], callbacks=None, **kwargs: Any) -> Tuple[str, dict]:
+        return await self._select(docs, **kwargs).acombine_docs(docs, callbacks=callbacks, **kwargs)
+
+    @property
+    def _chain_type(self) -> str:
+        return "budgeted_combine_documents_chain"
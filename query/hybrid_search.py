@@ -0,0 +1,114 @@
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+
+from lexical_index import LexicalIndex, tokenize
+import tracing
+
+RRF_K = 60  # Rank offset of reciprocal rank fusion; dampens the weight of the top ranks of each list
+HYBRID_CANDIDATES = 20  # Documents taken from each of the vector and keyword searches before fusion
+
+
+def document_key(document: Document) -> tuple:
+    """
+    Identifies the paragraph a document was made from, so the same paragraph found by
+    both searches is counted once. The vector table rows hold the paragraph text as is,
+    so the text and the file it comes from identify it in both; files are named within
+    a collection, so same-named files of different collections stay apart.
+    """
+    return document.metadata.get("collection"), document.metadata.get("source"), document.page_content
+
+
+def reciprocal_rank_fusion(rankings: Sequence[List[Document]], rrf_k: int = RRF_K) -> List[tuple]:
+    """
+    Fuses ranked lists of documents into one: every document scores 1 / (rrf_k + rank) for
+    each list it appears in. Only ranks are used, so the BM25 scores and vector distances
+    need no calibration against each other. Returns (document, score) pairs, best first;
+    a document found by several lists keeps the first list's copy (and its metadata).
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking, start=1):
+            key = document_key(document)
+            if key not in fused:
+                fused[key] = [document, 0.0]
+            fused[key][1] += 1.0 / (rrf_k + rank)
+    return sorted((tuple(pair) for pair in fused.values()), key=lambda pair: -pair[1])
+
+
+class TermOverlapReranker:
+    """
+    Cheap reranker for the fused candidates: boosts documents containing more of the
+    question's terms, weighted by their inverse document frequency in the keyword index.
+    Rare terms such as contract numbers or product codes therefore dominate, while common
+    words barely count. No model call is involved, so it adds well under a millisecond.
+    """
+
+    def __init__(self, lexical_index: LexicalIndex, weight: float = 1.0):
+        self.lexical_index = lexical_index
+        self.weight = weight
+
+    def __call__(self, query: str, scored: List[tuple]) -> List[tuple]:
+        idf = self.lexical_index.idf
+        terms = {term: idf.get(term, 0.0) for term in set(tokenize(query))}
+        total = sum(terms.values())
+        if not scored or not total:
+            return scored
+
+        best = scored[0][1]
+        reranked = []
+        for document, score in scored:
+            document_terms = set(tokenize(document.page_content))
+            coverage = sum(weight for term, weight in terms.items() if term in document_terms) / total
+            reranked.append((document, score / best + self.weight * coverage))
+        return sorted(reranked, key=lambda pair: -pair[1])
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Retriever combining the vector search with the keyword index: the `candidates` best
+    documents of each are fused by reciprocal rank fusion, optionally reranked, and the
+    top `k` are returned. Embeddings find paraphrases, keywords find exact identifiers
+    the embeddings blur; a question needs either one to surface its paragraph.
+
+    Like VectorStoreRetriever, it takes its "k" and "filter" from `search_kwargs`, so
+    ScopedRetrievalQAWithSourcesChain can scope each call to a collection or source.
+    """
+
+    vectorstore: VectorStore
+    lexical_index: Any
+    search_kwargs: Dict[str, Any] = {"k": 4}
+    candidates: int = HYBRID_CANDIDATES
+    rrf_k: int = RRF_K
+    reranker: Optional[Callable[[str, List[tuple]], List[tuple]]] = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(self, query: str, *, run_manager) -> List[Document]:
+        k = self.search_kwargs.get("k", 4)
+        search_filter = self.search_kwargs.get("filter")
+        candidates = max(k, self.candidates)
+
+        with tracing.span("vector_search") as span:
+            vector_documents = self.vectorstore.similarity_search(query, k=candidates, filter=search_filter)
+            span.add(items=len(vector_documents))
+        try:
+            with tracing.span("keyword_search") as span:
+                keyword_documents = [
+                    document for document, _ in self.lexical_index.search(query, k=candidates, filter=search_filter)
+                ]
+                span.add(items=len(keyword_documents))
+        except Exception as e:
+            # Without the keyword index, answer from the vector search alone
+            print(f"Keyword search failed, using the vector search only: {e}")
+            keyword_documents = []
+
+        # Vector documents first: they carry the distance to the question
+        scored = reciprocal_rank_fusion([vector_documents, keyword_documents], self.rrf_k)
+        if self.reranker:
+            scored = self.reranker(query, scored)
+        # The keyword index shares its documents between calls; return copies
+        return [Document(page_content=document.page_content, metadata=dict(document.metadata)) for document, _ in scored[:k]]
@@ -0,0 +1,179 @@
+import math
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+PARAGRAPHS_COLLECTION = "paragraphs"
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Words and identifiers; separators inside identifiers (CN-2024/118, A.4.2) are kept so they match as one term
+_TOKEN = re.compile(r"[0-9A-Za-z]+(?:[-_/.][0-9A-Za-z]+)*")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lower-cased terms of a text. Identifiers are indexed both whole and split into their
+    parts, so "CN-2024-118" is found by "CN-2024-118" as well as by "2024-118" or "118".
+    """
+    terms = []
+    for match in _TOKEN.finditer(text.lower()):
+        term = match.group()
+        terms.append(term)
+        if not term.isalnum():
+            terms.extend(part for part in re.split(r"[-_/.]", term) if part)
+    return terms
+
+
+class LexicalTerms(NamedTuple):
+    """
+    The BM25 index of one generation of the paragraphs, replaced as a whole so that a
+    search never mixes the postings of two generations.
+    """
+
+    documents: List[Document]
+    postings: dict  # term -> (document numbers, term frequencies)
+    lengths: np.ndarray
+    idf: dict
+
+
+class LexicalIndex:
+    """
+    In-memory BM25 index of the paragraph texts the chunker writes to Firestore, used to
+    find exact terms (contract numbers, product codes, ...) that embeddings tend to miss.
+
+    The paragraphs of all collections are read with a collection group query, and the
+    index is rebuilt when the index generation changes. Searches start that rebuild on a
+    background thread and keep using the index already built until it is done.
+    """
+
+    def __init__(self, db, generation=lambda: 0, k1: float = BM25_K1, b: float = BM25_B):
+        self.db = db
+        self.generation = generation
+        self.k1 = k1
+        self.b = b
+
+        self.terms = LexicalTerms([], {}, np.empty(0, dtype=np.float32), {})
+        self.loaded_generation = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    @property
+    def documents(self) -> List[Document]:
+        return self.terms.documents
+
+    @property
+    def idf(self) -> dict:
+        return self.terms.idf
+
+    def _read_paragraphs(self) -> List[Document]:
+        documents = []
+        for snapshot in self.db.collection_group(PARAGRAPHS_COLLECTION).stream():
+            data = snapshot.to_dict()
+            # Only paragraphs that are also in the vector table
+            if not data.get("indexed"):
+                continue
+            file_ref = snapshot.reference.parent.parent
+            documents.append(
+                Document(
+                    page_content=data["text"],
+                    metadata={
+                        "collection": file_ref.parent.id,
+                        "source": file_ref.id,
+                        "page": data.get("page"),
+                        "paragraph": snapshot.id,
+                    },
+                )
+            )
+        return documents
+
+    def build(self, documents: List[Document]) -> None:
+        postings = defaultdict(lambda: ([], []))
+        lengths = []
+        for number, document in enumerate(documents):
+            terms = Counter(tokenize(document.page_content))
+            lengths.append(sum(terms.values()))
+            for term, frequency in terms.items():
+                numbers, frequencies = postings[term]
+                numbers.append(number)
+                frequencies.append(frequency)
+
+        postings = {
+            term: (np.asarray(numbers, dtype=np.int64), np.asarray(frequencies, dtype=np.float32))
+            for term, (numbers, frequencies) in postings.items()
+        }
+        count = len(documents)
+        idf = {
+            term: math.log(1 + (count - len(numbers) + 0.5) / (len(numbers) + 0.5))
+            for term, (numbers, _) in postings.items()
+        }
+        self.terms = LexicalTerms(documents, postings, np.asarray(lengths, dtype=np.float32), idf)
+
+    def load(self, wait: bool = True) -> None:
+        """
+        Builds the index from Firestore, unless it is already up to date with the index
+        generation. Only one build runs at a time. With `wait=False` (on every search), the
+        build runs on a background thread and the index already built keeps being searched.
+        """
+        generation = self.generation()
+        with self._lock:
+            if self.loaded_generation == generation or self._refreshing:
+                return
+            self._refreshing = True
+
+        if wait:
+            self._load(generation)
+        else:
+            threading.Thread(target=self._load_in_background, args=(generation,), daemon=True).start()
+
+    def _load(self, generation: int) -> None:
+        try:
+            started = time.monotonic()
+            self.build(self._read_paragraphs())
+            self.loaded_generation = generation
+            print(f"Lexical index: {len(self.documents)} paragraphs, {len(self.terms.postings)} terms, built in {time.monotonic() - started:.2f}s")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _load_in_background(self, generation: int) -> None:
+        try:
+            self._load(generation)
+        except Exception as e:
+            # Retried by the next search if the generation is still not loaded
+            print(f"Could not rebuild the keyword index: {e}")
+
+    def search(self, query: str, k: int = 4, filter: Optional[Dict[str, str]] = None) -> List[Tuple[Document, float]]:
+        """
+        Returns the `k` paragraphs with the highest BM25 score for the query (and matching the
+        metadata `filter`), best first.
+        """
+        self.load(wait=False)
+        index = self.terms
+        if not index.documents:
+            return []
+
+        scores = np.zeros(len(index.documents), dtype=np.float32)
+        average_length = index.lengths.mean() or 1.0
+        norms = self.k1 * (1 - self.b + self.b * index.lengths / average_length)
+        for term in set(tokenize(query)):
+            if term not in index.postings:
+                continue
+            numbers, frequencies = index.postings[term]
+            scores[numbers] += index.idf[term] * frequencies * (self.k1 + 1) / (frequencies + norms[numbers])
+
+        if filter:
+            for number, document in enumerate(index.documents):
+                if scores[number] and any(document.metadata.get(field) != value for field, value in filter.items()):
+                    scores[number] = 0
+
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [(index.documents[number], float(scores[number])) for number in candidates]
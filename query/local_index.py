@@ -0,0 +1,372 @@
+import io
+import json
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from response import DISTANCE_KEY
+
+# Larger tables are only searched in BigQuery. Each row takes 4 bytes per dimension of
+# float32 vector (3 KiB at 768 dimensions) plus its text and metadata, and a refresh holds
+# the old and the new rows: 50000 rows of 768 dimensions need about 300 MB at peak for
+# the vectors alone, which fits a function with 1 GiB of memory
+MAX_ROWS = 50000
+KMEANS_ITERATIONS = 10
+SNAPSHOT_GENERATION_KEY = "index-generation"  # Custom metadata of the snapshot object: the index generation it holds
+
+
+class ExactSearch:
+    """
+    Brute force Euclidean top-k over all the vectors, using
+    |x - q|^2 = |x|^2 - 2 x.q + |q|^2 with the squared norms of the rows precomputed.
+    """
+
+    def __init__(self, vectors: np.ndarray):
+        self.vectors = vectors
+        self.norms = np.einsum("ij,ij->i", vectors, vectors)
+
+    def _top_k(self, rows: np.ndarray, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        if rows is None:
+            # Whole matrix: avoid copying it with a fancy index
+            distances = self.norms - 2 * (self.vectors @ query) + query @ query
+            rows = np.arange(len(distances))
+        elif len(rows):
+            distances = self.norms[rows] - 2 * (self.vectors[rows] @ query) + query @ query
+        else:
+            return rows, np.empty(0, dtype=np.float32)
+
+        if k < len(rows):
+            nearest = np.argpartition(distances, k)[:k]
+        else:
+            nearest = np.arange(len(rows))
+        nearest = nearest[np.argsort(distances[nearest])]
+        return rows[nearest], np.sqrt(np.maximum(distances[nearest], 0))
+
+    def search(self, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the row numbers of the `k` nearest vectors and their Euclidean distances, nearest first.
+        """
+        if not len(self.vectors):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        return self._top_k(None, query, k)
+
+
+class IVFSearch(ExactSearch):
+    """
+    Inverted file index: the vectors are clustered into `lists` lists with k-means, and a
+    search only scans the lists of the `probes` centroids nearest to the query. Trades
+    some recall for scanning about `probes / lists` of the rows.
+    """
+
+    def __init__(self, vectors: np.ndarray, lists: int, probes: int = 1, seed: int = 0):
+        super().__init__(vectors)
+        self.probes = probes
+        lists = max(1, min(lists, len(vectors)))
+
+        rng = np.random.default_rng(seed)
+        centroids = vectors[rng.choice(len(vectors), lists, replace=False)]
+        for _ in range(KMEANS_ITERATIONS):
+            assignments = self._assign(centroids)
+            for i in range(lists):
+                members = vectors[assignments == i]
+                if len(members):
+                    centroids[i] = members.mean(axis=0)
+        self.centroids = centroids
+        assignments = self._assign(centroids)
+        self.lists = [np.flatnonzero(assignments == i) for i in range(lists)]
+
+    def _assign(self, centroids: np.ndarray) -> np.ndarray:
+        distances = np.einsum("ij,ij->i", centroids, centroids)[None, :] - 2 * (self.vectors @ centroids.T)
+        return np.argmin(distances, axis=1)
+
+    def search(self, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        distances = np.einsum("ij,ij->i", self.centroids, self.centroids) - 2 * (self.centroids @ query)
+        probed = np.argsort(distances)[: self.probes]
+        rows = np.concatenate([self.lists[i] for i in probed])
+        return self._top_k(rows, query, k)
+
+
+class LoadedRows(NamedTuple):
+    """
+    The rows of one generation of the index, replaced as a whole so that a search never
+    mixes the rows of two generations.
+    """
+
+    ids: list
+    texts: list
+    metadatas: list
+    vectors: np.ndarray
+    search_index: ExactSearch
+
+
+class LocalVectorIndex(VectorStore):
+    """
+    Keeps the rows of the BigQuery vector table in memory and answers similarity searches
+    with NumPy instead of a BigQuery job. The configured `fallback` store
+    (BigQueryVectorSearch) is used whenever the index is not loaded or cannot serve a search.
+
+    The index is saved as a compact snapshot in GCS (`snapshot_uri`), so a new instance
+    downloads one object instead of reading the whole table. When the index generation
+    changes (the indexer added or removed vectors), only the row IDs are read from
+    BigQuery, and the rows that are new are fetched. Searches start that refresh on a
+    background thread and keep using the rows already loaded until it is done.
+    """
+
+    def __init__(
+        self,
+        fallback,
+        embedding: Embeddings,
+        generation=lambda: 0,
+        snapshot_uri: str = None,
+        storage_client=None,
+        max_rows: int = MAX_ROWS,
+        lists: int = 0,
+        probes: int = 1,
+    ):
+        self.fallback = fallback
+        self.embedding = embedding
+        self.generation = generation
+        self.snapshot_uri = snapshot_uri
+        self.storage_client = storage_client
+        self.max_rows = max_rows
+        self.lists = lists
+        self.probes = probes
+
+        self.rows: Optional[LoadedRows] = None
+        self.loaded_generation = None
+        # The table had more than `max_rows` rows at the loaded generation; only BigQuery is searched until it changes
+        self.too_large = False
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self.embedding
+
+    # BigQuery
+
+    def _query_rows(self, columns: str, ids: list = None) -> list:
+        from google.cloud import bigquery
+
+        # Listing the table skips the rows the indexer tombstoned; they are removed from the index on refresh
+        where = f"WHERE {self.fallback.doc_id_field} IN UNNEST(@ids)" if ids is not None else f"WHERE {self.fallback._live_rows()}"
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter("ids", "STRING", ids)] if ids is not None else []
+        )
+        return list(
+            self.fallback.bq_client.query(
+                f"SELECT {columns} FROM `{self.fallback.full_table_id}` {where}",
+                job_config=job_config,
+            ).result()
+        )
+
+    def _fetch_rows(self, ids: list = None) -> Tuple[list, list, list, list]:
+        store = self.fallback
+        rows = self._query_rows(
+            f"{store.doc_id_field}, {store.content_field}, {store.metadata_field}, {store.text_embedding_field}",
+            ids,
+        )
+        metadatas = []
+        for row in rows:
+            metadata = row[store.metadata_field] or {}
+            metadatas.append(json.loads(metadata) if isinstance(metadata, str) else dict(metadata))
+        return (
+            [row[store.doc_id_field] for row in rows],
+            [row[store.content_field] for row in rows],
+            metadatas,
+            [row[store.text_embedding_field] for row in rows],
+        )
+
+    # GCS snapshot
+
+    def _snapshot_blob(self):
+        bucket_name, _, path = self.snapshot_uri[len("gs://"):].partition("/")
+        return self.storage_client.bucket(bucket_name).blob(path)
+
+    def _stored_snapshot(self):
+        # The snapshot object with its metadata, None if there is none yet
+        blob = self._snapshot_blob()
+        return blob.bucket.get_blob(blob.name)
+
+    def _read_snapshot(self) -> bool:
+        blob = self._snapshot_blob()
+        if not blob.exists():
+            return False
+        with np.load(io.BytesIO(blob.download_as_bytes()), allow_pickle=False) as snapshot:
+            rows = json.loads(snapshot["rows"].tobytes().decode("utf-8"))
+            self._set_rows(rows["ids"], rows["texts"], rows["metadatas"], snapshot["vectors"])
+            self.loaded_generation = int(snapshot["generation"])
+        return True
+
+    def _write_snapshot(self) -> None:
+        from google.api_core.exceptions import PreconditionFailed
+
+        # Every instance refreshes to the same generations: only upload a snapshot that is
+        # newer than the stored one, and only if no other instance replaced it meanwhile
+        stored = self._stored_snapshot()
+        if stored is not None and int((stored.metadata or {}).get(SNAPSHOT_GENERATION_KEY, -1)) >= self.loaded_generation:
+            return
+
+        rows = json.dumps({"ids": self.rows.ids, "texts": self.rows.texts, "metadatas": self.rows.metadatas}).encode("utf-8")
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            vectors=self.rows.vectors,
+            rows=np.frombuffer(rows, dtype=np.uint8),
+            generation=np.array(self.loaded_generation),
+        )
+        blob = self._snapshot_blob()
+        blob.metadata = {SNAPSHOT_GENERATION_KEY: str(self.loaded_generation)}
+        try:
+            blob.upload_from_string(
+                buffer.getvalue(),
+                content_type="application/octet-stream",
+                if_generation_match=stored.generation if stored is not None else 0,
+            )
+        except PreconditionFailed:
+            print("Local index snapshot already uploaded by another instance")
+
+    # Loading
+
+    def _set_rows(self, ids: list, texts: list, metadatas: list, vectors) -> None:
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1) if ids else np.empty((0, 0), dtype=np.float32)
+        if self.lists and len(ids) > self.lists:
+            search_index = IVFSearch(vectors, self.lists, self.probes)
+        else:
+            search_index = ExactSearch(vectors)
+        self.rows = LoadedRows(list(ids), list(texts), list(metadatas), vectors, search_index)
+
+    def _refresh(self, generation: int) -> None:
+        # Only the IDs are read to find the rows added and removed since the loaded generation
+        store = self.fallback
+        current_ids = [row[store.doc_id_field] for row in self._query_rows(store.doc_id_field)]
+        if len(current_ids) > self.max_rows:
+            # Checked again when the generation changes, e.g. after rows were deleted
+            self.too_large = True
+            self.rows = None
+            self.loaded_generation = generation
+            raise ValueError(f"{len(current_ids)} rows exceed the local index limit of {self.max_rows}")
+        self.too_large = False
+
+        if self.rows is None:
+            self._set_rows(*self._fetch_rows())
+            self.loaded_generation = generation
+            return
+
+        loaded = self.rows
+        known = set(loaded.ids)
+        current = set(current_ids)
+        new_ids = [doc_id for doc_id in current_ids if doc_id not in known]
+
+        keep = [i for i, doc_id in enumerate(loaded.ids) if doc_id in current]
+        ids = [loaded.ids[i] for i in keep]
+        texts = [loaded.texts[i] for i in keep]
+        metadatas = [loaded.metadatas[i] for i in keep]
+        vectors = [loaded.vectors[keep]] if keep else []
+        if new_ids:
+            new_ids, new_texts, new_metadatas, new_vectors = self._fetch_rows(new_ids)
+            ids += new_ids
+            texts += new_texts
+            metadatas += new_metadatas
+            vectors.append(np.asarray(new_vectors, dtype=np.float32).reshape(len(new_ids), -1))
+
+        print(f"Local index: {len(new_ids)} row(s) added, {len(loaded.ids) - len(keep)} removed")
+        self._set_rows(ids, texts, metadatas, np.concatenate(vectors) if vectors else np.empty((0, 0)))
+        self.loaded_generation = generation
+
+    def load(self, wait: bool = True) -> bool:
+        """
+        Loads the index from the GCS snapshot if there is one, and brings it up to date with
+        the BigQuery table when the generation changed. Only one load runs at a time. With
+        `wait=False` (on every search), the load runs on a background thread and the rows
+        already loaded keep being searched meanwhile. Returns True if rows are loaded.
+        """
+        generation = self.generation()
+        with self._lock:
+            if self.loaded_generation == generation or self._refreshing:
+                return self.rows is not None
+            self._refreshing = True
+
+        if wait:
+            self._load(generation)
+        else:
+            threading.Thread(target=self._load_in_background, args=(generation,), daemon=True).start()
+        return self.rows is not None
+
+    def _load(self, generation: int) -> None:
+        try:
+            started = time.monotonic()
+            if self.loaded_generation is None and self.snapshot_uri:
+                try:
+                    self._read_snapshot()
+                except Exception as e:
+                    print(f"Could not read the local index snapshot, loading from BigQuery: {e}")
+            if self.loaded_generation == generation:
+                return
+
+            self._refresh(generation)
+
+            if self.snapshot_uri:
+                self._write_snapshot()
+            print(f"Local index: {len(self.rows.ids)} rows at generation {generation}, loaded in {time.monotonic() - started:.2f}s")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _load_in_background(self, generation: int) -> None:
+        try:
+            self._load(generation)
+        except Exception as e:
+            # Retried by the next search if the generation is still not loaded
+            print(f"Could not refresh the local index: {e}")
+
+    # Search
+
+    def _matches(self, metadata: dict, filter: Dict[str, Any]) -> bool:
+        return all(metadata.get(key) == value for key, value in filter.items())
+
+    def similarity_search_with_score_by_vector(
+        self, embedding: List[float], k: int = 4, filter: Optional[Dict[str, Any]] = None, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        try:
+            self.load(wait=False)
+            loaded = self.rows
+            if loaded is None:
+                raise ValueError(f"more than {self.max_rows} rows" if self.too_large else "not loaded yet")
+            query = np.asarray(embedding, dtype=np.float32)
+            if filter:
+                # Metadata filters are rare; scan the matching rows exactly
+                rows = np.array([i for i, metadata in enumerate(loaded.metadatas) if self._matches(metadata, filter)], dtype=np.int64)
+                indices, distances = loaded.search_index._top_k(rows, query, k) if len(rows) else ([], [])
+            else:
+                indices, distances = loaded.search_index.search(query, k)
+        except Exception as e:
+            print(f"Local index unavailable, searching BigQuery: {e}")
+            return self.fallback.similarity_search_with_score_by_vector(embedding, k, filter=filter, **kwargs)
+
+        return [
+            (Document(page_content=loaded.texts[i], metadata={**loaded.metadatas[i], "__id": loaded.ids[i], DISTANCE_KEY: float(distance)}), float(distance))
+            for i, distance in zip(indices, distances)
+        ]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in self.similarity_search_with_score_by_vector(embedding, k, **kwargs)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self.embedding.embed_query(query), k, **kwargs)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def add_texts(self, texts, metadatas: Optional[list] = None, **kwargs: Any) -> List[str]:
+        # Rows are only written by the indexer; they are picked up on the next refresh
+        return self.fallback.add_texts(texts, metadatas, **kwargs)
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas: Optional[list] = None, **kwargs: Any):
+        raise NotImplementedError("LocalVectorIndex is loaded from an existing BigQuery table")
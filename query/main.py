@@ -1,36 +1,104 @@
+import json
+import os
+import random
+
 import functions_framework
-import jsonpickle
-from langchain.chains.qa_with_sources.retrieval import RetrievalQAWithSourcesChain
+from flask import Response, stream_with_context
+from google.cloud import firestore  # type: ignore
+from langchain.chains.qa_with_sources.loading import load_qa_with_sources_chain
 from langchain.prompts import PromptTemplate
 from langchain.vectorstores.utils import DistanceStrategy
-from langchain_community.vectorstores.bigquery_vector_search import BigQueryVectorSearch
-from langchain_google_vertexai import ChatVertexAI, VertexAIEmbeddings
+from langchain_core.tracers import ConsoleCallbackHandler
 
-from langchain.globals import set_debug, set_verbose
+from answer_cache import AnswerCache, IndexGeneration, MemoizedQueryEmbeddings
+from answer_strategy import (
+    AUTO,
+    CONTEXT_TOKEN_BUDGET,
+    MAP_REDUCE,
+    STRATEGIES,
+    STUFF,
+    BudgetedCombineDocumentsChain,
+    LLMCallCounter,
+    SpanCallbackHandler,
+)
+from clients import ClientRegistry
+from hybrid_search import HYBRID_CANDIDATES, HybridRetriever, TermOverlapReranker
+from lexical_index import LexicalIndex
+from local_index import MAX_ROWS, LocalVectorIndex
+from scoped_search import (
+    FILTER_KEY,
+    ScopedBigQueryVectorSearch,
+    ScopedRetrievalQAWithSourcesChain,
+    request_filter,
+)
+from response import encode, from_answer, parse_fields, source_dicts, to_dict, to_sources
+from streaming import sse, stream_answer
+import tracing
 
-# Enable debug logging
-set_debug(True)
-set_verbose(True)
+# Fraction of requests whose full chain trace is logged, e.g. 0.01 for 1% (off by default)
+DEBUG_SAMPLE_RATE = float(os.environ.get("DEBUG_SAMPLE_RATE", 0))
+# How the retrieved documents are combined into an answer: auto, stuff, map_reduce or refine
+ANSWER_STRATEGY = os.environ.get("ANSWER_STRATEGY", AUTO)
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", CONTEXT_TOKEN_BUDGET))
+RETRIEVER_K = int(os.environ.get("RETRIEVER_K", 1))
+# Answers cached per instance (0 disables the cache), for how long, and how similar two questions must be to share one (0 disables the semantic tier)
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", 1000))
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", 3600))
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", 0.95))
+# Search an in-memory copy of the vector table instead of running a BigQuery job per query
+LOCAL_INDEX = os.environ.get("LOCAL_INDEX", "false").lower() == "true"
+LOCAL_INDEX_SNAPSHOT = os.environ.get("LOCAL_INDEX_SNAPSHOT")  # e.g. gs://YOUR_BUCKET/local_index.npz
+LOCAL_INDEX_MAX_ROWS = int(os.environ.get("LOCAL_INDEX_MAX_ROWS", MAX_ROWS))  # See MAX_ROWS for the memory it takes
+LOCAL_INDEX_LISTS = int(os.environ.get("LOCAL_INDEX_LISTS", 0))  # 0 for an exact search, else the number of IVF lists
+LOCAL_INDEX_PROBES = int(os.environ.get("LOCAL_INDEX_PROBES", 4))
+# Combine the vector search with a keyword index of the paragraph texts, for exact identifiers the embeddings miss
+HYBRID_SEARCH = os.environ.get("HYBRID_SEARCH", "false").lower() == "true"
+HYBRID_CANDIDATES = int(os.environ.get("HYBRID_CANDIDATES", HYBRID_CANDIDATES))  # Taken from each search before fusion
+# Rerank the fused documents by the rare question terms they contain; without it, RRF ranks an identifier match
+# found by the keyword search alone below the vector search's top documents, which matters with RETRIEVER_K=1
+HYBRID_RERANK = os.environ.get("HYBRID_RERANK", "true").lower() == "true"
 
 PROJECT_ID = "YOUR_PROJECT"
 LOCATION = "YOUR_LOCATION"
 BIGQUERY_DATASET = "gemini_di"  # @param {type: "string"}
 BIGQUERY_TABLE = "doc_and_vectors"  # @param {type: "string"}
 
-embeddings = VertexAIEmbeddings(
-    model_name="textembedding-gecko@003", project=PROJECT_ID, location=LOCATION
-)
+# Clients are created on first use rather than at import, see clients.py
+clients = ClientRegistry()
 
-store = BigQueryVectorSearch(
-    project_id=PROJECT_ID,
-    dataset_name=BIGQUERY_DATASET,
-    table_name=BIGQUERY_TABLE,
-    location=LOCATION,
-    embedding=embeddings,
-    distance_strategy=DistanceStrategy.EUCLIDEAN_DISTANCE,
-)
 
-chat_llm = ChatVertexAI(model_name="gemini-pro", project=PROJECT_ID, location=LOCATION)
+@clients.register
+def db():
+    return firestore.Client()
+
+
+@clients.register
+def query_embeddings():
+    from langchain_google_vertexai import VertexAIEmbeddings
+
+    embeddings = VertexAIEmbeddings(model_name="textembedding-gecko@003", project=PROJECT_ID, location=LOCATION)
+    # A question embedded for the semantic cache lookup is reused by the vector search on a miss
+    return MemoizedQueryEmbeddings(embeddings)
+
+
+@clients.register
+def store():
+    # Collection and source filters are applied inside the vector search, see scoped_search.py
+    return ScopedBigQueryVectorSearch(
+        project_id=PROJECT_ID,
+        dataset_name=BIGQUERY_DATASET,
+        table_name=BIGQUERY_TABLE,
+        location=LOCATION,
+        embedding=query_embeddings(),
+        distance_strategy=DistanceStrategy.EUCLIDEAN_DISTANCE,
+    )
+
+
+@clients.register
+def chat_llm():
+    from langchain_google_vertexai import ChatVertexAI
+
+    return ChatVertexAI(model_name="gemini-pro", project=PROJECT_ID, location=LOCATION)
 
 custom_prompt_template = """You are a chatbot used for answering questions based on provided context. Use the following pieces of context to answer the question at the end. 
 
@@ -43,32 +111,243 @@ di_prompt = PromptTemplate(
     template=custom_prompt_template, input_variables=["context", "question"]
 )
 
+# Single-call prompt: all the retrieved documents at once, answer followed by the sources used
+stuff_prompt_template = """You are a chatbot used for answering questions based on provided context. Use the following pieces of context to answer the question at the end. After the answer, list the sources of the context you used on a line starting with "SOURCES:".
+
+{summaries}
+
+Question: {question}
+Helpful Answer:"""
+
+di_stuff_prompt = PromptTemplate(
+    template=stuff_prompt_template, input_variables=["summaries", "question"]
+)
+
+
+def build_combine_chain(llm, strategy: str = ANSWER_STRATEGY, token_budget: int = CONTEXT_TOKEN_BUDGET):
+    """
+    Builds the chain that turns the retrieved documents into an answer:
+        stuff        one LLM call with all the documents in the prompt
+        map_reduce   one LLM call per document and one to combine the results
+        refine       one LLM call per document, refining the previous answer
+        auto         stuff if the prompt fits in `token_budget` tokens, map_reduce otherwise
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown answer strategy: {strategy}. Available: {', '.join(STRATEGIES)}")
+
+    # The LLM steps are tagged so that the spans of their calls are named after them, see SpanCallbackHandler
+    if strategy == STUFF:
+        chain = load_qa_with_sources_chain(llm, chain_type=STUFF, prompt=di_stuff_prompt)
+        chain.llm_chain.tags = ["stuff"]
+        return chain
+    if strategy == MAP_REDUCE:
+        chain = load_qa_with_sources_chain(llm, chain_type=MAP_REDUCE, question_prompt=di_prompt)
+        # The map calls are made through LLMChain.apply, which drops the tags of its chain; tag the whole chain
+        chain.tags = ["map"]
+        chain.reduce_documents_chain.combine_documents_chain.llm_chain.tags = ["reduce"]
+        return chain
+    if strategy == AUTO:
+        return BudgetedCombineDocumentsChain(
+            stuff_chain=build_combine_chain(llm, STUFF),
+            fallback_chain=build_combine_chain(llm, MAP_REDUCE),
+            token_budget=token_budget,
+        )
+    chain = load_qa_with_sources_chain(llm, chain_type=strategy)
+    chain.initial_llm_chain.tags = chain.refine_llm_chain.tags = ["refine"]
+    return chain
+
+
+def build_chain(llm, retriever, strategy: str = ANSWER_STRATEGY) -> ScopedRetrievalQAWithSourcesChain:
+    """
+    Assembles the question answering chain. The chain keeps no state between calls,
+    so a single instance is built on the first request and shared by all requests.
+    """
+    return ScopedRetrievalQAWithSourcesChain(
+        combine_documents_chain=build_combine_chain(llm, strategy),
+        retriever=retriever,
+        return_source_documents=True,
+    )
+
+
+@clients.register
+def index_generation():
+    # The indexer bumps the index generation (and that of the collection) whenever the vector table changes
+    return IndexGeneration(db(), BIGQUERY_TABLE)
+
+
+@clients.register
+def search_store():
+    if not LOCAL_INDEX:
+        return store()
+
+    from google.cloud import storage  # type: ignore
+
+    local_index = LocalVectorIndex(
+        store(),
+        embedding=query_embeddings(),
+        generation=index_generation().current,
+        snapshot_uri=LOCAL_INDEX_SNAPSHOT,
+        storage_client=storage.Client(project=PROJECT_ID) if LOCAL_INDEX_SNAPSHOT else None,
+        max_rows=LOCAL_INDEX_MAX_ROWS,
+        lists=LOCAL_INDEX_LISTS,
+        probes=LOCAL_INDEX_PROBES,
+    )
+    try:
+        local_index.load()
+    except Exception as e:
+        # Searches keep falling back to BigQuery until the index can be loaded
+        print(f"Could not load the local index: {e}")
+    return local_index
+
+
+@clients.register
+def retriever():
+    if not HYBRID_SEARCH:
+        return search_store().as_retriever(search_kwargs={"k": RETRIEVER_K}, return_source_documents=True)
+
+    # Rebuilt from the Firestore paragraphs whenever the index generation changes
+    lexical_index = LexicalIndex(db(), generation=index_generation().current)
+    try:
+        lexical_index.load()
+    except Exception as e:
+        # Loading is retried on the next search; until then queries use the vector search only
+        print(f"Could not load the keyword index: {e}")
+    return HybridRetriever(
+        vectorstore=search_store(),
+        lexical_index=lexical_index,
+        search_kwargs={"k": RETRIEVER_K},
+        candidates=HYBRID_CANDIDATES,
+        reranker=TermOverlapReranker(lexical_index) if HYBRID_RERANK else None,
+    )
+
+
+@clients.register
+def chatbot():
+    return build_chain(chat_llm(), retriever())
+
+
+@clients.register
+def answer_cache():
+    if ANSWER_CACHE_SIZE <= 0:
+        return None
+    # Re-indexing a collection drops the answers scoped to it and the unscoped ones
+    return AnswerCache(
+        query_embeddings(),
+        generation=index_generation().current,
+        size=ANSWER_CACHE_SIZE,
+        ttl=ANSWER_CACHE_TTL,
+        similarity_threshold=ANSWER_CACHE_SIMILARITY,
+    )
+
+
+def stream_events(
+    query_text: str,
+    search_filter: dict,
+    scope: str,
+    fields: tuple,
+    llm_calls: LLMCallCounter,
+    callbacks: list,
+    request_span: tracing.Span,
+):
+    """
+    Answers a query as server-sent events: the retrieved sources first, then the answer
+    tokens as Gemini generates them, then a "done" event with the other response fields.
+    """
+    response_fields, source_fields = fields
+    semantic = ANSWER_CACHE_SIMILARITY > 0
+    cache = answer_cache()
+    # The request has returned by the time the answer is streamed; trace the stream on its own
+    root = tracing.follow(request_span, "query_stream")
+    callbacks = callbacks + [SpanCallbackHandler(root)]
+    error = None
+    try:
+        with tracing.span("answer_cache_lookup", parent=root):
+            answer = cache.lookup(query_text, semantic, scope, search_filter.get("collection")) if cache else None
+        if answer is not None:
+            answer.update({"question": query_text, "llm_calls": 0})
+            yield sse("sources", source_dicts(to_sources(answer["source_documents"]), source_fields))
+            yield sse("token", answer["answer"])
+        else:
+            for event, data in stream_answer(chatbot(), query_text, search_filter, callbacks):
+                if event == "done":
+                    answer = data
+                    answer["llm_calls"] = llm_calls.calls
+                    if cache:
+                        cache.store(query_text, answer, semantic, scope, search_filter.get("collection"))
+                    continue
+                if event == "sources":
+                    data = source_dicts(to_sources(data), source_fields)
+                yield sse(event, data)
+
+        # The sources were sent first
+        done_fields = tuple(field for field in response_fields if field != "sources")
+        yield sse("done", to_dict(from_answer(answer), done_fields))
+    except Exception as err:
+        error = err
+        yield sse("error", {"error": f"Sorry, an error occured while procuring the answer. Error: {str(err)}"})
+    finally:
+        root.set(llm_calls=llm_calls.calls)
+        root.end(error)
+
+
 @functions_framework.http
+@tracing.traced("query")
 def query(request) -> tuple:
 
+    # Create the clients concurrently on the first request, so that their cold start round trips overlap
+    clients.warm("chatbot", "answer_cache")
+
     # Get the bucket name and file name from the request
     request_json = request.get_json(silent=True)
     query_text = request_json["query"]
+    # Optional "collection" and "source" fields restrict the search to one tenant or document
+    search_filter = request_filter(request_json)
+    scope = json.dumps(search_filter, sort_keys=True)
+    # Optional "fields" select the response fields, e.g. ["answer", "sources.source", "sources.page"] to skip the source texts
+    try:
+        fields = parse_fields(request_json.get("fields"))
+    except ValueError as err:
+        return (encode({"error": str(err)}), 400, {"Content-Type": "application/json"})
 
-    retriever = store.as_retriever(search_kwargs={"k": 1}, return_source_documents=True)
+    # Only trace a sample of the requests, instead of dumping every chain run to stdout
+    llm_calls = LLMCallCounter()
+    callbacks = [llm_calls]
+    if random.random() < DEBUG_SAMPLE_RATE:
+        callbacks.append(ConsoleCallbackHandler())
+    request_span = tracing.current()
 
-    chatbot = RetrievalQAWithSourcesChain.from_chain_type(
-        llm=chat_llm,
-        chain_type="map_reduce",
-        retriever=retriever,
-        return_source_documents=True,
-    )
-    chatbot.combine_documents_chain.llm_chain.prompt = di_prompt
+    # Stream the answer to clients asking for server-sent events; the others get the complete answer as JSON
+    if request_json.get("stream") or "text/event-stream" in request.headers.get("Accept", ""):
+        return Response(
+            stream_with_context(stream_events(query_text, search_filter, scope, fields, llm_calls, callbacks, request_span)),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
 
+    semantic = ANSWER_CACHE_SIMILARITY > 0
+    cache = answer_cache()
     try:
-        answer = chatbot({"question": query_text})
+        with tracing.span("answer_cache_lookup"):
+            answer = cache.lookup(query_text, semantic, scope, search_filter.get("collection")) if cache else None
+        if answer is not None:
+            # Served from the cache: no vector search and no LLM call
+            answer.update({"question": query_text, "llm_calls": 0})
+        else:
+            callbacks.append(SpanCallbackHandler(request_span))
+            answer = chatbot()({"question": query_text, FILTER_KEY: search_filter}, callbacks=callbacks)
+            answer["llm_calls"] = llm_calls.calls
+            if cache:
+                cache.store(query_text, answer, semantic, scope, search_filter.get("collection"))
     except Exception as err:
-        answer = (
-            f"Sorry, an error occured while procuring the answer. Error: {str(err)}"
-        )
+        body = encode({"question": query_text, "error": f"Sorry, an error occured while procuring the answer. Error: {str(err)}"})
+        print(f"Query failed - {body.decode()}")
+        return (body, 500, {"Content-Type": "application/json"})
+
+    request_span.set(llm_calls=llm_calls.calls, cache=answer.get("cache"))
+    if cache:
+        tracing.verbose(f"Answer cache: {cache.stats()}")
 
-    # TODO - Find a better way to convert to json
-    json_string = jsonpickle.encode(answer)
-    print(f"Query reply - {json_string}")
+    body = encode(to_dict(from_answer(answer), *fields))
+    tracing.verbose(f"Query reply - {body.decode()}")
 
-    return (json_string, 200)
+    return (body, 200, {"Content-Type": "application/json"})
@@ -0,0 +1,97 @@
+from typing import Iterable, List, NamedTuple, Optional
+
+import orjson
+from langchain_core.documents import Document
+
+DISTANCE_KEY = "__distance"  # Metadata key the vector stores record a document's distance to the question under
+
+
+class Source(NamedTuple):
+    """
+    A retrieved document as returned to the client.
+    """
+    source: str
+    page: Optional[int]
+    score: Optional[float]  # Distance to the question (Euclidean), lower is closer; None if only found by keyword search
+    content: str
+
+
+class QueryResponse(NamedTuple):
+    """
+    The reply of the query function.
+    """
+    question: str
+    answer: str
+    sources: List[Source]
+    cited_sources: str  # The sources the model said it used
+    llm_calls: int
+    cache: Optional[str]  # "exact" or "semantic" for answers served from the cache
+
+
+RESPONSE_FIELDS = QueryResponse._fields
+SOURCE_FIELDS = Source._fields
+
+
+def to_sources(docs: Iterable[Document]) -> List[Source]:
+    return [
+        Source(
+            source=doc.metadata.get("source"),
+            page=doc.metadata.get("page"),
+            score=doc.metadata.get(DISTANCE_KEY),
+            content=doc.page_content,
+        )
+        for doc in docs
+    ]
+
+
+def from_answer(answer: dict) -> QueryResponse:
+    """
+    Builds the response from the output of the question answering chain.
+    """
+    return QueryResponse(
+        question=answer["question"],
+        answer=answer["answer"],
+        sources=to_sources(answer.get("source_documents", [])),
+        cited_sources=answer.get("sources", ""),
+        llm_calls=answer.get("llm_calls", 0),
+        cache=answer.get("cache"),
+    )
+
+
+def parse_fields(fields: Optional[list]) -> tuple:
+    """
+    Parses the "fields" option of a request, e.g. ["answer", "sources.source", "sources.page"],
+    into the response fields and source fields to return (all of them by default).
+    Unknown fields are rejected with a ValueError.
+    """
+    if not fields:
+        return RESPONSE_FIELDS, SOURCE_FIELDS
+
+    response_fields, source_fields = [], []
+    for field in fields:
+        name, _, subfield = field.partition(".")
+        if name not in RESPONSE_FIELDS or (subfield and (name != "sources" or subfield not in SOURCE_FIELDS)):
+            raise ValueError(f"Unknown field: {field}")
+        if name not in response_fields:
+            response_fields.append(name)
+        if subfield:
+            source_fields.append(subfield)
+    return tuple(response_fields), tuple(source_fields) or SOURCE_FIELDS
+
+
+def source_dicts(sources: List[Source], source_fields: tuple = SOURCE_FIELDS) -> list:
+    return [{field: getattr(source, field) for field in source_fields} for source in sources]
+
+
+def to_dict(response: QueryResponse, fields: tuple = RESPONSE_FIELDS, source_fields: tuple = SOURCE_FIELDS) -> dict:
+    data = {field: getattr(response, field) for field in fields}
+    if "sources" in data:
+        data["sources"] = source_dicts(response.sources, source_fields)
+    return data
+
+
+def encode(data) -> bytes:
+    """
+    Serialises a response (or any part of it) to JSON.
+    """
+    return orjson.dumps(data)
@@ -0,0 +1,200 @@
+import json
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain.chains.qa_with_sources.retrieval import RetrievalQAWithSourcesChain
+from langchain.vectorstores.utils import DistanceStrategy
+from langchain_community.vectorstores.bigquery_vector_search import BigQueryVectorSearch
+from langchain_core.documents import Document
+
+from response import DISTANCE_KEY
+
+COLLECTION_COLUMN = "collection"  # Top-level column the indexer clusters the vector table by
+TOMBSTONE_SUFFIX = "_tombstones"  # Table of the ids of the rows the indexer replaced, until they are compacted
+# Searches without a filter fetch `k` + the number of tombstones + this margin (for the tombstones added since the
+# count was read), so that `k` remain once the tombstoned ones are skipped
+TOMBSTONE_OVERFETCH = 10
+# With more tombstones than this (compact_vectors has not run for a while), the live rows are searched exactly instead
+MAX_TOMBSTONE_OVERFETCH = 1000
+TOMBSTONE_CHECK_SECONDS = 60  # How long the number of tombstones (or the absence of their table) is cached
+FILTER_KEY = "filter"
+FILTER_FIELDS = ("collection", "source")
+
+
+def request_filter(request_json: dict) -> dict:
+    """
+    Returns the metadata filter of a query request: its optional "collection" and "source" fields.
+    """
+    return {field: request_json[field] for field in FILTER_FIELDS if request_json.get(field)}
+
+
+class ScopedBigQueryVectorSearch(BigQueryVectorSearch):
+    """
+    BigQueryVectorSearch that applies metadata filters before the vector search instead of
+    after it. The base class filters the `k` nearest rows of the whole table, which can
+    return fewer than `k` (or no) rows of the requested collection; here VECTOR_SEARCH runs
+    over a subquery that only selects the matching rows. The collection is matched on the
+    clustered `collection` column, so BigQuery only reads that collection's blocks; other
+    fields are matched in the JSON metadata. Filter values are passed as query parameters.
+
+    Rows listed in the tombstone table (the chunks a new version of a file changed or
+    removed, until `compact_vectors` deletes them) are skipped by every search. Until the
+    indexer's `setup` has created that table, nothing is skipped.
+
+    The indexer creates the tables; here they are only read, which saves the create and
+    update calls the base class makes on every cold start.
+    """
+
+    def _initialize_table(self):
+        return self.bq_client.get_table(self.full_table_id)
+
+    _tombstone_count: Optional[int] = None
+    _tombstones_checked: float = float("-inf")
+
+    @property
+    def tombstone_table_id(self) -> str:
+        return self.full_table_id + TOMBSTONE_SUFFIX
+
+    def _tombstones(self) -> Optional[int]:
+        """
+        The number of tombstoned rows, or None if the tombstone table does not exist (the
+        indexer's `setup` was not run again after upgrading). Read at most every TOMBSTONE_CHECK_SECONDS.
+        """
+        from google.api_core.exceptions import NotFound
+
+        now = time.monotonic()
+        if now - self._tombstones_checked >= TOMBSTONE_CHECK_SECONDS:
+            try:
+                self._tombstone_count = self.bq_client.get_table(self.tombstone_table_id).num_rows or 0
+            except NotFound:
+                print(f"Table {self.tombstone_table_id} not found, tombstoned rows are not skipped; run the indexer's setup")
+                self._tombstone_count = None
+            self._tombstones_checked = now
+        return self._tombstone_count
+
+    def _live_rows(self, column: str = None) -> str:
+        """
+        The condition excluding the tombstoned rows.
+        """
+        if self._tombstones() is None:
+            return "TRUE"
+        return f"{column or self.doc_id_field} NOT IN (SELECT {self.doc_id_field} FROM `{self.tombstone_table_id}`)"
+
+    def _document_tuples(self, job) -> List[Tuple[Document, List[float], float]]:
+        document_tuples = []
+        for row in job:
+            metadata = row[self.metadata_field] or {}
+            if not isinstance(metadata, dict):
+                metadata = json.loads(metadata)
+            metadata["__id"] = row[self.doc_id_field]
+            metadata["__job_id"] = job.job_id
+            metadata[DISTANCE_KEY] = row["_vector_search_distance"]
+            document = Document(page_content=row[self.content_field], metadata=metadata)
+            document_tuples.append((document, row[self.text_embedding_field], row["_vector_search_distance"]))
+        return document_tuples
+
+    def _search_with_score_and_embeddings_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: Optional[Dict[str, Any]] = None,
+        brute_force: bool = False,
+        fraction_lists_to_search: Optional[float] = None,
+    ) -> List[Tuple[Document, List[float], float]]:
+        from google.cloud import bigquery
+
+        distance_type = "COSINE" if self.distance_strategy == DistanceStrategy.COSINE else "EUCLIDEAN"
+        tombstones = self._tombstones() or 0
+        if not filter and tombstones <= MAX_TOMBSTONE_OVERFETCH:
+            # Searches the whole table, so that the vector index applies; the tombstoned rows are skipped afterwards
+            if not self._have_index and not self._creating_index:
+                self._initialize_vector_index()
+            if brute_force:
+                options = ", options => '{\"use_brute_force\":true}'"
+            elif fraction_lists_to_search:
+                options = f", options => '{{\"fraction_lists_to_search\":{fraction_lists_to_search}}}'"
+            else:
+                options = ""
+            query = f"""
+                SELECT
+                    base.*,
+                    distance AS _vector_search_distance
+                FROM VECTOR_SEARCH(
+                    TABLE `{self.full_table_id}`,
+                    "{self.text_embedding_field}",
+                    (SELECT @v AS {self.text_embedding_field}),
+                    distance_type => "{distance_type}",
+                    top_k => {k + tombstones + TOMBSTONE_OVERFETCH}
+                    {options}
+                )
+                WHERE {self._live_rows("base." + self.doc_id_field)}
+                ORDER BY distance
+                LIMIT {k}
+            """
+            job = self.bq_client.query(
+                query,
+                job_config=bigquery.QueryJobConfig(
+                    query_parameters=[bigquery.ArrayQueryParameter("v", "FLOAT64", embedding)],
+                    use_query_cache=False,
+                    priority=bigquery.QueryPriority.BATCH,
+                ),
+                api_method=bigquery.enums.QueryApiMethod.QUERY,
+            )
+            return self._document_tuples(job)
+
+        conditions = [self._live_rows()]
+        parameters = [bigquery.ArrayQueryParameter("v", "FLOAT64", embedding)]
+        for i, (field, value) in enumerate((filter or {}).items()):
+            if field == COLLECTION_COLUMN:
+                column = f"`{COLLECTION_COLUMN}`"
+            else:
+                column = f"JSON_VALUE(`{self.metadata_field}`, '$.{field}')"
+            conditions.append(f"{column} = @filter_{i}")
+            parameters.append(bigquery.ScalarQueryParameter(f"filter_{i}", "STRING", str(value)))
+
+        # The vector index does not apply to a filtered subquery; the filtered rows are searched exactly. Without a
+        # filter, this is only used when there are too many tombstones to skip after an indexed search
+        query = f"""
+            SELECT
+                base.*,
+                distance AS _vector_search_distance
+            FROM VECTOR_SEARCH(
+                (SELECT * FROM `{self.full_table_id}` WHERE {" AND ".join(conditions)}),
+                "{self.text_embedding_field}",
+                (SELECT @v AS {self.text_embedding_field}),
+                distance_type => "{distance_type}",
+                top_k => {k}
+            )
+        """
+        job = self.bq_client.query(
+            query,
+            job_config=bigquery.QueryJobConfig(query_parameters=parameters, use_query_cache=False),
+            api_method=bigquery.enums.QueryApiMethod.QUERY,
+        )
+        return self._document_tuples(job)
+
+
+class ScopedRetrievalQAWithSourcesChain(RetrievalQAWithSourcesChain):
+    """
+    RetrievalQAWithSourcesChain taking an optional metadata filter as the "filter" input,
+    which is passed to the vector search of that call only. The chain itself is shared by
+    all requests, so the filter cannot be set on its retriever.
+    """
+
+    def _scoped_retriever(self, inputs: Dict[str, Any]):
+        filter = inputs.get(FILTER_KEY)
+        if not filter:
+            return self.retriever
+        return self.retriever.copy(update={"search_kwargs": {**self.retriever.search_kwargs, "filter": filter}})
+
+    def _get_docs(self, inputs: Dict[str, Any], *, run_manager) -> List[Document]:
+        docs = self._scoped_retriever(inputs).get_relevant_documents(
+            inputs[self.question_key], callbacks=run_manager.get_child()
+        )
+        return self._reduce_tokens_below_limit(docs)
+
+    async def _aget_docs(self, inputs: Dict[str, Any], *, run_manager) -> List[Document]:
+        docs = await self._scoped_retriever(inputs).aget_relevant_documents(
+            inputs[self.question_key], callbacks=run_manager.get_child()
+        )
+        return self._reduce_tokens_below_limit(docs)
@@ -0,0 +1,91 @@
+import re
+from typing import Iterator, Tuple
+
+from langchain.chains.combine_documents.stuff import StuffDocumentsChain
+
+from answer_strategy import BudgetedCombineDocumentsChain
+from response import encode
+
+SOURCES_MARKER = re.compile(r"SOURCES?:", re.IGNORECASE)
+# Longest text that may be the start of a marker split across tokens ("SOURCES:")
+MARKER_HOLDBACK = len("SOURCES:") - 1
+
+
+def sse(event: str, data) -> str:
+    """
+    Formats a server-sent event with a JSON payload.
+    """
+    return f"event: {event}\ndata: {encode(data).decode()}\n\n"
+
+
+def split_sources(text: str) -> Tuple[str, str]:
+    """
+    Splits an answer into its text and the sources the model listed after "SOURCES:",
+    like RetrievalQAWithSourcesChain does.
+    """
+    match = SOURCES_MARKER.search(text)
+    if not match:
+        return text, ""
+    return text[: match.start()], text[match.end() :].strip()
+
+
+def stream_tokens(llm, prompt, callbacks=None) -> Iterator[Tuple[str, str]]:
+    """
+    Streams the answer of the model as "token" events, holding back the trailing
+    "SOURCES: ..." list that the prompt asks for. Returns the complete output.
+    """
+    text = ""
+    sent = 0
+    # Tagged like the stuff chain's calls, see SpanCallbackHandler
+    for chunk in llm.stream(prompt, config={"callbacks": callbacks, "tags": ["stuff"]}):
+        text += chunk.content
+        if sent < 0:
+            # The sources list has started; keep reading it without streaming it
+            continue
+        match = SOURCES_MARKER.search(text, max(0, sent - MARKER_HOLDBACK))
+        end = match.start() if match else max(sent, len(text) - MARKER_HOLDBACK)
+        if end > sent:
+            yield "token", text[sent:end]
+        sent = -1 if match else max(sent, end)
+    if sent >= 0 and len(text) > sent:
+        yield "token", text[sent:]
+    return text
+
+
+def stream_answer(chain, question: str, search_filter: dict, callbacks=None) -> Iterator[Tuple[str, object]]:
+    """
+    Answers a question with the question answering chain, yielding (event, data) pairs:
+    "sources" with the retrieved documents as soon as the search returns, "token" for
+    every piece of the answer as the model generates it, and "done" with the complete
+    answer dict (the same fields as the non-streaming reply).
+
+    Tokens are streamed when the documents are answered in a single stuff prompt; with
+    map_reduce or refine, the intermediate calls are not streamed and the final answer
+    is sent as a single token.
+    """
+    retriever = chain._scoped_retriever({"filter": search_filter})
+    docs = retriever.get_relevant_documents(question, callbacks=callbacks)
+    yield "sources", docs
+
+    combine = chain.combine_documents_chain
+    if isinstance(combine, BudgetedCombineDocumentsChain):
+        combine = combine._select(docs, question=question)
+
+    if isinstance(combine, StuffDocumentsChain):
+        inputs = combine._get_inputs(docs, question=question)
+        prompt = combine.llm_chain.prompt.format_prompt(**inputs)
+        output = yield from stream_tokens(combine.llm_chain.llm, prompt, callbacks)
+        # The sources list was held back from the token stream; take it from the complete output
+        answer_text, sources = split_sources(output)
+    else:
+        output = combine.run(input_documents=docs, question=question, callbacks=callbacks)
+        answer_text, sources = split_sources(output)
+        yield "token", answer_text
+
+    yield "done", {
+        "question": question,
+        "answer": answer_text,
+        "sources": sources,
+        "source_documents": docs,
+        "filter": search_filter,
+    }
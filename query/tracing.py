@@ -0,0 +1,245 @@
+import contextvars
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from functools import wraps
+from typing import Any, Callable, Dict, Optional
+
+# Fraction of the requests whose spans are all logged; every request logs one summary of its stages
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0))
+# Set to "true" to also log the texts (chunks, answers, ...) processed by the functions
+VERBOSE_LOGGING = os.environ.get("VERBOSE_LOGGING", "false").lower() == "true"
+# Cloud Logging links the log entries to Cloud Trace when it knows the project
+PROJECT_ID = os.environ.get("GOOGLE_CLOUD_PROJECT") or os.environ.get("GCP_PROJECT")
+SERVICE_NAME = os.environ.get("K_SERVICE") or os.environ.get("FUNCTION_TARGET") or "function"
+
+_TRACEPARENT = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+_current = contextvars.ContextVar("current_span", default=None)
+
+
+def export_json(record: dict) -> None:
+    """
+    Writes a record as one line of JSON on stdout, which Cloud Logging parses into a structured log entry.
+    """
+    print(json.dumps(record, default=str), flush=True)
+
+
+# Replaced to collect the records elsewhere, e.g. in the benchmarks
+export: Callable[[dict], None] = export_json
+
+
+def verbose(message: str) -> None:
+    """
+    Logs a message only when VERBOSE_LOGGING is enabled, for large texts not worth writing to stdout on every request.
+    """
+    if VERBOSE_LOGGING:
+        print(message)
+
+
+class Trace:
+    """
+    The spans of one request. Every finished span adds its duration and counters to the
+    totals of its stage, which the root span logs when it ends.
+    """
+
+    def __init__(self, trace_id: Optional[str] = None, sampled: bool = False):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.sampled = sampled
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.lock = threading.Lock()
+
+    def record(self, span: "Span") -> None:
+        with self.lock:
+            stage = self.stages.setdefault(span.name, {"spans": 0, "duration_ms": 0.0, "errors": 0})
+            stage["spans"] += 1
+            stage["duration_ms"] += span.duration_ms
+            stage["errors"] += span.error is not None
+            for counter, value in span.counters.items():
+                stage[counter] = stage.get(counter, 0) + value
+
+
+class Span:
+    """
+    A timed stage of a request, with attributes and counters (items, bytes, tokens,
+    api_calls, ...). Use it as a context manager, which also makes it the parent of the
+    spans started inside, or call `end` explicitly.
+    """
+
+    def __init__(self, trace: Trace, name: str, parent: Optional["Span"] = None, parent_span_id: Optional[str] = None, **attributes):
+        self.trace = trace
+        self.name = name
+        self.parent = parent
+        self.parent_span_id = parent.span_id if parent else parent_span_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.attributes = attributes
+        self.counters: Dict[str, float] = {}
+        self.error: Optional[str] = None
+        self.start_time = time.time()
+        self.duration_ms = 0.0
+        self._started = time.perf_counter()
+        self._ended = False
+        self._token = None
+
+    def add(self, **counters: float) -> None:
+        """
+        Increments the span's counters, e.g. `span.add(items=len(batch), api_calls=1)`. Safe to call from several threads.
+        """
+        with self.trace.lock:
+            for counter, value in counters.items():
+                self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        if self._ended:
+            return
+        self._ended = True
+        self.duration_ms = (time.perf_counter() - self._started) * 1000
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+
+        if self.parent is not None:
+            self.trace.record(self)
+            if self.trace.sampled:
+                export(self._record())
+        else:
+            # The root span summarizes the request, sampled or not
+            record = self._record()
+            record["stages"] = self.trace.stages
+            export(record)
+
+    def _record(self) -> dict:
+        # Field names follow the OpenTelemetry span model
+        record = {
+            "severity": "ERROR" if self.error else "INFO",
+            "message": f"{SERVICE_NAME} {self.name} {self.duration_ms:.1f}ms" + (f" failed: {self.error}" if self.error else ""),
+            "service": SERVICE_NAME,
+            "name": self.name,
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_span_id,
+            "start_time": self.start_time,
+            "duration_ms": round(self.duration_ms, 3),
+            "status": "ERROR" if self.error else "OK",
+            "attributes": self.attributes,
+            "counters": self.counters,
+        }
+        if self.error:
+            record["error"] = self.error
+        if PROJECT_ID:
+            record["logging.googleapis.com/trace"] = f"projects/{PROJECT_ID}/traces/{self.trace.trace_id}"
+            record["logging.googleapis.com/spanId"] = self.span_id
+            record["logging.googleapis.com/trace_sampled"] = self.trace.sampled
+        return record
+
+    def __enter__(self) -> "Span":
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        _current.reset(self._token)
+        self.end(exc)
+
+
+class _NoSpan(Span):
+    """
+    Returned by `span` outside of a trace (e.g. when a module is used on its own): does nothing.
+    """
+
+    def __init__(self):
+        pass
+
+    def add(self, **counters: float) -> None:
+        pass
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        pass
+
+    def __enter__(self) -> "Span":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+def trace(name: str, headers: Optional[dict] = None, **attributes) -> Span:
+    """
+    Starts the root span of a request. The trace continues the one of a W3C `traceparent`
+    header, if any. It is sampled with probability TRACE_SAMPLE_RATE.
+    """
+    matches = _TRACEPARENT.match((headers or {}).get("traceparent", "") or "")
+    if matches:
+        trace_id, parent_span_id, _ = matches.groups()
+        # Sampled at this function's own rate, whatever the caller's flags
+        return Span(Trace(trace_id, random.random() < TRACE_SAMPLE_RATE), name, parent_span_id=parent_span_id, **attributes)
+    return Span(Trace(sampled=random.random() < TRACE_SAMPLE_RATE), name, **attributes)
+
+
+def follow(request_span: Span, name: str, **attributes) -> Span:
+    """
+    Starts the root span of work that goes on after a request returned (e.g. a streamed
+    response), in the trace of the request's span.
+    """
+    if request_span is NO_SPAN:
+        return trace(name, **attributes)
+    return Span(Trace(request_span.trace.trace_id, request_span.trace.sampled), name, parent_span_id=request_span.span_id, **attributes)
+
+
+def span(name: str, parent: Optional[Span] = None, **attributes) -> Span:
+    """
+    Starts a span of the current request, as a child of `parent` or of the current span.
+    Outside of a request, returns a span that does nothing.
+    """
+    parent = parent or _current.get()
+    if parent is None or parent is NO_SPAN:
+        return NO_SPAN
+    return Span(parent.trace, name, parent=parent, **attributes)
+
+
+def current() -> Span:
+    return _current.get() or NO_SPAN
+
+
+def bind(function: Callable) -> Callable:
+    """
+    Wraps a function to run with the current span, for work submitted to other threads
+    (which do not inherit it), so that the spans they start belong to this request.
+    """
+    context = contextvars.copy_context()
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(function, *args, **kwargs)
+
+    return wrapper
+
+
+def traced(name: str) -> Callable:
+    """
+    Decorator tracing every call of a function entry point as a request. The `traceparent`
+    header of an HTTP request (or attribute of a CloudEvent) continues the caller's trace.
+    """
+
+    def decorator(handler: Callable) -> Callable:
+        @wraps(handler)
+        def wrapper(request, *args, **kwargs):
+            headers = getattr(request, "headers", None)
+            if headers is None and hasattr(request, "get_attributes"):
+                headers = request.get_attributes()
+            with trace(name, headers=headers):
+                return handler(request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator